@@ -5,19 +5,20 @@ using approximate bayesian computing (ABC)
 and a logistic branching process (lb-process).
 """
 
+import ast
+import concurrent.futures
 import copy
+import functools
+import json
+import os
 import re
 import sys
+import time
 
 import click
 import numpy as np
-from pyabc import (ABCSMC, Distribution, RV)
-from pyabc.sampler import MulticoreEvalParallelSampler
-from pyabc.populationstrategy import AdaptivePopulationSize
-from pyabc.populationstrategy import ConstantPopulationSize
-from pyabc import History
-import toml
 
+import dbtools
 import simtools
 
 
@@ -75,18 +76,20 @@ def select_time_match(time, *obs):
     return np.array(selected), np.array(matching)
 
 
-def distance(simulation, observation):
+def distance(state, simulation, observation):
     """
     rmsd between a simulated growth curve and a set of experimental datapoints
+    the noise is drawn from the seed of the simulation (see abc_model), if it has one
+    state - the ReconstructionState with the parameters and observations
     """
 
     distances = []
 
     # print(simulation, observation)
 
-    for id_string in simtools.OBSERVED:
+    for id_string in state.observed:
         sim = {str(k): simulation[id_string + '.' + str(k)] for k in ['time', 'size', 'rate']}
-        obs = {str(k): observation[id_string + '.' + str(k)] for k in simtools.OBSERVED[id_string]}
+        obs = {str(k): observation[id_string + '.' + str(k)] for k in state.observed[id_string]}
 
         # print(sim, obs)
 
@@ -94,102 +97,689 @@ def distance(simulation, observation):
 
         selected_size = sim['size']
 
-        filters = copy.deepcopy(simtools.PARAMS['filters'])
+        filters = copy.deepcopy(state.params['filters'])
         samplings, dilutions = simtools.get_samplings_dilutions(obs)
 
         # print(samplings, dilutions)
 
         # apply noise filters
-        selected_count = simtools.apply_sampling(selected_size, samplings, dilutions)
+        rng = simtools.random_state(simulation.get('seed'), id_string, 'noise')
+        selected_count = simtools.apply_sampling(selected_size, samplings, dilutions, rng)
         # print(type(selected_count))
-        selected_count = simtools.apply_noise(selected_count, filters)
+        selected_count = simtools.apply_noise(selected_count, filters, rng)
 
         # print(selected_count)
 
-        if simtools.PARAMS['abc_params']['distance_function'] == 'linear':
+        if state.params['abc_params']['distance_function'] == 'linear':
             distances.append(np.sum(np.abs(np.array(obs['count']) - selected_count)))
-        elif simtools.PARAMS['abc_params']['distance_function'] == 'rmsd':
+        elif state.params['abc_params']['distance_function'] == 'rmsd':
             distances.append(rmsd(np.array(obs['count']), selected_count))
 
     return sum(distances)
 
 
-def abc_model(params):
+def prescreen_distance(state, birthrate, seed):
     """
-    model for abc computation
-    run one timeline for each observation
+    distance of the deterministic bernoulli curves with the same parameters,
+    starting populations and noise as a particle
     """
-
     data = {}
+    for id_string, obs in state.observed.items():
+        time, size, rate = simtools.bernoulli_curve(
+            state.params['starting_population'][id_string](
+                rng=simtools.random_state(seed, id_string, 'start')),
+            obs['time'],
+            birthrate,
+            state.params['simulation_params']['deathrate_interaction'])
+        data[id_string] = {
+            'time': time,
+            'size': size,
+            'rate': rate,
+        }
+    data = flatten_observed(data)
+    data['seed'] = seed
+    return distance(state, data, flatten_observed(state.observed))
 
-    for id_string, obs in simtools.OBSERVED.items():
-        re_birthrates = re.compile(r'r([0-9])')
-        kvs = sorted([(k, v) for k, v in params.items() if re_birthrates.search(k)],
-                     key=lambda x: int(re_birthrates.search(x[0]).group(1)))
-        birthrate = [x[1] for x in kvs]
 
-        deathrate_interaction = simtools.PARAMS['simulation_params']['deathrate_interaction']
+def prescreen(state, birthrate, seed):
+    """
+    True if a particle should be rejected without running the stochastic simulator,
+    because its bernoulli distance exceeds prescreen_factor times the current epsilon
+    """
+    factor = state.params['abc_params']['prescreen_factor']
+    if factor is None or state.epsilon is None or \
+            state.params['abc_params']['simulator'] == 'bernoulli':
+        return False
+    with simtools.stage('prescreen'):
+        rejected = prescreen_distance(state, birthrate, seed) > factor*state.epsilon
+    if rejected:
+        simtools.count('prescreen_rejected')
+    return rejected
 
-        # print('obs', obs)
 
-        time, size, rate = simtools.simulate_timeline(
-            simtools.PARAMS['starting_population'][id_string](),
-            obs['time'],
+def fit_surrogate(kind, x, y, z):
+    """
+    regression model of y = log(1 + distance) from the birth rate control points x
+    kind is 'gp' (gaussian process) or 'gbr' (gradient boosting, fit to the lower quantile)
+    """
+    from scipy.stats import norm
+    if kind == 'gp':
+        from sklearn.gaussian_process import GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
+        kernel = ConstantKernel()*RBF(length_scale=np.ones(x.shape[1])) + WhiteKernel()
+        model = GaussianProcessRegressor(kernel=kernel, normalize_y=True)
+    elif kind == 'gbr':
+        from sklearn.ensemble import GradientBoostingRegressor
+        model = GradientBoostingRegressor(loss='quantile', alpha=norm.cdf(-z))
+    else:
+        sys.exit('Unsupported surrogate: ' + str(kind))
+    model.fit(x, y)
+    return model
+
+
+def surrogate_lower_bound(model, x, z):
+    """
+    predicted mean minus z standard deviations of y (or the fitted lower quantile)
+    """
+    if hasattr(model, 'kernel_'):
+        mean, std = model.predict(x, return_std=True)
+        return mean - z*std
+    return model.predict(x)
+
+
+def surrogate_screen(state, birthrate, seed=None):
+    """
+    'skip' if the distance surrogate is confident that a particle would be rejected.
+    A fraction (surrogate_audit) of those particles is simulated anyway ('audit'),
+    to monitor how often the surrogate skips particles that would have been accepted.
+    Otherwise None.
+    The audit draw comes from the particle seed, so it is reproducible like the simulations.
+    """
+    model = state.surrogates.get(len(birthrate))
+    if model is None or state.epsilon is None:
+        return None
+    with simtools.stage('surrogate'):
+        lower = surrogate_lower_bound(model, np.array([birthrate]),
+                                      state.params['abc_params']['surrogate_z'])[0]
+    if lower <= np.log1p(state.epsilon):
+        return None
+    # the birthrate is part of the key, common random numbers share the seed within a generation
+    rng = simtools.random_state(seed, 'audit', [float(b) for b in birthrate])
+    if rng is None:
+        rng = np.random
+    if rng.uniform() < state.params['abc_params']['surrogate_audit']:
+        simtools.count('surrogate_audited')
+        return 'audit'
+    simtools.count('surrogate_skipped')
+    return 'skip'
+
+
+def simulation_threads(state):
+    """
+    number of observations of a particle that are simulated at the same time
+    by every one of the parallel_simulations workers
+    """
+    threads = state.params['abc_params']['simulation_threads']
+    return max(1, min(threads, len(state.observed)))
+
+
+# thread pool of this process for simulate_observations, as (pid, threads, pool)
+# forked workers inherit the pool object but not its threads, so it is keyed on the pid
+SIMULATION_POOL = None
+
+
+def simulation_pool(threads):
+    """
+    thread pool with the given number of threads, created once per worker process
+    """
+    global SIMULATION_POOL
+    if SIMULATION_POOL is None or SIMULATION_POOL[:2] != (os.getpid(), threads):
+        SIMULATION_POOL = (os.getpid(), threads, concurrent.futures.ThreadPoolExecutor(threads))
+    return SIMULATION_POOL[2]
+
+
+def simulate_observations(state, birthrate, seed):
+    """
+    run one timeline for each observation, concurrently if simulation_threads(state) > 1
+    """
+    deathrate_interaction = state.params['simulation_params']['deathrate_interaction']
+    simulator = state.params['abc_params']['simulator']
+
+    jobs = []
+    for id_string, obs in state.observed.items():
+        simulation_seed = None
+        if seed is not None:
+            simulation_seed = simtools.derive_seed(seed, id_string, 'simulation')
+        # drawn here, in order, so that the global random state is used
+        # the same way no matter how many threads there are
+        starting_population = state.params['starting_population'][id_string](
+            rng=simtools.random_state(seed, id_string, 'start'))
+        jobs.append((starting_population, obs['time'], simulation_seed))
+
+    def simulate(job):
+        starting_population, times, simulation_seed = job
+        return simtools.simulate_timeline(
+            starting_population,
+            times,
             birthrate,
             deathrate_interaction,
-            simtools.PARAMS['abc_params']['simulator'],
+            simulator,
             # verbosity=1
+            seed=simulation_seed,
         )
 
+    threads = simulation_threads(state)
+    if threads > 1:
+        results = list(simulation_pool(threads).map(simulate, jobs))
+    else:
+        results = [simulate(job) for job in jobs]
+
+    data = {}
+    for id_string, (time, size, rate) in zip(state.observed, results):
         data[id_string] = {
             'time': time,
             'size': size,
             'rate': rate,
         }
+    return data
 
-    data = flatten_observed(data)
 
-    data['simulation'] = True # tag as simulation data for distance calculation
+def abc_model(state, params):
+    """
+    model for abc computation
+    run one timeline for each observation
+    state - the ReconstructionState of the reconstruction (bound in abc_setup)
+    """
+
+    with simtools.stage('model'):
+        data = {}
+        seed = simtools.particle_seed(state.params['abc_params'], state.generation)
+
+        re_birthrates = re.compile(r'r([0-9])')
+        kvs = sorted([(k, v) for k, v in params.items() if re_birthrates.search(k)],
+                     key=lambda x: int(re_birthrates.search(x[0]).group(1)))
+        birthrate = [x[1] for x in kvs]
+
+        # tag particles that are rejected without simulation for abc_distance
+        if prescreen(state, birthrate, seed):
+            return {'simulation': True, 'skipped': 'prescreen'}
+        screen = surrogate_screen(state, birthrate, seed)
+        if screen == 'skip':
+            return {'simulation': True, 'skipped': 'surrogate'}
+
+        data = simulate_observations(state, birthrate, seed)
+
+        data = flatten_observed(data)
+
+        data['simulation'] = True # tag as simulation data for distance calculation
+        if seed is not None:
+            data['seed'] = seed # noise in the distance is drawn from the same seed
+        if state.particle_log is not None:
+            # for logging the particle with its distance
+            data['birthrate'] = birthrate
+            data['audit'] = screen == 'audit'
 
     return data
 
 
-def abc_distance(a, b):
+def abc_distance(state, a, b):
     """
     Distance for abc computation. Simply runs distance using abc model dicts
     """
 
     # print(a, b)
 
-    if 'simulation' in a:
-        return distance(a, b)
-    else:
-        return distance(b, a)
+    if 'skipped' in a or 'skipped' in b:
+        return float('inf')
+
+    if 'simulation' not in a:
+        a, b = b, a
+    with simtools.stage('distance'):
+        d = distance(state, a, b)
+
+    if 'birthrate' in a:
+        if a['audit'] and d <= state.epsilon:
+            simtools.count('surrogate_missed')
+        simtools.log_particle(state.particle_log, state.generation, a['birthrate'], d)
+
+    return d
+
+
+class SamplerHooks:
+    """
+    Mixin for pyabc samplers that calls hooks before and after sampling each generation.
+    Hooks are objects with before(calibration) and after(calibration, sample) methods,
+    where calibration is true for the initial sample from the prior
+    that pyabc uses for calibrating epsilon.
+    If seed is set, the workers are seeded from it (see seeded_workers).
+    The workers write their stage timings periodically (see timed_workers).
+    state is the ReconstructionState of the run the sampler is used for (see add_hooks).
+    """
+
+    hooks = None
+    seed = None
+    state = None
+
+    def sample_until_n_accepted(self, n, simulate_one, *args, **kwargs):
+        calibration = kwargs.get('all_accepted', False)
+        for hook in self.hooks:
+            hook.before(calibration)
+        simulate_one = timed_workers(simulate_one, self.state)
+        if self.seed is not None:
+            simulate_one = seeded_workers(simulate_one, self.seed, self.state.generation)
+        sample = super().sample_until_n_accepted(n, simulate_one, *args, **kwargs)
+        for hook in self.hooks:
+            hook.after(calibration, sample)
+        return sample
+
+
+def seeded_workers(simulate_one, *keys):
+    """
+    wrap simulate_one so that every worker process seeds the global numpy random state
+    (which pyabc draws proposals from) before its first particle.
+    pyabc reseeds forked workers from the system, so this has to happen in the worker itself.
+    Workers are numbered in the order they start, so with a single worker the whole
+    run is reproducible, with several the accepted particles depend on their timing.
+    """
+    import multiprocessing
+    counter = multiprocessing.Value('i', 0)
+    # each forked worker gets its own copy of this list
+    seeded = []
+
+    def wrapper():
+        if not seeded:
+            with counter.get_lock():
+                worker = counter.value
+                counter.value += 1
+            np.random.seed(simtools.derive_seed(*keys, worker))
+            seeded.append(worker)
+        return simulate_one()
+
+    return wrapper
+
+
+def timed_workers(simulate_one, state):
+    """
+    wrap simulate_one so that every worker flushes its stage timings to state.timing_file
+    after a particle at most every simtools.FLUSH_INTERVAL seconds,
+    and once more when a forked worker exits.
+    The main process flushes its own timings in TimingRecorder.after.
+    """
+    import multiprocessing.util
+    main = os.getpid()
+    # each forked worker gets its own copy of this list
+    registered = []
+
+    def wrapper():
+        if not registered and os.getpid() != main:
+            # counters inherited from the main process are flushed by the main process
+            with simtools.TIMINGS_LOCK:
+                simtools.TIMINGS.clear()
+            multiprocessing.util.Finalize(None, simtools.flush_timings,
+                                          args=(state.timing_file, state.generation),
+                                          kwargs={'force': True}, exitpriority=0)
+            registered.append(True)
+        result = simulate_one()
+        simtools.flush_timings(state.timing_file, state.generation)
+        return result
+
+    return wrapper
+
+
+def hooked_sampler(base, *args, **kwargs):
+    """
+    create a pyabc sampler of class base with SamplerHooks mixed in
+    """
+    sampler = type('Hooked' + base.__name__, (SamplerHooks, base), {})(*args, **kwargs)
+    sampler.hooks = []
+    return sampler
+
+
+def write_json_line(filename, entry):
+    with open(filename, 'a') as out_file:
+        out_file.write(json.dumps(entry) + '\n')
+
+
+class TimingRecorder:
+    """
+    Sampler hook that collects the per stage timings reported by the workers
+    and writes them, aggregated per worker and generation, as json lines next to the database.
+    The main process records the wall time of sampling and of everything pyabc does
+    between generations (fitting transitions, epsilon updates, database writes).
+    """
+
+    def __init__(self, abc, state, dbfile, resume=False):
+        self.abc = abc
+        self.state = state
+        self.sidecar = dbfile + '.timing.jsonl'
+        self.scratch = dbfile + '.timing.scratch'
+        # a resumed run appends to the timings of the earlier generations
+        for filename in [self.scratch] if resume else [self.sidecar, self.scratch]:
+            if os.path.exists(filename):
+                os.remove(filename)
+        state.timing_file = self.scratch
+        self.generation = None
+        self.sampling = None
+        self.sampled = None
+
+    def before(self, calibration):
+        self.finish()
+        if calibration:
+            self.generation = -1
+        else:
+            self.generation = self.abc.history.max_t + 1
+        self.state.generation = self.generation
+        self.start = time.perf_counter()
+
+    def after(self, calibration, sample):
+        self.sampled = time.perf_counter()
+        self.sampling = self.sampled - self.start
+        # forked workers have flushed when they exited, only the main process is left
+        simtools.flush_timings(self.scratch, self.generation, force=True)
+        workers = {}
+        if os.path.exists(self.scratch):
+            with open(self.scratch, 'r') as in_file:
+                for line in in_file:
+                    entry = json.loads(line)
+                    stages = workers.setdefault(entry['worker'], {})
+                    for name, (calls, seconds) in entry['stages'].items():
+                        counter = stages.setdefault(name, [0, 0.0])
+                        counter[0] += calls
+                        counter[1] += seconds
+            os.remove(self.scratch)
+        for worker, stages in sorted(workers.items()):
+            write_json_line(self.sidecar, {'generation': self.generation,
+                                           'worker': worker,
+                                           'stages': stages})
+
+    def finish(self):
+        """
+        write the main process timings of the last sampled generation
+        """
+        if self.sampled is None:
+            return
+        write_json_line(self.sidecar, {
+            'generation': self.generation,
+            'worker': 'main',
+            'stages': {
+                'sampling': [1, self.sampling],
+                'pyabc': [1, time.perf_counter() - self.sampled],
+            },
+        })
+        self.sampled = None
+
+
+class EpsilonTracker:
+    """
+    Sampler hook that makes the epsilon of the generation being sampled
+    available to the workers as state.epsilon (used for prescreening)
+    """
+
+    def __init__(self, abc, state):
+        self.abc = abc
+        self.state = state
+
+    def before(self, calibration):
+        self.state.epsilon = None
+        if not calibration:
+            epsilon = self.abc.eps(self.abc.history.max_t + 1)
+            if epsilon < float('inf'):
+                self.state.epsilon = epsilon
+
+    def after(self, calibration, sample):
+        pass
 
 
-def abc_setup(birthrate_groups):
+class Surrogate:
     """
-    create abc model
-    parameters are stored in the global simtools.PARAMS dict
+    Sampler hook that fits a surrogate of the distance, per number of control points,
+    to the particles evaluated in earlier generations (logged next to the database).
+    The workers are forked after the hook runs, and use it to skip particles (see surrogate_screen).
     """
 
-    for curve_resolution in simtools.PARAMS['abc_params']['resolution_limits']:
+    # the cost of fitting a gaussian process grows with the cube of the training set
+    max_training = 500
+    min_training = 20
+
+    def __init__(self, abc, state, dbfile):
+        self.abc = abc
+        self.state = state
+        self.log = dbfile + '.particles.jsonl'
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        state.particle_log = self.log
+
+    def before(self, calibration):
+        self.state.surrogates = {}
+        if calibration or not os.path.exists(self.log):
+            return
+        abc_params = self.state.params['abc_params']
+        if self.abc.history.max_t + 1 < abc_params['surrogate_after']:
+            return
+        samples = {}
+        with open(self.log, 'r') as in_file:
+            for line in in_file:
+                entry = json.loads(line)
+                if entry['distance'] < float('inf'):
+                    samples.setdefault(len(entry['birthrate']), []).append(entry)
+        for points, entries in samples.items():
+            entries = entries[-self.max_training:]
+            if len(entries) < self.min_training:
+                continue
+            x = np.array([x['birthrate'] for x in entries])
+            y = np.log1p([x['distance'] for x in entries])
+            self.state.surrogates[points] = fit_surrogate(
+                abc_params['surrogate'], x, y, abc_params['surrogate_z'])
+
+    def after(self, calibration, sample):
+        pass
+
+
+class ModelPruner:
+    """
+    Sampler hook that retires resolution models whose probability has stayed below
+    prune_threshold for prune_generations generations. The model prior of retired models
+    is set to zero, so the whole population goes to the surviving models.
+    The most probable model is never retired. Pruning is recorded in the database.
+    """
+
+    def __init__(self, abc, state, dbfile):
+        self.abc = abc
+        self.state = state
+        self.dbfile = dbfile
+        self.retired = set()
+
+    def before(self, calibration):
+        from scipy import stats
+        if calibration:
+            return
+        threshold = self.state.params['abc_params']['prune_threshold']
+        generations = self.state.params['abc_params']['prune_generations']
+        t = self.abc.history.max_t
+        if t + 1 < generations:
+            return
+        probabilities = self.abc.history.get_model_probabilities().fillna(0.0)
+        recent = probabilities.loc[t - generations + 1:t]
+        latest = probabilities.loc[t]
+        pruned = [m for m in latest.index
+                  if m not in self.retired and latest[m] > 0.0
+                  and m != latest.idxmax() and np.all(recent[m] < threshold)]
+        if not pruned:
+            return
+        for m in pruned:
+            print('Pruning model', m, 'with probability', latest[m], file=sys.stderr)
+            dbtools.record_pruned(self.dbfile, self.abc.history.id, int(m), t + 1, float(latest[m]))
+            self.retired.add(m)
+        survivors = [m for m in range(len(self.abc.models)) if m not in self.retired]
+        p_survivors = [self.abc.model_prior.pmf(m) for m in survivors]
+        # the proposal function of this generation already holds the prior, so change it in place
+        self.abc.model_prior.distribution = stats.rv_discrete(
+            values=(survivors, [x/sum(p_survivors) for x in p_survivors]))
+
+    def after(self, calibration, sample):
+        pass
+
+
+def posterior_curves(abc_history, points, t=None, extent=1.0):
+    """
+    particles of all resolution models of a reconstruction as growth rate curves,
+    interpolated onto a grid of evenly spaced control points
+    extent is the length of the new timeline relative to the reconstructed one,
+    beyond the end of the reconstructed timeline the last control point is extrapolated
+    returns curves (one per row) and their weights (including the model probability)
+    """
+    if t is None:
+        t = abc_history.max_t
+    grid = np.linspace(0.0, extent, points)
+    curves = []
+    weights = []
+    for m, p_model in abc_history.get_model_probabilities(t)['p'].items():
+        if p_model <= 0.0:
+            continue
+        df, w = abc_history.get_distribution(m=m, t=t)
+        columns = sorted(df.columns, key=lambda x: int(x.split('.r')[-1]))
+        for rates, weight in zip(df[columns].values, w):
+            if len(rates) == 1:
+                curves.append(np.full(points, rates[0]))
+            else:
+                curves.append(np.interp(grid, np.linspace(0.0, 1.0, len(rates)), rates))
+            weights.append(weight*p_model)
+    weights = np.array(weights)
+    return np.array(curves), weights/np.sum(weights)
+
+
+def warm_start_limits(curves, weights, rate_limits, width):
+    """
+    per control point rate limits covering the mean +- width standard deviations of curves,
+    within the rate_limits
+    """
+    low, high = sorted(rate_limits)
+    mean = np.average(curves, axis=0, weights=weights)
+    sd = np.sqrt(np.average((curves - mean)**2, axis=0, weights=weights))
+    # never narrower than a few percent of the full range
+    sd = np.maximum(sd, 0.02*(high - low))
+    return np.maximum(mean - width*sd, low), np.minimum(mean + width*sd, high)
+
+
+# one base per control point (at most 9)
+HALTON_BASES = [2, 3, 5, 7, 11, 13, 17, 19, 23]
+
+
+class HaltonSequence:
+    """
+    scrambled halton sequence in the unit cube, every digit position of every base
+    has its own random permutation of the digits (which breaks up the correlation between
+    the larger bases). The position in the sequence is shared between forked sampler workers,
+    so that together they draw consecutive points.
+    """
+
+    def __init__(self, dimensions, seed=None):
+        import math
+        import multiprocessing
+        rng = np.random.RandomState(seed)
+        self.bases = HALTON_BASES[:dimensions]
+        # enough digits to tell apart 2^31 points
+        self.permutations = [
+            [rng.permutation(base) for __ in range(int(math.ceil(31/math.log2(base))))]
+            for base in self.bases]
+        self.index = multiprocessing.Value('l', 0)
+
+    def point(self, i):
+        point = []
+        for base, permutations in zip(self.bases, self.permutations):
+            x = 0.0
+            scale = 1.0/base
+            digits = i
+            for permutation in permutations:
+                x += permutation[digits % base]*scale
+                digits //= base
+                scale /= base
+            point.append(x)
+        return np.array(point)
+
+    def next(self):
+        with self.index.get_lock():
+            i = self.index.value
+            self.index.value += 1
+        return self.point(i)
+
+
+def quasi_random(distribution, lows, highs, seed=None):
+    """
+    make a pyabc Distribution of uniform birth rate priors draw from a scrambled halton sequence.
+    The points are still uniformly distributed over the prior, so the (unit) importance weights
+    that pyabc gives particles drawn from the prior stay correct.
+    Only the initial samples are drawn with rvs(), later generations use the transitions.
+    """
+    from pyabc import Parameter
+    sequence = HaltonSequence(len(lows), seed)
+    lows = np.array(lows)
+    highs = np.array(highs)
+
+    def rvs():
+        x = lows + sequence.next()*(highs - lows)
+        return Parameter({'birthrate.r' + str(i): float(v) for i, v in enumerate(x)})
+
+    distribution.rvs = rvs
+    return distribution
+
+
+def abc_setup(state, sampler, warm_start=None, extent=1.0):
+    """
+    create abc model for the parameters and observations in state (a ReconstructionState),
+    which the model and distance functions are bound to
+    sampler is a pyabc sampler with SamplerHooks (see Reconstruction.sampler)
+    warm_start is a History of a (coarser) pilot reconstruction, the priors are then
+    limited to the region around its posterior curves (see warm_start_limits)
+    extent is the length of the timeline relative to the warm start (see posterior_curves)
+    """
+    # pyabc is slow to import, so only do it when actually needed
+    from pyabc import ABCSMC, Distribution, RV
+    from pyabc.populationstrategy import ConstantPopulationSize
+
+    abc_params = state.params['abc_params']
+    for curve_resolution in abc_params['resolution_limits']:
         assert curve_resolution > 0 and curve_resolution <= 9
 
     abc_priors = []
+    # share of the full prior volume in each model
+    prior_volumes = []
+    rate_limits = sorted(abc_params['rate_limits'])
     for resolution_limit in range(
-            simtools.PARAMS['abc_params']['resolution_limits'][0],
-            simtools.PARAMS['abc_params']['resolution_limits'][1] + 1):
+            abc_params['resolution_limits'][0],
+            abc_params['resolution_limits'][1] + 1):
+        if warm_start is None:
+            lows = [rate_limits[0] for __ in range(resolution_limit)]
+            highs = [rate_limits[1] for __ in range(resolution_limit)]
+        else:
+            lows, highs = warm_start_limits(
+                *posterior_curves(warm_start, resolution_limit, extent=extent),
+                rate_limits, abc_params['warm_start_width'])
         abc_prior_dict = {}
+        volume = 1.0
         for i in range(resolution_limit):
-            abc_prior_dict['r' + str(i)] = \
-                RV("uniform", simtools.PARAMS['abc_params']['rate_limits'][0],
-                abs(simtools.PARAMS['abc_params']['rate_limits'][1] - \
-                simtools.PARAMS['abc_params']['rate_limits'][0]))
-        abc_priors.append(Distribution(birthrate=copy.deepcopy(abc_prior_dict)))
+            abc_prior_dict['r' + str(i)] = RV("uniform", lows[i], highs[i] - lows[i])
+            volume *= (highs[i] - lows[i])/(rate_limits[1] - rate_limits[0])
+        abc_prior = Distribution(birthrate=copy.deepcopy(abc_prior_dict))
+        if abc_params['initial_sampling'] == 'halton':
+            seed = abc_params['seed']
+            if seed is not None:
+                seed = simtools.derive_seed(seed, resolution_limit, 'halton')
+            abc_prior = quasi_random(abc_prior, lows, highs, seed)
+        abc_priors.append(abc_prior)
+        prior_volumes.append(volume)
 
     print('priors', abc_priors)
 
+    # restricting the prior of a model to a fraction of its volume raises its evidence
+    # by the inverse of that fraction (if no posterior mass is cut off),
+    # so the model prior compensates to keep the model probabilities unchanged
+    model_prior = None
+    if warm_start is not None:
+        model_prior = RV("rv_discrete", values=(
+            list(range(len(prior_volumes))),
+            [x/sum(prior_volumes) for x in prior_volumes]))
+
     #abc = ABCSMC([abc_model for __ in abc_priors], abc_priors, abc_distance,
     #             population_size=AdaptivePopulationSize(
     #                 int(simtools.PARAMS['abc_params']['starting_population_size']),
@@ -198,56 +788,742 @@ def abc_setup(birthrate_groups):
     #                 min_population_size=int(simtools.PARAMS['abc_params']['min_population_size'])),
     #             sampler=MulticoreEvalParallelSampler(
     #                 simtools.PARAMS['abc_params']['parallel_simulations']))
-    abc = ABCSMC([abc_model for __ in abc_priors], abc_priors, abc_distance,
+    # pyabc names models and distances after the function, so the bound ones keep their names
+    model = functools.update_wrapper(functools.partial(abc_model, state), abc_model)
+    model_distance = functools.update_wrapper(functools.partial(abc_distance, state), abc_distance)
+    abc = ABCSMC([model for __ in abc_priors], abc_priors, model_distance,
                  population_size=ConstantPopulationSize(
-                     int(simtools.PARAMS['abc_params']['starting_population_size'])),
-                 sampler=MulticoreEvalParallelSampler(
-                     simtools.PARAMS['abc_params']['parallel_simulations']))
+                     int(abc_params['starting_population_size'])),
+                 model_prior=model_prior,
+                 sampler=sampler)
 
     return abc
 
 
 
+def add_hooks(abc, state, dbfile, resume=False):
+    """
+    set the sampler hooks configured in abc_params, returns the TimingRecorder
+    """
+    abc.sampler.state = state
+    timing = TimingRecorder(abc, state, dbfile, resume)
+    abc.sampler.hooks = [timing, EpsilonTracker(abc, state)]
+    if state.params['abc_params']['surrogate'] is not None:
+        abc.sampler.hooks.append(Surrogate(abc, state, dbfile))
+    if state.params['abc_params']['prune_threshold'] is not None:
+        abc.sampler.hooks.append(ModelPruner(abc, state, dbfile))
+    return timing
+
+
+def pilot_reconstruction(state, sampler, observed, dbfile):
+    """
+    reconstruct with the resolutions up to warm_start only, for warm starting the full run
+    returns the History of the pilot
+    """
+    pilot = ReconstructionState(copy.deepcopy(state.params), state.observed)
+    abc_params = pilot.params['abc_params']
+    abc_params['resolution_limits'] = [
+        abc_params['resolution_limits'][0],
+        min(abc_params['warm_start'], abc_params['resolution_limits'][1])]
+    abc_params['max_populations'] = abc_params['warm_start_generations']
+    print('Running pilot for resolutions', abc_params['resolution_limits'],
+          'saving database in:', dbfile, file=sys.stderr)
+    abc = abc_setup(pilot, sampler)
+    abc.new('sqlite:///' + dbfile, observed)
+    timing = add_hooks(abc, pilot, dbfile)
+    abc.run(minimum_epsilon=abc_params['min_epsilon'],
+            max_nr_populations=abc_params['max_populations'],
+            min_acceptance_rate=abc_params['min_acceptance'])
+    timing.finish()
+    return abc.history
+
+
+def warm_start_info(dbfile, run_id, extent):
+    """
+    run metadata recording the posterior the priors of a run were built from,
+    so that resume can build them again
+    """
+    return {'warm_start': os.path.abspath(dbfile), 'warm_start_id': run_id, 'extent': extent}
+
+
+class ReconstructionState:
+    """
+    Everything the model and distance functions of one reconstruction read: the parameters
+    and observations (as from simtools.parse_params and parse_observations), and what the
+    sampler hooks set for the generation being sampled. The sampler workers are forked
+    after the hooks run, so they see the state of the generation they sample.
+    """
+
+    def __init__(self, params, observed):
+        self.params = params
+        self.observed = observed
+        # ABC generation currently being sampled (-1 is the calibration sample)
+        self.generation = None
+        # acceptance threshold of the generation currently being sampled (None while calibrating)
+        self.epsilon = None
+        # if set, evaluated particles and their distances are appended to this file
+        self.particle_log = None
+        # fitted distance surrogates per number of control points (see Surrogate)
+        self.surrogates = {}
+        # if set, the workers append their stage timings to this file (see timed_workers)
+        self.timing_file = None
+
+
+class Reconstruction:
+    """
+    Reconstruction of the birth rate timeline of one group of observations.
+    Owns its parameters, observations and the rest of the reconstruction state
+    (a ReconstructionState, which is passed explicitly to the model and distance functions),
+    and the pyabc sampler that all its runs share. Several reconstructions can thus be
+    created and run in one process.
+    """
+
+    def __init__(self, paramfile, obsfile, dbfile, resolution=None):
+        """
+        resolution - only reconstruct this number of control points (see merge-shards)
+        """
+        self.paramfile = paramfile
+        self.obsfile = obsfile
+        self.dbfile = dbfile
+        observed = simtools.parse_observations(obsfile)
+        params = simtools.parse_params(paramfile, observed)
+        if resolution is not None:
+            params['abc_params']['resolution_limits'] = [resolution, resolution]
+        self.state = ReconstructionState(params, observed)
+        self.samplers = {}
+        self.observed = flatten_observed(observed)
+        self.birthrate_groups = len({v[0] for k, v in self.observed.items()
+                                     if 'birthrate_group' in k})
+
+    @property
+    def params(self):
+        return self.state.params
+
+    def sampler(self, single_core=False):
+        """
+        the pyabc sampler of this reconstruction, created on first use
+        single_core runs all simulations in the main process (useful for profiling)
+        """
+        from pyabc.sampler import MulticoreEvalParallelSampler, SingleCoreSampler
+        if single_core not in self.samplers:
+            if single_core:
+                sampler = hooked_sampler(SingleCoreSampler)
+            else:
+                sampler = hooked_sampler(MulticoreEvalParallelSampler,
+                                         self.params['abc_params']['parallel_simulations'])
+            sampler.seed = self.params['abc_params']['seed']
+            self.samplers[single_core] = sampler
+        return self.samplers[single_core]
+
+    def history(self, run_id=None):
+        """
+        the pyabc History of the database (the latest run, unless run_id is given)
+        """
+        from pyabc import History
+        abc_history = History('sqlite:///' + self.dbfile)
+        if run_id is not None:
+            abc_history.id = run_id
+        return abc_history
+
+    def _run(self, abc, resume=False, profile=None):
+        max_populations = self.params['abc_params']['max_populations']
+        if resume:
+            max_populations -= abc.history.max_t + 1
+            if max_populations <= 0:
+                print('The run already has max_populations generations', file=sys.stderr)
+                return
+        timing = add_hooks(abc, self.state, self.dbfile, resume)
+
+        def run():
+            abc.run(minimum_epsilon=self.params['abc_params']['min_epsilon'],
+                    max_nr_populations=max_populations,
+                    min_acceptance_rate=self.params['abc_params']['min_acceptance'])
+
+        print('Running ABC', file=sys.stderr)
+        if profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(run)
+            profiler.dump_stats(self.dbfile + '.prof')
+            print('Saved profile in:', self.dbfile + '.prof', file=sys.stderr)
+        elif profile == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            run()
+            profiler.stop()
+            with open(self.dbfile + '.profile.html', 'w') as out_html:
+                out_html.write(profiler.output_html())
+            print('Saved profile in:', self.dbfile + '.profile.html', file=sys.stderr)
+        else:
+            run()
+        timing.finish()
+
+    def run(self, engine='abc', profile=None):
+        """
+        start a new reconstruction in the database
+        engine - 'abc', or 'mcmc' for likelihood tempered SMC (see likelihood.py)
+        profile - 'cprofile' or 'pyinstrument' (simulations then run in the main process)
+        """
+        if engine == 'mcmc':
+            import likelihood
+            print('Saving database in:', 'sqlite:///' + self.dbfile, file=sys.stderr)
+            likelihood.reconstruct(self.params, self.state.observed, self.observed, self.dbfile)
+            return
+
+        sampler = self.sampler(single_core=profile is not None)
+        warm_start = None
+        meta_info = {}
+        if self.params['abc_params']['warm_start'] is not None:
+            warm_start = pilot_reconstruction(self.state, sampler, self.observed,
+                                              self.dbfile + '.pilot.db')
+            meta_info = warm_start_info(self.dbfile + '.pilot.db', warm_start.id, 1.0)
+
+        # generate abc model
+        abc = abc_setup(self.state, sampler, warm_start=warm_start)
+
+        db_path = 'sqlite:///' + self.dbfile
+        print('Saving database in:', db_path, file=sys.stderr)
+
+        # run abc
+        print('Constructing ABC', file=sys.stderr)
+        abc.new(db_path, self.observed, meta_info=meta_info)
+        self._run(abc, profile=profile)
+
+    def resume(self, run_id=None):
+        """
+        continue a stopped reconstruction until max_populations generations in total,
+        with the priors it was started with (see warm_start_info)
+        """
+        from pyabc import History
+        abc_history = self.history(run_id)
+        # the priors of a warm started run come from the posterior it was started from
+        meta_info = ast.literal_eval(abc_history.get_abc().json_parameters or '{}')
+        warm_start = None
+        extent = 1.0
+        if 'warm_start' in meta_info:
+            if not os.path.exists(meta_info['warm_start']):
+                sys.exit('Can not resume without the database the run was warm started from: '
+                         + meta_info['warm_start'])
+            warm_start = History('sqlite:///' + meta_info['warm_start'])
+            warm_start.id = meta_info['warm_start_id']
+            extent = meta_info['extent']
+        elif self.params['abc_params']['warm_start'] is not None:
+            sys.exit('The run does not record its warm start, so its priors can not be '
+                     'rebuilt. Reconstruct it again instead.')
+        abc = abc_setup(self.state, self.sampler(), warm_start=warm_start, extent=extent)
+        print('Resuming run', abc_history.id, 'of', self.dbfile, 'after generation',
+              abc_history.max_t, file=sys.stderr)
+        abc.load('sqlite:///' + self.dbfile, abc_history.id)
+        self._run(abc, resume=True)
+
+    def update(self, previous):
+        """
+        reconstruct with priors limited to the region around the posterior curves of
+        a previous reconstruction (the database previous) of the observations with
+        fewer time points, stretched to the longer timeline
+        """
+        from pyabc import History
+        previous_history = History('sqlite:///' + previous)
+        extent = end_time(self.observed)/end_time(previous_history.observed_sum_stat())
+        if extent < 1.0:
+            sys.exit('The observations end before those of the previous reconstruction')
+        print('Updating', previous, 'with the timeline extended by a factor',
+              '{:.3g}'.format(extent), file=sys.stderr)
+
+        abc = abc_setup(self.state, self.sampler(), warm_start=previous_history, extent=extent)
+        print('Saving database in:', 'sqlite:///' + self.dbfile, file=sys.stderr)
+        abc.new('sqlite:///' + self.dbfile, self.observed,
+                meta_info=warm_start_info(previous, previous_history.id, extent))
+        self._run(abc)
+
+    def reweight(self, previous, previous_paramfile, min_ess=0.5):
+        """
+        importance reweight the final population of the database previous, reconstructed
+        with the parameters in previous_paramfile, to the parameters of this reconstruction
+        (see the reweight command). Runs a new reconstruction if that is not possible.
+        """
+        from pyabc import History
+
+        previous_params = simtools.parse_params(previous_paramfile, self.state.observed)
+        abc_params = self.params['abc_params']
+        rate_limits = sorted(abc_params['rate_limits'])
+        resolution_limits = abc_params['resolution_limits']
+        redistance = self.params['filters'] != previous_params['filters']
+
+        def rerun(reason):
+            print(reason + ', reconstructing again', file=sys.stderr)
+            self.run()
+
+        reason = prior_widened(previous_params['abc_params'], abc_params)
+        if reason is not None:
+            return rerun(reason)
+        # the epsilon of the previous run is on the scale of its distance function
+        if abc_params['distance_function'] != previous_params['abc_params']['distance_function']:
+            return rerun('The distance_function changed')
+
+        previous_history = History('sqlite:///' + previous)
+        t = previous_history.max_t
+        epsilon = float(previous_history.get_all_populations().set_index('t').loc[t]['epsilon'])
+
+        population = dbtools.read_population(previous_history, t)
+        particles = []
+        for __, parameter, weight, d, simulation in population:
+            rates = np.array(list(parameter.values()))
+            points = len(rates)
+            if not resolution_limits[0] <= points <= resolution_limits[1]:
+                continue
+            if np.any(rates < rate_limits[0]) or np.any(rates > rate_limits[1]):
+                continue
+            weight *= prior_density(rate_limits, points) / \
+                prior_density(previous_params['abc_params']['rate_limits'], points)
+            if redistance:
+                if 'simulation' not in simulation:
+                    return rerun('The previous database has no stored simulations')
+                d = distance(self.state, simulation, self.observed)
+                if d > epsilon:
+                    continue
+            particles.append((points - resolution_limits[0], parameter, weight, d))
+
+        if not particles:
+            return rerun('No particles remain')
+        weights = np.array([x[2] for x in particles])
+        weights /= np.sum(weights)
+        particles = [(m, parameter, w, d) for (m, parameter, __, d), w in zip(particles, weights)]
+        ess = 1.0/np.sum(weights**2)
+        print('{} of {} particles remain, effective sample size {:.1f}'.format(
+            len(particles), len(population), ess), file=sys.stderr)
+        if ess < min_ess*len(population):
+            return rerun('Effective sample size below {:g} of the population'.format(min_ess))
+
+        model_names = ['abc_model' for __ in range(resolution_limits[0], resolution_limits[1] + 1)]
+        history = dbtools.new_history(self.dbfile, self.observed, model_names,
+                                      {'reweighted': previous})
+        dbtools.append_population(history, 0, epsilon, particles, 0, model_names)
+        history.done()
+        for m in range(len(model_names)):
+            print('model {} probability {:.3g}'.format(
+                m, np.sum(weights[[x[0] == m for x in particles]])), file=sys.stderr)
+        print('Saved reweighted population in:', self.dbfile, file=sys.stderr)
+
+    def merge_shards(self, shards):
+        """
+        merge reconstructions of single resolutions (the databases shards) into the database
+        (see the merge-shards command)
+        """
+        from pyabc import History
+
+        resolution_limits = self.params['abc_params']['resolution_limits']
+        model_names = ['abc_model' for __ in range(resolution_limits[0], resolution_limits[1] + 1)]
+
+        histories = {}
+        for shard in shards:
+            abc_history = History('sqlite:///' + shard)
+            df, __ = abc_history.get_distribution(m=0, t=abc_history.max_t)
+            resolution = df.shape[1]
+            assert resolution_limits[0] <= resolution <= resolution_limits[1]
+            assert resolution - resolution_limits[0] not in histories
+            histories[resolution - resolution_limits[0]] = abc_history
+            print('Shard', shard, 'resolution', resolution, 'generations', abc_history.max_t + 1)
+
+        history = dbtools.new_history(self.dbfile, self.observed, model_names,
+                                      {'merged_shards': list(shards)})
+        caches = {m: {} for m in histories}
+        for t in range(max(x.max_t for x in histories.values()) + 1):
+            generations = {m: min(t, x.max_t) for m, x in histories.items()}
+            populations = {m: x.get_all_populations().set_index('t').loc[generations[m]]
+                           for m, x in histories.items()}
+            epsilon = max(x['epsilon'] for x in populations.values())
+            evidence = {m: shard_evidence(x, epsilon, caches[m]) for m, x in histories.items()}
+            particles = []
+            for m, abc_history in histories.items():
+                p_model = evidence[m]/sum(evidence.values())
+                if p_model <= 0.0:
+                    continue
+                for __, parameter, weight, d, __ in dbtools.read_population(
+                        abc_history, generations[m]):
+                    particles.append((m, parameter, weight*p_model, d))
+            samples = sum(int(populations[m]['samples'])
+                          for m, x in histories.items() if t <= x.max_t)
+            dbtools.append_population(history, t, epsilon, particles, samples, model_names)
+            print('t: {}, eps: {:.4g}, model probabilities: {}'.format(t, epsilon, ', '.join(
+                '{}: {:.3g}'.format(m, evidence[m]/sum(evidence.values()))
+                for m in sorted(evidence))))
+        history.done()
+
+    def monitor(self, interval=30.0, once=False, run_id=1):
+        """
+        print the progress of the run run_id every interval seconds until it is done
+        (see the monitor command)
+        """
+        follow(self.dbfile, self.params['abc_params'], interval, once, run_id)
+
+    def posterior(self, t=None, run_id=None):
+        """
+        posterior of generation t (default: the last one)
+        returns a dict of model index -> (model probability, parameter DataFrame, weights)
+        """
+        abc_history = self.history(run_id)
+        if t is None:
+            t = abc_history.max_t
+        result = {}
+        for m, p_model in abc_history.get_model_probabilities(t)['p'].items():
+            if p_model <= 0.0:
+                continue
+            df, w = abc_history.get_distribution(m=m, t=t)
+            result[m] = (p_model, df, w)
+        return result
+
+
 @main.command()
 @click.option('-p', '--paramfile', type=click.Path())
 @click.option('-o', '--obsfile', type=click.Path())
 @click.option('-d', '--dbfile', type=click.Path())
-def reconstruct(paramfile, obsfile, dbfile):
+@click.option('--profile', type=click.Choice(['cprofile', 'pyinstrument']), default=None,
+              help='profile the run (simulations then run in the main process)')
+@click.option('--engine', type=click.Choice(['abc', 'mcmc']), default='abc',
+              help='abc, or likelihood tempered SMC with metropolis moves (bernoulli only)')
+@click.option('--resolution', type=int, default=None,
+              help='only reconstruct this resolution (see merge-shards)')
+def reconstruct(paramfile, obsfile, dbfile, profile, engine, resolution):
     """
     Reconstruct a likely reproduction rate function given a set of experimental observations
+    Per stage timings are saved in DBFILE.timing.jsonl (see the timing command)
     """
-
-    # Generate observed dictionary from input observations
-    observed = simtools.parse_observations(obsfile)
-    print('Observed data:', observed)
-
-    # Set simulation parameters
-    simtools.parse_params(paramfile, observed)
-    # print(simtools.PARAMS)
+    reconstruction = Reconstruction(paramfile, obsfile, dbfile, resolution)
+    print('Observed data:', reconstruction.state.observed)
     print('Starting populations (poisson distributed)')
-    for k, v in simtools.PARAMS['starting_population'].items():
+    for k, v in reconstruction.params['starting_population'].items():
         print(k, v())
     print('Simulation end times')
-    for k, v in simtools.PARAMS['end_time'].items():
+    for k, v in reconstruction.params['end_time'].items():
         print(k, v())
-    print('Using simulator:', simtools.PARAMS['abc_params']['simulator'])
+    print('Using simulator:', reconstruction.params['abc_params']['simulator'])
+    print('Observed data (flat):', reconstruction.observed)
+    reconstruction.run(engine, profile)
 
-    observed = flatten_observed(observed)
-    print('Observed data (flat):', observed)
 
-    # generate abc model
-    abc = abc_setup(len({v[0] for k, v in observed.items() if 'birthrate_group' in k}))
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path())
+@click.option('-o', '--obsfile', type=click.Path())
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('--run-id', type=int, default=None)
+def resume(paramfile, obsfile, dbfile, run_id):
+    """
+    Continue a stopped reconstruction in DBFILE up to max_populations generations
+    """
+    Reconstruction(paramfile, obsfile, dbfile).resume(run_id)
+
+
+def end_time(observed):
+    """
+    last time point of any observation in a flat observed dict
+    """
+    return max(max(v) for k, v in observed.items() if k.endswith('.time'))
 
-    db_path = 'sqlite:///' + dbfile
-    print('Saving database in:', db_path, file=sys.stderr)
 
-    # run abc
-    print('Constructing ABC', file=sys.stderr)
-    abc.new(db_path, observed)
-    print('Running ABC', file=sys.stderr)
-    abc.run(minimum_epsilon=simtools.PARAMS['abc_params']['min_epsilon'],
-            max_nr_populations=simtools.PARAMS['abc_params']['max_populations'],
-            min_acceptance_rate=simtools.PARAMS['abc_params']['min_acceptance'])
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path())
+@click.option('-o', '--obsfile', type=click.Path())
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('--previous', type=click.Path(), required=True,
+              help='database of a reconstruction of the same observations with fewer time points')
+@click.option('--max-populations', type=int, default=None,
+              help='maximum number of generations (default: max_populations)')
+def update(paramfile, obsfile, dbfile, previous, max_populations):
+    """
+    Reconstruct again after new time points were added to the observations.
+    The priors are limited to the region around the posterior curves of the previous
+    reconstruction (see warm_start_width), stretched to the longer timeline.
+    """
+    reconstruction = Reconstruction(paramfile, obsfile, dbfile)
+    if max_populations is not None:
+        reconstruction.params['abc_params']['max_populations'] = max_populations
+    reconstruction.update(previous)
+
+
+def prior_density(rate_limits, points):
+    """
+    density of the uniform birth rate prior of a model with the given number of control points
+    """
+    low, high = sorted(rate_limits)
+    return (high - low)**-points
+
+
+def prior_widened(previous, current):
+    """
+    reason why a reconstruction with the previous abc_params can not be reweighted to
+    the current ones, or None. Reweighting can only shrink the prior, it has no particles
+    where only the current prior has mass (wider rate_limits or new resolutions).
+    """
+    previous_low, previous_high = sorted(previous['rate_limits'])
+    low, high = sorted(current['rate_limits'])
+    if low < previous_low or high > previous_high:
+        return 'The rate_limits are wider than before'
+    if current['resolution_limits'][0] < previous['resolution_limits'][0] or \
+            current['resolution_limits'][1] > previous['resolution_limits'][1]:
+        return 'The resolution_limits include resolutions that were not reconstructed'
+    return None
+
+
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path())
+@click.option('-o', '--obsfile', type=click.Path())
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('--previous', type=click.Path(), required=True,
+              help='database of a reconstruction of the same observations')
+@click.option('--previous-paramfile', type=click.Path(), required=True,
+              help='parameters of the previous reconstruction')
+@click.option('--min-ess', type=float, default=0.5,
+              help='reconstruct again if the effective sample size is below this fraction')
+def reweight(paramfile, obsfile, dbfile, previous, previous_paramfile, min_ess):
+    """
+    Reuse a reconstruction after narrowing the priors or changing the noise filters.
+    The final population is importance reweighted to the new rate_limits, and if the filters
+    changed, the stored simulations are compared to the observations again with the new
+    filters (particles no longer within epsilon are dropped).
+    Falls back to a new reconstruction if the priors are wider than before, if the distance
+    function changed (epsilon is on the scale of the old one), or if too few effective
+    particles remain.
+    """
+    Reconstruction(paramfile, obsfile, dbfile).reweight(previous, previous_paramfile, min_ess)
+
+
+def shard_evidence(abc_history, epsilon, weighted_distances):
+    """
+    estimate of the ABC evidence P(distance <= epsilon) of a single model reconstruction.
+    The first generation is sampled from the prior, so its acceptance rate estimates the
+    evidence at its epsilon. Each later step down to a smaller epsilon multiplies it by the
+    weighted fraction of the previous population that is also within the smaller epsilon.
+    This only approximates the model probabilities of a joint run of all resolutions, which
+    share one epsilon schedule; the Monte Carlo error of each shard carries over to them.
+    weighted_distances - dict caching abc_history.get_weighted_distances per generation
+    """
+    populations = abc_history.get_all_populations()
+    populations = populations[populations.t >= 0].sort_values('t')
+
+    def within(t, eps):
+        if t not in weighted_distances:
+            weighted_distances[t] = abc_history.get_weighted_distances(t)
+        df = weighted_distances[t]
+        return df['w'][df['distance'] <= eps].sum()/df['w'].sum()
+
+    first = populations.iloc[0]
+    evidence = first['particles']/first['samples']
+    last = first
+    for __, population in populations.iloc[1:].iterrows():
+        if population['epsilon'] < epsilon:
+            break
+        evidence *= within(last['t'], population['epsilon'])
+        last = population
+    return evidence*within(last['t'], epsilon)
+
+
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path())
+@click.option('-o', '--obsfile', type=click.Path())
+@click.option('-d', '--dbfile', type=click.Path())
+@click.argument('shards', nargs=-1, type=click.Path())
+def merge_shards(paramfile, obsfile, dbfile, shards):
+    """
+    Merge reconstructions of single resolutions (reconstruct --resolution) into one database.
+    Model probabilities of every generation come from the evidence of each shard at the
+    largest epsilon among them (see shard_evidence).
+    """
+    Reconstruction(paramfile, obsfile, dbfile).merge_shards(shards)
+
+
+@main.command()
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('--per-worker', is_flag=True, default=False)
+def timing(dbfile, per_worker):
+    """
+    Summarize where the time of a reconstruction went, per generation and stage.
+    Stages are nested: model includes prescreen, surrogate, spawn and parse,
+    distance includes sampling, samplings_dilutions and noise.
+    """
+    generations = {}
+    with open(dbfile + '.timing.jsonl', 'r') as in_file:
+        for line in in_file:
+            entry = json.loads(line)
+            generations.setdefault(entry['generation'], []).append(entry)
+
+    for generation, entries in sorted(generations.items()):
+        main_stages = {}
+        workers = []
+        for entry in entries:
+            if entry['worker'] == 'main':
+                main_stages = entry['stages']
+            else:
+                workers.append(entry)
+        label = 'calibration' if generation == -1 else 'generation ' + str(generation)
+        print(label + ':',
+              'sampling {:.2f} s,'.format(main_stages.get('sampling', [0, 0.0])[1]),
+              'pyabc {:.2f} s,'.format(main_stages.get('pyabc', [0, 0.0])[1]),
+              len(workers), 'workers')
+        totals = {}
+        for entry in workers:
+            for name, (calls, seconds) in entry['stages'].items():
+                counter = totals.setdefault(name, [0, 0.0])
+                counter[0] += calls
+                counter[1] += seconds
+        if 'prescreen' in totals:
+            screened = totals['prescreen'][0]
+            rejected = totals.get('prescreen_rejected', [0, 0.0])[0]
+            print('  prescreen rejected {} of {} particles ({:.1f}%)'.format(
+                rejected, screened, 100.0*rejected/max(screened, 1)))
+        if 'surrogate' in totals:
+            screened = totals['surrogate'][0]
+            skipped = totals.get('surrogate_skipped', [0, 0.0])[0]
+            audited = totals.get('surrogate_audited', [0, 0.0])[0]
+            missed = totals.get('surrogate_missed', [0, 0.0])[0]
+            print('  surrogate skipped {} of {} particles ({:.1f}%),'.format(
+                skipped, screened, 100.0*skipped/max(screened, 1)),
+                  '{} of {} audited would have been accepted'.format(missed, audited))
+        rows = [('all', totals)]
+        if per_worker:
+            rows += [(str(x['worker']), x['stages']) for x in workers]
+        for worker, stages in rows:
+            for name, (calls, seconds) in sorted(stages.items(), key=lambda x: -x[1][1]):
+                print('  {:>8} {:<20} {:>8} calls {:>10.3f} s {:>10.3f} ms/call'.format(
+                    worker, name, calls, seconds, 1e3*seconds/max(calls, 1)))
+
+
+def read_timings(filename, generation):
+    """
+    model evaluations per worker for one generation from a timing (sidecar or scratch) file
+    """
+    evaluations = {}
+    if not os.path.exists(filename):
+        return evaluations
+    with open(filename, 'r') as in_file:
+        for line in in_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be half written
+                continue
+            if entry['generation'] != generation or entry['worker'] == 'main':
+                continue
+            calls = entry['stages'].get('model', [0, 0.0])[0]
+            evaluations[entry['worker']] = evaluations.get(entry['worker'], 0) + calls
+    return evaluations
+
+
+def estimate_remaining(populations, min_epsilon, max_populations):
+    """
+    estimate the number of generations left, by extrapolating the
+    (log-linear) decrease of epsilon over the last generations
+    """
+    done = len(populations)
+    remaining = max_populations - done
+    epsilon = np.array(populations['epsilon'], dtype=float)[-3:]
+    if len(epsilon) >= 2 and np.all(epsilon > 0) and min_epsilon > 0:
+        slope = np.polyfit(np.arange(len(epsilon)), np.log(epsilon), 1)[0]
+        if slope < 0:
+            needed = int(np.ceil((np.log(min_epsilon) - np.log(epsilon[-1]))/slope))
+            remaining = min(remaining, max(needed, 0))
+    return max(remaining, 0)
+
+
+def monitor_status(abc_history, dbfile, params):
+    """
+    text describing the current state of a (running) reconstruction
+    """
+    import pandas as pd
+    lines = []
+    populations = abc_history.get_all_populations()
+    populations = populations[populations.t >= 0].sort_values('t')
+    if len(populations) == 0:
+        lines.append('No generations finished yet')
+        current = 0
+    else:
+        last = populations.iloc[-1]
+        current = int(last['t']) + 1
+        target = ''
+        if params is not None:
+            target = ' of max ' + str(params['max_populations']) + \
+                     ', min epsilon ' + str(params['min_epsilon'])
+        lines.append('Generation {} done{}'.format(int(last['t']), target))
+        lines.append('  epsilon {:.4g}  acceptance rate {:.3f} ({} of {} samples)'.format(
+            last['epsilon'], last['particles']/last['samples'],
+            int(last['particles']), int(last['samples'])))
+        probabilities = abc_history.get_model_probabilities(int(last['t']))
+        names = []
+        for m, p in probabilities['p'].items():
+            name = 'model ' + str(m)
+            if params is not None:
+                name = str(params['resolution_limits'][0] + m) + ' points'
+            names.append('{} {:.3f}'.format(name, p))
+        lines.append('  model probabilities: ' + ', '.join(names))
+
+    # throughput from the timing sidecar of the last finished generation
+    evaluations = read_timings(dbfile + '.timing.jsonl', current - 1)
+    sampling = None
+    if os.path.exists(dbfile + '.timing.jsonl'):
+        with open(dbfile + '.timing.jsonl', 'r') as in_file:
+            for line in in_file:
+                entry = json.loads(line)
+                if entry['generation'] == current - 1 and entry['worker'] == 'main':
+                    sampling = entry['stages']['sampling'][1]
+    if evaluations and sampling:
+        rates = ', '.join(['{:.2f}'.format(x/sampling) for __, x in sorted(evaluations.items())])
+        lines.append('  simulations per second per worker: ' + rates)
+
+    # generation in progress
+    running = read_timings(dbfile + '.timing.scratch', current)
+    if running:
+        lines.append('Generation {} running: {} simulations so far on {} workers'.format(
+            current, sum(running.values()), len(running)))
+
+    if params is not None and len(populations) >= 2:
+        remaining = estimate_remaining(populations, params['min_epsilon'], params['max_populations'])
+        durations = np.diff(pd.to_datetime(populations['population_end_time']).values)
+        duration = np.mean(durations[-3:]) / np.timedelta64(1, 's')
+        lines.append('ETA: {} generations, about {:.1f} minutes'.format(
+            remaining, remaining*duration/60))
+    return '\n'.join(lines)
+
+
+def follow(dbfile, params, interval, once, run_id):
+    """
+    print the status of the run run_id in dbfile every interval seconds until it is done
+    params - abc_params of the run, needed for the ETA (or None)
+    """
+    from pyabc import History
+
+    while not os.path.exists(dbfile):
+        print('Waiting for', dbfile, 'to be created')
+        time.sleep(interval)
+
+    abc_history = History('sqlite:///' + dbfile)
+    abc_history.id = run_id
+    while True:
+        print(time.strftime('[%H:%M:%S]'), monitor_status(abc_history, dbfile, params))
+        if once or abc_history.get_abc().end_time is not None:
+            break
+        time.sleep(interval)
+
+
+@main.command()
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('-p', '--paramfile', type=click.Path(), default=None,
+              help='parameter file of the run, needed for the ETA')
+@click.option('-o', '--obsfile', type=click.Path(), default=None,
+              help='observations of the run, needed with the parameter file')
+@click.option('-i', '--interval', type=float, default=30.0, help='seconds between updates')
+@click.option('--once', is_flag=True, default=False)
+@click.option('--run-id', type=int, default=1)
+def monitor(dbfile, paramfile, obsfile, interval, once, run_id):
+    """
+    Follow the progress of a running reconstruction
+    """
+    if paramfile is None:
+        follow(dbfile, None, interval, once, run_id)
+    elif obsfile is None:
+        raise click.UsageError('The parameter file needs the observations (-o) as well')
+    else:
+        Reconstruction(paramfile, obsfile, dbfile).monitor(interval, once, run_id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+"""
+Regression adjustment of accepted ABC particles (Beaumont et al. 2002).
+The birth rates of the particles are regressed on their simulated summary statistics,
+and moved along the fitted regression to where the simulations would match the observations.
+This corrects much of the error of stopping at a larger epsilon.
+"""
+
+import sys
+
+import simtools
+
+
+# ridge penalty, relative to the (standardized) summary statistics
+RIDGE_ALPHA = 1.0
+# keeps the logit transform of the birth rates finite at the prior limits
+LOGIT_MARGIN = 1e-6
+
+
+def observed_statistics(observed):
+    """
+    log counts of all observed data points, in the order of summary_statistics
+    """
+    import numpy as np
+    stats = []
+    for id_string, obs in observed.items():
+        stats.extend([np.log1p(x) for x in obs['count'] if x is not None])
+    return np.array(stats)
+
+
+def summary_statistics(params, observed, simulation):
+    """
+    log expected counts of a simulation (a flat sum stat dict from abc_model)
+    at every observed data point, i.e. the sizes before noise mapped to the observed scale
+    params, observed - as from simtools.parse_params and parse_observations
+    """
+    import numpy as np
+    import likelihood
+    stats = []
+    for id_string, obs in observed.items():
+        samplings, dilutions = simtools.get_samplings_dilutions(obs)
+        mean, __ = likelihood.observation_moments(
+            np.array(simulation[id_string + '.size'], dtype=float),
+            samplings, dilutions, params['filters'])
+        stats.extend([np.log1p(max(x, 0.0)) for x, y in zip(mean, obs['count']) if y is not None])
+    return np.array(stats)
+
+
+def logit(x, low, high):
+    import numpy as np
+    p = np.clip((x - low)/(high - low), LOGIT_MARGIN, 1.0 - LOGIT_MARGIN)
+    return np.log(p/(1.0 - p))
+
+
+def inverse_logit(y, low, high):
+    import numpy as np
+    return low + (high - low)/(1.0 + np.exp(-y))
+
+
+def adjust(params, observed, rates, stats, distances, weights, epsilon, method='linear'):
+    """
+    regression adjust the particles of one model
+    params, observed - as from simtools.parse_params and parse_observations
+    rates - birth rates (one particle per row)
+    stats - simulated summary statistics (one particle per row)
+    distances, weights - of the particles, epsilon - of the population
+    method - 'linear' (weighted least squares) or 'ridge'
+    returns adjusted rates and weights (particle weight times an epanechnikov kernel of the distance)
+    """
+    import numpy as np
+    low, high = sorted(params['abc_params']['rate_limits'])
+
+    kernel = np.maximum(1.0 - (np.asarray(distances)/epsilon)**2, 0.0)
+    weights = np.asarray(weights)*kernel
+    if np.sum(weights) <= 0.0:
+        sys.exit('No particle is within epsilon, can not adjust')
+    weights = weights/np.sum(weights)
+
+    # standardize the statistics, centered on the observation
+    x = stats - observed_statistics(observed)
+    mean = np.average(x, axis=0, weights=weights)
+    sd = np.sqrt(np.average((x - mean)**2, axis=0, weights=weights))
+    varying = sd > 0.0
+    x = (x[:, varying] - mean[varying])/sd[varying]
+    y = logit(rates, low, high)
+
+    design = np.column_stack([np.ones(len(x)), x])
+    sqrt_w = np.sqrt(weights)[:, None]
+    if method == 'linear':
+        beta = np.linalg.lstsq(design*sqrt_w, y*sqrt_w, rcond=None)[0]
+    elif method == 'ridge':
+        penalty = RIDGE_ALPHA*np.eye(design.shape[1])
+        penalty[0, 0] = 0.0  # the intercept is not penalized
+        gram = (design*weights[:, None]).T @ design
+        beta = np.linalg.solve(gram + penalty*np.sum(weights), (design*weights[:, None]).T @ y)
+    else:
+        raise ValueError('Unknown regression adjustment: ' + str(method))
+
+    # the observation is at x = -mean/sd, move every particle to it
+    x_observed = -mean[varying]/sd[varying]
+    adjusted = y - (x - x_observed) @ beta[1:]
+    return inverse_logit(adjusted, low, high), weights
@@ -0,0 +1,670 @@
+"""
+Benchmarks for the simulators, the distance and noise functions
+and complete (small) reconstructions.
+Results are stored as json so that runs on different commits can be compared.
+Also calibrates the accuracy of the simulators against their run time.
+"""
+
+import csv
+import datetime
+import importlib.util
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+import click
+
+import simtools
+
+
+CODE_DIR = path.dirname(path.abspath(__file__))
+ROOT_DIR = path.dirname(CODE_DIR)
+
+SIMULATORS = ['bernoulli', 'rar-engine']
+POPULATION_SIZES = [1e3, 1e4, 1e5, 1e6, 3e6]
+CONTROL_POINTS = [1, 3, 5, 9]
+CARRYING_CAPACITY = 3e6
+# observation grid similar to the bundled datasets
+TIMES = [float(x) for x in range(9)]
+
+# reconstruct benchmarks: dataset and overrides of its configuration
+# min_epsilon is zero so that every run goes through max_populations generations
+# one sampling worker, with several the particles (and the number of simulations)
+# depend on which worker finishes first, so the runs are not reproducible from the seed
+RECONSTRUCTIONS = {
+    'minimal': {'starting_population_size': 50, 'max_populations': 4, 'min_epsilon': 0.0,
+                'parallel_simulations': 1},
+    'demo': {'starting_population_size': 20, 'max_populations': 2, 'min_epsilon': 0.0,
+             'parallel_simulations': 1},
+}
+
+# initial sampling benchmarks: datasets and overrides of their configuration
+# many control points, where pseudo random samples cover the prior worst
+# (the bernoulli simulator keeps the runs short, the number of simulations is what is compared)
+# (one sampling worker, as for RECONSTRUCTIONS)
+INITIAL_SAMPLING = {
+    'demo': {'starting_population_size': 100, 'max_populations': 4, 'min_epsilon': 0.0,
+             'resolution_limits': [5, 9], 'simulator': 'bernoulli', 'parallel_simulations': 1},
+    'kcl22': {'starting_population_size': 100, 'max_populations': 4, 'min_epsilon': 0.0,
+              'resolution_limits': [5, 9], 'simulator': 'bernoulli', 'parallel_simulations': 1},
+}
+SAMPLINGS = ['random', 'halton']
+
+# simulator calibration: the exact stochastic simulator that the others are compared to
+REFERENCE_SIMULATOR = 'rar-engine'
+CARRYING_CAPACITIES = [1e5, 1e6, CARRYING_CAPACITY]
+# birth rate curves, as fractions of the rate limits
+# (RATE_LIMITS unless calibrating for a dataset)
+CALIBRATION_CURVES = {
+    'constant': [0.5],
+    'declining': [0.9, 0.5, 0.1],
+    'rising': [0.1, 0.5, 0.9],
+}
+RATE_LIMITS = [0.4, 1.2]
+# at most this many starting populations of a dataset are calibrated
+CALIBRATION_SIZES = 5
+
+
+@click.group()
+def main():
+    """
+    performance benchmarks
+    """
+    pass
+
+
+def import_abc():
+    """
+    abc.py can not be imported as 'abc' since that collides with the standard library
+    """
+    spec = importlib.util.spec_from_file_location('ratrack_abc', path.join(CODE_DIR, 'abc.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    return result.stdout.strip()
+
+
+def timed(function, repeats):
+    """
+    wall time in seconds of repeated calls to function
+    """
+    times = []
+    for __ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def record(results, name, params, times):
+    """
+    add a benchmark result and print a summary line
+    """
+    import numpy as np
+    result = {
+        'name': name,
+        'params': params,
+        'times': times,
+        'min': float(np.min(times)),
+        'median': float(np.median(times)),
+    }
+    results.append(result)
+    print(name, ' '.join([k + '=' + str(v) for k, v in params.items()]),
+          'min {:.6f} s median {:.6f} s'.format(result['min'], result['median']))
+
+
+def write_results(results, jsonfile):
+    if jsonfile is None:
+        return
+    out = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    with open(jsonfile, 'w') as out_json:
+        json.dump(out, out_json, indent=1)
+    print('Results saved in', jsonfile)
+
+
+def linear_birthrates(control_points):
+    """
+    a declining growth rate curve with the given number of control points
+    """
+    import numpy as np
+    return list(np.linspace(1.2, 0.4, control_points))
+
+
+def bench_simulators(results, simulators, sizes, control_points, repeats):
+    for simulator in simulators:
+        for size in sizes:
+            for points in control_points:
+                birthrates = linear_birthrates(points)
+                times = timed(lambda: simtools.simulate_timeline(
+                    int(size), TIMES, birthrates, 1.0/CARRYING_CAPACITY, simulator,
+                    verbosity=0), repeats)
+                record(results, 'simulate_timeline',
+                       {'simulator': simulator, 'size': int(size), 'control_points': points},
+                       times)
+
+
+def bench_distance(results, repeats):
+    """
+    abc.distance against the bundled demo dataset
+    """
+    import numpy as np
+    abc = import_abc()
+    observed = simtools.parse_observations(path.join(ROOT_DIR, 'data', 'demo.csv'))
+    state = abc.ReconstructionState(
+        simtools.parse_params(path.join(ROOT_DIR, 'data', 'demo.toml'), observed), observed)
+    simulation = {}
+    for id_string, obs in observed.items():
+        simulation[id_string] = {
+            'time': np.array(obs['time']),
+            'size': np.array(obs['count'], dtype=float)*1.1,
+            'rate': np.ones(len(obs['time'])),
+        }
+    simulation = abc.flatten_observed(simulation)
+    observation = abc.flatten_observed(observed)
+    for distance_function in ['linear', 'rmsd']:
+        state.params['abc_params']['distance_function'] = distance_function
+        times = timed(lambda: abc.distance(state, simulation, observation), repeats)
+        record(results, 'distance',
+               {'distance_function': distance_function, 'observations': len(observed)},
+               times)
+
+
+def bench_noise(results, repeats):
+    """
+    apply_sampling and apply_noise on series of different lengths
+    """
+    import numpy as np
+    filters = {
+        'copy': [{'name': 'copy'}],
+        'poisson': [{'name': 'poisson', 'sample': 0.01}],
+        'gauss-multiplicative': [{'name': 'gauss-multiplicative', 'mean': 1.0, 'sigma': 0.05}],
+    }
+    for length in [10, 100, 1000]:
+        size = np.linspace(1e3, 1e6, length)
+        samplings = np.full((length, 2), 0.01)
+        dilutions = np.full((length, 1), 0.5)
+        times = timed(lambda: simtools.apply_sampling(size, samplings, dilutions), repeats)
+        record(results, 'apply_sampling', {'length': length}, times)
+        for name, filt in filters.items():
+            times = timed(lambda: simtools.apply_noise(size.copy(), filt), repeats)
+            record(results, 'apply_noise', {'length': length, 'filter': name}, times)
+
+
+def prepare_group(dataset, overrides, workdir, seed):
+    """
+    preprocess a bundled dataset the same way as the snakemake pipeline
+    and return observation and parameter files for its first group
+    """
+    import csv
+    import toml
+    csvtools = importlib.import_module('csvtools')
+    obsfile = path.join(ROOT_DIR, 'data', dataset + '.csv')
+    paramfile = path.join(ROOT_DIR, 'data', dataset + '.toml')
+    groups = path.join(workdir, dataset + '.groups.csv')
+    zero = path.join(workdir, dataset + '.zero.csv')
+    deathless = path.join(workdir, dataset + '.deathless.csv')
+    csvtools.define_groups.callback(obsfile, paramfile, groups)
+    csvtools.zero_time_longform.callback(groups, zero)
+    csvtools.delete_column.callback(zero, deathless, 'dead')
+
+    group_obsfile = path.join(workdir, dataset + '.g0.data.csv')
+    with open(deathless, 'r') as in_csv, open(group_obsfile, 'w') as out_csv:
+        rdr = csv.DictReader(in_csv)
+        wtr = csv.DictWriter(out_csv, fieldnames=rdr.fieldnames)
+        wtr.writeheader()
+        for row in rdr:
+            if row['birthrate_group'] == '0':
+                wtr.writerow(row)
+
+    params = toml.load(paramfile)
+    params['abc_params'].update(overrides)
+    params['abc_params']['birthrate_coupling_sets'] = []
+    params['abc_params']['seed'] = seed
+    params.setdefault('plot_params', {})['coupling_names'] = dataset
+    group_paramfile = path.join(workdir, dataset + '.g0.toml')
+    with open(group_paramfile, 'w') as out_toml:
+        toml.dump(params, out_toml)
+    return group_obsfile, group_paramfile
+
+
+def bench_reconstruct(results, datasets, repeats, seed):
+    """
+    complete reconstructions with a small population and fixed number of generations
+    """
+    from pyabc import History
+    for dataset in datasets:
+        with tempfile.TemporaryDirectory() as workdir:
+            obsfile, paramfile = prepare_group(dataset, RECONSTRUCTIONS[dataset], workdir, seed)
+            times = []
+            simulations = []
+            for i in range(repeats):
+                dbfile = path.join(workdir, dataset + '.' + str(i) + '.db')
+                start = time.perf_counter()
+                subprocess.run([sys.executable, path.join(CODE_DIR, 'abc.py'), 'reconstruct',
+                                '-p', paramfile, '-o', obsfile, '-d', dbfile],
+                               cwd=ROOT_DIR, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+                simulations.append(int(History('sqlite:///' + dbfile).total_nr_simulations))
+            record(results, 'reconstruct',
+                   dict(dataset=dataset, seed=seed, simulations=simulations,
+                        **RECONSTRUCTIONS[dataset]),
+                   times)
+
+
+def simulations_to_epsilon(populations, epsilon):
+    """
+    simulations (including the calibration sample) until a population reached epsilon
+    None if no population did
+    """
+    simulations = 0
+    for __, population in populations.sort_values('t').iterrows():
+        simulations += int(population['samples'])
+        if population['t'] >= 0 and population['epsilon'] <= epsilon:
+            return simulations
+    return None
+
+
+def bench_initial_sampling(results, datasets, repeats, seed):
+    """
+    simulations needed to reach a common epsilon with pseudo random and halton initial samples
+    the common epsilon is the largest final epsilon of all runs on a dataset
+    """
+    from pyabc import History
+    for dataset in datasets:
+        with tempfile.TemporaryDirectory() as workdir:
+            runs = {}
+            for sampling in SAMPLINGS:
+                overrides = dict(INITIAL_SAMPLING[dataset], initial_sampling=sampling)
+                runs[sampling] = []
+                for i in range(repeats):
+                    obsfile, paramfile = prepare_group(dataset, overrides, workdir, seed + i)
+                    dbfile = path.join(workdir, dataset + '.' + sampling + str(i) + '.db')
+                    start = time.perf_counter()
+                    subprocess.run([sys.executable, path.join(CODE_DIR, 'abc.py'), 'reconstruct',
+                                    '-p', paramfile, '-o', obsfile, '-d', dbfile],
+                                   cwd=ROOT_DIR, check=True,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    elapsed = time.perf_counter() - start
+                    runs[sampling].append(
+                        (elapsed, History('sqlite:///' + dbfile).get_all_populations()))
+            epsilon = max(x['epsilon'].min() for y in runs.values() for __, x in y)
+            for sampling in SAMPLINGS:
+                simulations = [simulations_to_epsilon(x, epsilon) for __, x in runs[sampling]]
+                record(results, 'initial_sampling',
+                       dict(dataset=dataset, sampling=sampling, seed=seed, epsilon=float(epsilon),
+                            simulations=simulations, **INITIAL_SAMPLING[dataset]),
+                       [x for x, __ in runs[sampling]])
+                print('  simulations to epsilon {:.4g}: mean {:.1f}'.format(
+                    epsilon, sum(simulations)/len(simulations)))
+
+
+def dataset_grid(paramfile, obsfile):
+    """
+    calibration grid of a dataset: its expected starting populations (at most CALIBRATION_SIZES),
+    carrying capacity, rate limits and the observation times of its longest series
+    """
+    import numpy as np
+    import likelihood
+    precheck = importlib.import_module('precheck')
+    sizes = []
+    times = []
+    with tempfile.TemporaryDirectory() as workdir:
+        groups = precheck.read_groups(paramfile, obsfile, workdir)
+    for group, observed in sorted(groups.items()):
+        params = simtools.parse_params(paramfile, observed)
+        for obs in observed.values():
+            sizes.append(likelihood.expected_starting_population(params, obs))
+            if len(obs['time']) > len(times):
+                times = list(obs['time'])
+    sizes = np.unique(np.round(sizes))
+    if len(sizes) > CALIBRATION_SIZES:
+        sizes = np.quantile(sizes, np.linspace(0, 1, CALIBRATION_SIZES)).round()
+    deathrate_interaction = params['simulation_params']['deathrate_interaction']
+    capacities = [1.0/deathrate_interaction if deathrate_interaction > 0 else 0.0]
+    return list(sizes), capacities, sorted(params['abc_params']['rate_limits']), times
+
+
+def calibrate_cell(size, capacity, birthrates, times, simulators, repeats, seed):
+    """
+    simulate one grid cell with the reference and every simulator
+    returns per simulator the run times and relative discrepancies
+    (of every simulation and observation time, against the mean of the reference simulations)
+    the simulations compared use other seeds than the reference, so the discrepancy of
+    the reference simulator itself is the noise floor of a single stochastic simulation
+    """
+    import numpy as np
+    deathrate_interaction = 1.0/capacity if capacity > 0 else 0.0
+
+    def simulate(simulator, i):
+        start = time.perf_counter()
+        __, sim_size, __ = simtools.simulate_timeline(
+            int(size), times, birthrates, deathrate_interaction, simulator,
+            verbosity=0, seed=i)
+        return time.perf_counter() - start, sim_size
+
+    reference = np.array([simulate(REFERENCE_SIMULATOR, seed + i)[1] for i in range(repeats)],
+                         dtype=float)
+    mean = np.maximum(np.mean(reference, axis=0), 1.0)
+
+    result = {}
+    for simulator in [REFERENCE_SIMULATOR] + [x for x in simulators if x != REFERENCE_SIMULATOR]:
+        runs = [simulate(simulator, seed + repeats + i) for i in range(repeats)]
+        result[simulator] = (
+            [x for x, __ in runs],
+            np.concatenate([np.abs(np.array(y, dtype=float) - mean)/mean for __, y in runs]),
+        )
+    return result
+
+
+def within_target(row, target_error):
+    """
+    a simulator is accurate enough if it is within the target error,
+    or no worse than the noise of the reference simulator itself
+    """
+    return row['discrepancy_p95'] <= max(target_error, row['noise_p95'])
+
+
+def recommend(rows, target_error):
+    """
+    cheapest simulator (total median time) that is within the target error
+    in every row it was calibrated in, None if no simulator is
+    """
+    simulators = sorted(set(x['simulator'] for x in rows))
+    within = [x for x in simulators
+              if all(within_target(y, target_error) for y in rows if y['simulator'] == x)]
+    if not within:
+        return None
+    return min(within, key=lambda x: sum(y['time_median'] for y in rows if y['simulator'] == x))
+
+
+def plot_calibration(rows, target_error, save):
+    """
+    discrepancy and run time against starting population (one line per simulator and capacity)
+    with the target error (dashed) and the noise floor of the reference (light grey)
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    fig, axs = plt.subplots(nrows=2, sharex=True)
+    fig.set_size_inches(6, 6)
+    capacities = sorted(set(x['capacity'] for x in rows))
+    linestyles = ['-', '--', ':', '-.']
+    for i, simulator in enumerate(sorted(set(x['simulator'] for x in rows))):
+        for j, capacity in enumerate(capacities):
+            cell = [x for x in rows if x['simulator'] == simulator and x['capacity'] == capacity]
+            sizes = sorted(set(x['size'] for x in cell))
+            # the worst curve at each size
+            discrepancy = [max(x['discrepancy_p95'] for x in cell if x['size'] == y) for y in sizes]
+            runtime = [max(x['time_median'] for x in cell if x['size'] == y) for y in sizes]
+            label = '{} (capacity {:.3g})'.format(simulator, capacity)
+            linestyle = linestyles[j % len(linestyles)]
+            axs[0].plot(sizes, discrepancy, color='C' + str(i), linestyle=linestyle, marker='.',
+                        label=label)
+            axs[1].plot(sizes, runtime, color='C' + str(i), linestyle=linestyle, marker='.')
+    for j, capacity in enumerate(capacities):
+        cell = [x for x in rows if x['capacity'] == capacity]
+        sizes = sorted(set(x['size'] for x in cell))
+        axs[0].plot(sizes, [max(x['noise_p95'] for x in cell if x['size'] == y) for y in sizes],
+                    color='lightgrey', linestyle=linestyles[j % len(linestyles)], zorder=-1)
+    axs[0].axhline(target_error, color='grey', linestyle='--', linewidth=1.0)
+    axs[0].set_ylabel('Discrepancy (95th percentile)')
+    axs[1].set_ylabel('Time per simulation [s]')
+    axs[1].set_xlabel('Starting population')
+    for ax in axs:
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+    axs[0].legend(fontsize='small')
+    plt.tight_layout()
+    fig.savefig(save)
+    plt.close(fig)
+
+
+def bench_calibrate(results, simulators, sizes, capacities, rate_limits, times,
+                    repeats, seed, target_error):
+    """
+    discrepancy and run time of the simulators over a grid of starting populations,
+    carrying capacities and birth rate curves
+    returns the rows of the calibration table
+    """
+    import numpy as np
+    rows = []
+    for size in sizes:
+        for capacity in capacities:
+            for curve, fractions in CALIBRATION_CURVES.items():
+                birthrates = [rate_limits[0] + x*(rate_limits[1] - rate_limits[0])
+                              for x in fractions]
+                cell = calibrate_cell(size, capacity, birthrates, times, simulators,
+                                      repeats, seed)
+                noise = float(np.quantile(cell[REFERENCE_SIMULATOR][1], 0.95))
+                cell_rows = []
+                for simulator in simulators:
+                    run_times, discrepancy = cell[simulator]
+                    row = {
+                        'size': int(size),
+                        'capacity': float(capacity),
+                        'curve': curve,
+                        'simulator': simulator,
+                        'time_median': float(np.median(run_times)),
+                        'discrepancy_median': float(np.median(discrepancy)),
+                        'discrepancy_p95': float(np.quantile(discrepancy, 0.95)),
+                        'discrepancy_max': float(np.max(discrepancy)),
+                        'noise_p95': noise,
+                    }
+                    record(results, 'calibrate',
+                           {k: v for k, v in row.items() if k != 'time_median'}, run_times)
+                    cell_rows.append(row)
+                best = recommend(cell_rows, target_error)
+                for row in cell_rows:
+                    row['recommended'] = row['simulator'] == best
+                rows += cell_rows
+    return rows
+
+
+@main.command()
+@click.option('-s', '--simulator', 'simulators', type=click.Choice(SIMULATORS),
+              multiple=True, default=SIMULATORS)
+@click.option('-n', '--size', 'sizes', type=float, multiple=True, default=POPULATION_SIZES)
+@click.option('-c', '--control-points', type=int, multiple=True, default=CONTROL_POINTS)
+@click.option('-r', '--repeats', type=int, default=5)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def simulators(simulators, sizes, control_points, repeats, jsonfile):
+    """
+    simulator runtime over population sizes and number of control points
+    """
+    results = []
+    bench_simulators(results, simulators, sizes, control_points, repeats)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.option('-r', '--repeats', type=int, default=1000)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def distance(repeats, jsonfile):
+    """
+    distance function runtime
+    """
+    results = []
+    bench_distance(results, repeats)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.option('-r', '--repeats', type=int, default=1000)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def noise(repeats, jsonfile):
+    """
+    sampling and noise filter runtime
+    """
+    results = []
+    bench_noise(results, repeats)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.option('-d', '--dataset', 'datasets', type=click.Choice(list(RECONSTRUCTIONS)),
+              multiple=True, default=list(RECONSTRUCTIONS))
+@click.option('-r', '--repeats', type=int, default=1)
+@click.option('--seed', type=int, default=1)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def reconstruct(datasets, repeats, seed, jsonfile):
+    """
+    end to end reconstruction runtime
+    """
+    results = []
+    bench_reconstruct(results, datasets, repeats, seed)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.option('-d', '--dataset', 'datasets', type=click.Choice(list(INITIAL_SAMPLING)),
+              multiple=True, default=list(INITIAL_SAMPLING))
+@click.option('-r', '--repeats', type=int, default=5)
+@click.option('--seed', type=int, default=1)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def initial_sampling(datasets, repeats, seed, jsonfile):
+    """
+    simulations to a common epsilon with pseudo random and halton initial populations
+    """
+    results = []
+    bench_initial_sampling(results, datasets, repeats, seed)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path(), default=None,
+              help='calibrate for a dataset (with -o): its starting populations, '
+                   'carrying capacity, rate limits and observation times')
+@click.option('-o', '--obsfile', type=click.Path(), default=None)
+@click.option('-s', '--simulator', 'simulators', type=click.Choice(SIMULATORS),
+              multiple=True, default=SIMULATORS)
+@click.option('-n', '--size', 'sizes', type=float, multiple=True,
+              help='starting populations (default: POPULATION_SIZES or from the dataset)')
+@click.option('-k', '--capacity', 'capacities', type=float, multiple=True,
+              help='carrying capacities, 0 for none (default: CARRYING_CAPACITIES or from the dataset)')
+@click.option('-e', '--target-error', type=float, default=0.05,
+              help='largest acceptable relative discrepancy (95th percentile)')
+@click.option('-r', '--repeats', type=int, default=5)
+@click.option('--seed', type=int, default=1)
+@click.option('-c', '--csvfile', type=click.Path(), default=None)
+@click.option('--save', type=click.Path(), default=None, help='plot of the calibration')
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def calibrate(paramfile, obsfile, simulators, sizes, capacities, target_error,
+              repeats, seed, csvfile, save, jsonfile):
+    """
+    simulator accuracy against run time
+    every simulator is compared with the mean of repeated reference (rar-engine) simulations
+    at the observation times, and the cheapest simulator within the target error
+    (or within the noise of the reference) is recommended
+    """
+    if paramfile is not None:
+        dataset_sizes, dataset_capacities, rate_limits, times = dataset_grid(paramfile, obsfile)
+    else:
+        dataset_sizes, dataset_capacities, rate_limits, times = \
+            POPULATION_SIZES, CARRYING_CAPACITIES, RATE_LIMITS, TIMES
+    sizes = list(sizes) or dataset_sizes
+    capacities = list(capacities) or dataset_capacities
+
+    results = []
+    rows = bench_calibrate(results, simulators, sizes, capacities, rate_limits, times,
+                           repeats, seed, target_error)
+    write_results(results, jsonfile)
+
+    if csvfile is not None:
+        with open(csvfile, 'w') as out_csv:
+            wtr = csv.DictWriter(out_csv, fieldnames=list(rows[0]))
+            wtr.writeheader()
+            for row in rows:
+                wtr.writerow(row)
+    if save is not None:
+        plot_calibration(rows, target_error, save)
+
+    best = recommend(rows, target_error)
+    if best is not None:
+        print('Recommended simulator:', best)
+        return
+    print('No simulator is within a discrepancy of', target_error, 'everywhere')
+    print('(the noise floor of a single reference simulation is up to {:.3g})'.format(
+        max(x['noise_p95'] for x in rows)))
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault((row['size'], row['capacity'], row['curve']), 'none')
+        if row['recommended']:
+            cells[(row['size'], row['capacity'], row['curve'])] = row['simulator']
+    for (size, capacity, curve), simulator in cells.items():
+        print('  size {} capacity {:.3g} curve {}: {}'.format(size, capacity, curve, simulator))
+
+
+@main.command('all')
+@click.option('-r', '--repeats', type=int, default=5)
+@click.option('--seed', type=int, default=1)
+@click.option('-j', '--jsonfile', type=click.Path(), default=None)
+def run_all(repeats, seed, jsonfile):
+    """
+    run every benchmark
+    """
+    results = []
+    bench_simulators(results, SIMULATORS, POPULATION_SIZES, CONTROL_POINTS, repeats)
+    bench_distance(results, repeats*200)
+    bench_noise(results, repeats*200)
+    bench_reconstruct(results, list(RECONSTRUCTIONS), 1, seed)
+    write_results(results, jsonfile)
+
+
+@main.command()
+@click.argument('baseline', type=click.Path())
+@click.argument('candidate', type=click.Path())
+@click.option('-t', '--threshold', type=float, default=1.1,
+              help='slowdown ratio (of the minimum time) that counts as a regression')
+def compare(baseline, candidate, threshold):
+    """
+    compare two benchmark json files
+    """
+    with open(baseline) as in_json:
+        base = json.load(in_json)
+    with open(candidate) as in_json:
+        cand = json.load(in_json)
+    print('baseline ', base['commit'], base['date'])
+    print('candidate', cand['commit'], cand['date'])
+
+    def key(result):
+        params = {k: v for k, v in result['params'].items()
+                  if k not in ['simulations', 'epsilon', 'noise_p95']
+                  and not k.startswith('discrepancy')}
+        return result['name'] + ' ' + json.dumps(params, sort_keys=True)
+
+    base_results = {key(x): x for x in base['results']}
+    regressions = 0
+    for result in cand['results']:
+        k = key(result)
+        if k not in base_results:
+            continue
+        ratio = result['min'] / base_results[k]['min']
+        flag = ''
+        if ratio > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('{:.3f}x {}{}'.format(ratio, k, flag))
+    if regressions:
+        print(regressions, 'regressions found')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
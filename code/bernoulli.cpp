@@ -21,10 +21,13 @@ struct Arguments {
   vector<double> birth_rate;
   double interaction_death_rate;
   vector<double> times;
+  string method;
 };
 
 
 static vector<double> birth_rate;
+// integral of the birth rate from 0 to the start of each segment
+static vector<double> cumulative_birth_rate;
 static double t_end;
 static double interaction;
 
@@ -35,60 +38,46 @@ double interpolate(double a, double b, double x) {
 }
 
 
-double birth_rate_function(double t) {
-  double dt = t_end / (birth_rate.size() - 1);
-  size_t i = t / dt;
-  return interpolate(birth_rate[i], birth_rate[i+1], (t - i*dt)/dt);
+double segment_length() {
+  return t_end / (birth_rate.size() - 1);
 }
 
 
-double birth_rate_integral(double a, double b) {
+// index of the segment containing t
+// (t_end belongs to the final segment)
+size_t segment(double t) {
+  size_t i = t / segment_length();
+  return min(i, birth_rate.size() - 2);
+}
 
-  bool negate = false;
-  if (a > b) {
-    negate = true;
-    swap(a, b);
-  }
 
-  double integral = 0.0;
-  double dt = t_end / (birth_rate.size() - 1);
-  size_t start_segment = a / dt;
-  size_t end_segment = b / dt;
-
-  // If b is equal to end_time, it is still in the final segment
-  if (end_segment == birth_rate.size() - 1)
-    --end_segment;
-
-  double low_birthrate = interpolate(birth_rate[start_segment], birth_rate[start_segment + 1], (a - dt*start_segment)/dt);
-  double high_birthrate = interpolate(birth_rate[end_segment], birth_rate[end_segment + 1], (b - dt*end_segment)/dt);
-
-  if (start_segment == end_segment) {
-    integral += low_birthrate * (b - a);
-    integral += (high_birthrate - low_birthrate) * (b - a) / 2.0;
-  } else {
-    // first and final segment
-    integral += low_birthrate * (dt*(start_segment + 1) - a);
-    integral += (birth_rate[start_segment + 1] - low_birthrate) * (dt*(start_segment + 1) - a) / 2.0;
-    integral += birth_rate[end_segment] * (b - dt*end_segment);
-    integral += (high_birthrate - birth_rate[end_segment]) * (b - dt*end_segment) / 2.0;
-
-    // intervening segments
-    for (size_t i = start_segment + 1; i < end_segment; ++i) {
-      integral += birth_rate[i] * dt;
-      integral += (birth_rate[i+1] - birth_rate[i]) * dt / 2.0;
-    }
-  }
+double birth_rate_function(double t) {
+  double dt = segment_length();
+  size_t i = segment(t);
+  return interpolate(birth_rate[i], birth_rate[i+1], (t - i*dt)/dt);
+}
 
-  if (negate)
-    return -integral;
 
-  return integral;
+void setup_cumulative_birth_rate() {
+  double dt = segment_length();
+  cumulative_birth_rate.assign(birth_rate.size(), 0.0);
+  for (size_t i = 1; i < birth_rate.size(); ++i) {
+    cumulative_birth_rate[i] = cumulative_birth_rate[i-1] + (birth_rate[i-1] + birth_rate[i]) * dt / 2.0;
+  }
 }
 
 
+// integral_0^t a(ξ) dξ in constant time using the precomputed segment integrals
+double birth_rate_integral(double t) {
+  double dt = segment_length();
+  size_t i = segment(t);
+  double u = t - dt*i;
+  return cumulative_birth_rate[i] + (birth_rate[i] + birth_rate_function(t)) * u / 2.0;
+}
+
 
 double denominator_function(double t, [[maybe_unused]] void *params) {
-  return -interaction * birth_rate_function(t) * exp(birth_rate_integral(0.0, t));
+  return -interaction * birth_rate_function(t) * exp(birth_rate_integral(t));
 }
 
 
@@ -104,6 +93,7 @@ int main(int argc, char **argv) {
     TCLAP::ValueArg<string> a_birth_rate("b", "birth-rate", "Birth rate", true, "", "[0, 1, 2, ...]", cmd);
     TCLAP::ValueArg<double> a_interaction_death_rate("q", "interaction-death_rate", "Interaction Death rate", true, 100, "double", cmd);
     TCLAP::ValueArg<string> a_times("t", "measure-times", "Times to measure population size", true, "", "[0, 1, 2, ...]", cmd);
+    TCLAP::ValueArg<string> a_method("m", "method", "Solution method, analytic or quadrature", false, "analytic", "string", cmd);
 
     cmd.parse(argc, argv);
 
@@ -140,6 +130,8 @@ int main(int argc, char **argv) {
       assert(a.times[i-1] <= a.times[i]);
     }
     assert(a.interaction_death_rate >= 0);
+    a.method = a_method.getValue();
+    assert(a.method == "analytic" || a.method == "quadrature");
 
   } catch (TCLAP::ArgException &e) {
     cerr << "TCLAP Error: " << e.error() << endl << "\targ: " << e.argId() << endl;
@@ -152,10 +144,27 @@ int main(int argc, char **argv) {
   t_end = a.times.back();
   interaction = a.interaction_death_rate;
   birth_rate = a.birth_rate;
+  setup_cumulative_birth_rate();
 
   // Logistic growth with a variable birthrate is a bernoulli differential equation with the following solution
-  // f(t) = e^( integral_0^t a(ξ) dξ)/(c_1 - integral_0^t-b e^( integral_0^ζ a(ξ) dξ) dζ)
+  // f(t) = e^( integral_0^t a(ξ) dξ)/(c_1 - integral_0^t-b a(ζ) e^( integral_0^ζ a(ξ) dξ) dζ)
   // where a is the birthrate and b is the interaction factor
+  // (the interaction death rate is proportional to the birth rate, see nrm.cpp)
+  // The integrand in the denominator is the derivative of -b e^( integral_0^ζ a(ξ) dξ)
+  // so with A(t) = integral_0^t a(ξ) dξ the solution is exactly
+  // f(t) = 1/(e^-A(t)/n0 + b(1 - e^-A(t)))
+  // The quadrature is kept as a check of the analytic solution
+
+  if (a.method == "analytic") {
+    std::cout << "time\tsize\trate\n";
+    cout.precision(numeric_limits<double>::max_digits10);
+    for (auto t: a.times) {
+      double A = birth_rate_integral(t);
+      double N = 1.0 / (exp(-A)/a.n0 - interaction*expm1(-A));
+      cout << t << '\t' << N << '\t' << birth_rate_function(t) << endl;
+    }
+    return 0;
+  }
 
   gsl_integration_workspace *workspace;
 
@@ -172,23 +181,31 @@ int main(int argc, char **argv) {
   // in that case, we want the program to keep running while raising the error limits
   gsl_set_error_handler_off();
 
+  // the denominator integral is accumulated over the intervals between consecutive times
+  double d_int = 0.0;
+  double t_prev = 0.0;
+
   for (auto time: a.times) {
     double t = time;
     // First, find the numerator integral_0^t a(ξ) dξ
-    double numerator = birth_rate_integral(0.0, t);
+    double numerator = birth_rate_integral(t);
 
     // calculate integral in denominator with gsl
-    double d_int;
+    double d_int_step = 0.0;
     double d_int_err;
 
-    int status;
-    double tolerance = 1e-7;
-    do {
-      status = gsl_integration_qag(&denominator_integral, 0.0, t, 0, tolerance, 1000, 6, workspace, &d_int, &d_int_err);
-      if (status) {
-        tolerance *= 10.0;
-      }
-    } while (status != 0);
+    if (t > t_prev) {
+      int status;
+      double tolerance = 1e-7;
+      do {
+        status = gsl_integration_qag(&denominator_integral, t_prev, t, 0, tolerance, 1000, 6, workspace, &d_int_step, &d_int_err);
+        if (status) {
+          tolerance *= 10.0;
+        }
+      } while (status != 0);
+    }
+    d_int += d_int_step;
+    t_prev = t;
 
     // Finally, find population size at time t
     double N = exp(numerator) / (1.0/a.n0 - d_int);
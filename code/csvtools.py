@@ -295,5 +295,100 @@ def merge(infiles, outfile):
                     wtr.writerow(row)
 
 
+
+@main.command()
+@click.option('-o', 'outfile', type=click.Path(), help='observations (like data/<name>.csv)')
+@click.option('-p', 'paramfile', type=click.Path(), help='matching parameter file')
+@click.option('-t', 'truthfile', type=click.Path(), default=None,
+              help='true birth rate control points of every group (default: <outfile>.truth.csv)')
+@click.option('--prefix', type=str, default='syn', help='names are <prefix><group>.<replicate>')
+@click.option('-g', '--groups', type=int, default=3, help='number of coupling sets')
+@click.option('-n', '--names', type=int, default=2, help='names (replicates) per coupling set')
+@click.option('--times', type=int, default=5, help='number of time points')
+@click.option('--interval', type=float, default=2.0, help='days between time points')
+@click.option('--samplings', type=int, default=2, help='number of sampling columns')
+@click.option('--dilutions', type=int, default=0, help='number of dilution columns')
+@click.option('-k', '--capacity', type=float, default=3e6, help='carrying capacity')
+@click.option('--start', type=float, default=1e5, help='starting population')
+@click.option('--control-points', type=int, default=3,
+              help='control points of the true birth rate curves')
+@click.option('--rates', type=(float, float), default=(0.3, 1.5),
+              help='range of the true birth rates')
+@click.option('--noise', type=float, default=0.05,
+              help='sigma of gauss-multiplicative measurement noise (0 for none)')
+@click.option('-s', '--simulator', type=click.Choice(['rar-engine', 'bernoulli']),
+              default='bernoulli')
+@click.option('--seed', type=int, default=1)
+def synthesize(outfile, paramfile, truthfile, prefix, groups, names, times, interval,
+               samplings, dilutions, capacity, start, control_points, rates, noise,
+               simulator, seed):
+    """
+    generate a dataset with known birth rate curves
+    every coupling set shares a random piecewise linear birth rate curve, and every name in it
+    is simulated separately, then sampled, diluted and measured like the real observations
+    """
+    # simtools (and numpy) are only needed here
+    import simtools
+
+    if truthfile is None:
+        truthfile = path.splitext(outfile)[0] + '.truth.csv'
+    time_axis = [i*interval for i in range(times)]
+    filters = [{'name': 'gauss-multiplicative', 'mean': 1.0, 'sigma': noise}] if noise > 0 \
+        else [{'name': 'copy'}]
+    rng = simtools.random_state(seed, 'synthesize')
+
+    fieldnames = ['name', 'time', 'count'] + \
+        ['sample' + str(i + 1) for i in range(samplings)] + \
+        ['dilute' + str(i + 1) for i in range(dilutions)]
+    coupling_sets = []
+    with open(outfile, 'w') as out_csv, open(truthfile, 'w') as truth_csv:
+        wtr = csv.DictWriter(out_csv, fieldnames=fieldnames)
+        wtr.writeheader()
+        truth_wtr = csv.DictWriter(truth_csv, fieldnames=['name', 'rate_position', 'rate'])
+        truth_wtr.writeheader()
+        for group in range(groups):
+            birthrates = list(rng.uniform(rates[0], rates[1], control_points))
+            for i, rate in enumerate(birthrates):
+                truth_wtr.writerow({'name': prefix + str(group), 'rate_position': i, 'rate': rate})
+            coupling_sets.append([])
+            for replicate in range(names):
+                name = prefix + str(group) + '.' + str(replicate)
+                coupling_sets[-1].append(name)
+                __, size, __ = simtools.simulate_timeline(
+                    int(start), time_axis, birthrates, 1.0/capacity, simulator, verbosity=0,
+                    seed=simtools.derive_seed(seed, name))
+                # fractions counted, and fractions of the culture kept at passaging
+                sampling = rng.uniform(0.005, 0.05, (times, samplings))
+                dilution = rng.uniform(0.1, 1.0, (times, dilutions))
+                count = simtools.apply_noise(
+                    simtools.apply_sampling(size.astype(float), sampling, dilution, rng),
+                    filters, rng)
+                for j, t in enumerate(time_axis):
+                    row = {'name': name, 'time': t, 'count': int(max(count[j], 0))}
+                    for k in range(samplings):
+                        row['sample' + str(k + 1)] = sampling[j, k]
+                    for k in range(dilutions):
+                        row['dilute' + str(k + 1)] = dilution[j, k]
+                    wtr.writerow(row)
+
+    params = {
+        'simulation_params': {'carrying_capacity': capacity},
+        'abc_params': {
+            'rate_limits': [0.01, 3.0],
+            'resolution_limits': [1, control_points + 1],
+            'parallel_simulations': 4,
+            'simulator': simulator,
+            'birthrate_coupling_sets': coupling_sets,
+        },
+        'plot_params': {
+            'population_measure': 'Cells',
+            'coupling_names': [prefix + str(x) for x in range(groups)],
+        },
+        'filters': filters,
+    }
+    with open(paramfile, 'w') as out_toml:
+        toml.dump(params, out_toml)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,96 @@
+"""
+Tools for writing pyabc History databases outside of an ABCSMC run,
+so that results of other inference methods can be read by the plotting and table tools,
+and for ratrack specific tables stored alongside the pyabc tables.
+"""
+
+import inspect
+import sqlite3
+from contextlib import closing
+
+
+def new_history(dbfile, observed, model_names, options):
+    """
+    create a new run in a (new or existing) database
+    observed - flat observation dict, stored as the observed summary statistics
+    options - dict of run metadata
+    """
+    from pyabc import History
+    history = History('sqlite:///' + dbfile)
+    history.store_initial_data(None, options, observed, {}, model_names, '', '', '')
+    return history
+
+
+def new_particle(m, parameter, weight, distance, sum_stat=None):
+    """
+    pyabc Particle with one accepted sample. pyabc 0.9 keeps lists of the accepted
+    summary statistics and distances of a particle, later versions only one of each.
+    """
+    from pyabc import Parameter, Particle
+    if sum_stat is None:
+        sum_stat = {}
+    if 'sum_stat' in inspect.signature(Particle).parameters:
+        return Particle(m=m, parameter=Parameter(parameter), weight=weight,
+                        sum_stat=sum_stat, distance=distance)
+    return Particle(m=m, parameter=Parameter(parameter), weight=weight,
+                    accepted_sum_stats=[sum_stat], accepted_distances=[distance])
+
+
+def append_population(history, t, epsilon, particles, nr_simulations, model_names):
+    """
+    store a generation of particles
+    particles - list of (model index, parameter dict, weight, distance)
+    the weights are normalized to sum to one, the sum of the weights
+    of a model becomes its model probability
+    """
+    from pyabc import Population
+    total = sum(weight for __, __, weight, __ in particles)
+    population = Population([new_particle(m, parameter, weight/total, distance)
+                             for m, parameter, weight, distance in particles])
+    history.append_population(t, epsilon, population, nr_simulations, model_names)
+
+
+def read_population(history, t):
+    """
+    particles of generation t of a History (for any pyabc version, see new_particle)
+    returns a list of (model index, parameter dict, weight, distance, summary statistics)
+    """
+    population = history.get_population(t)
+    if hasattr(population, 'get_list'):
+        particles = population.get_list()
+    else:
+        particles = population.particles
+    result = []
+    for particle in particles:
+        if hasattr(particle, 'accepted_distances'):
+            distance = particle.accepted_distances[0]
+            sum_stat = particle.accepted_sum_stats[0]
+        else:
+            distance = particle.distance
+            sum_stat = particle.sum_stat
+        result.append((particle.m, dict(particle.parameter), particle.weight, distance, sum_stat))
+    return result
+
+
+def record_pruned(dbfile, run_id, m, t, probability):
+    """
+    record that model m was pruned before generation t (at the given model probability)
+    """
+    with closing(sqlite3.connect(dbfile)) as connection, connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS ratrack_pruned '
+                           '(abc_smc_id INTEGER, m INTEGER, t INTEGER, probability REAL)')
+        connection.execute('INSERT INTO ratrack_pruned VALUES (?, ?, ?, ?)',
+                           (run_id, m, t, probability))
+
+
+def read_pruned(dbfile, run_id):
+    """
+    list of (model index, generation, model probability) of models pruned in a run
+    """
+    with closing(sqlite3.connect(dbfile)) as connection:
+        tables = connection.execute('SELECT name FROM sqlite_master WHERE type = ? AND name = ?',
+                                    ('table', 'ratrack_pruned')).fetchall()
+        if not tables:
+            return []
+        return connection.execute('SELECT m, t, probability FROM ratrack_pruned '
+                                  'WHERE abc_smc_id = ? ORDER BY t, m', (run_id,)).fetchall()
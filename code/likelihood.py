@@ -0,0 +1,247 @@
+"""
+Likelihood based reconstruction of the reproduction rate timeline.
+With the deterministic bernoulli model, the observation model (sampling, dilutions and noise filters)
+gives an approximately gaussian likelihood of the counts, so instead of ABC the posterior of
+every resolution can be found by likelihood tempered sequential monte carlo with metropolis moves.
+"""
+
+import functools
+import sys
+
+import simtools
+
+
+# the next inverse temperature is chosen to keep this fraction of effective particles
+ESS_FRACTION = 0.5
+# metropolis steps per particle and tempering stage
+MOVES = 5
+
+
+def expected_starting_population(params, obs):
+    """
+    mean of the starting population drawn in simtools.parse_params
+    """
+    import numpy as np
+    if params['simulation_params']['starting_cell_count'] != 'calculate':
+        return float(params['simulation_params']['starting_cell_count'])
+    samplings, dilutions = simtools.get_samplings_dilutions(obs)
+    pop = max(obs['count'][0], params['simulation_params']['min_starting_cell_count'])
+    return pop / np.prod(samplings[0]) * np.prod(dilutions[0])
+
+
+def observation_moments(size, samplings, dilutions, filters):
+    """
+    mean and variance of the observed count given the population size,
+    propagated through simtools.apply_sampling and simtools.apply_noise
+    """
+    import numpy as np
+    mean = np.array(size, dtype=float)
+    var = np.zeros(mean.shape)
+
+    def scale(factor):
+        return mean*factor, var*factor**2
+
+    def poisson(factor):
+        # law of total variance for a poisson count with a random mean
+        return mean*factor, mean*factor + var*factor**2
+
+    for dilution in dilutions.transpose():
+        mean, var = scale(1.0/dilution)
+    for sample in samplings.transpose():
+        if simtools.FORWARD_SAMPLING == 'RV':
+            mean, var = poisson(sample)
+        else:
+            mean, var = scale(sample)
+    for filt in filters:
+        if filt['name'] == 'perfect':
+            mean, var = scale(filt['sample'])
+        elif filt['name'] == 'poisson':
+            mean, var = poisson(filt['sample'])
+        elif filt['name'] == 'gauss-multiplicative':
+            var = filt['mean']**2*var + filt['sigma']**2*(var + mean**2)
+            mean = filt['mean']*mean
+        elif filt['name'] == 'gauss-additive':
+            mean = mean + filt['mean']
+            var = var + filt['sigma']**2
+
+    # the counts are rounded
+    return mean, var + 1.0/12.0
+
+
+def log_likelihood(params, observed, birthrates):
+    """
+    gaussian (moment matched) log likelihood of all observed counts
+    for each row of birth rate control points
+    params, observed - as from simtools.parse_params and parse_observations
+    """
+    import numpy as np
+    birthrates = np.atleast_2d(birthrates)
+    total = np.zeros(birthrates.shape[0])
+    for id_string, obs in observed.items():
+        count = np.array([np.nan if x is None else x for x in obs['count']], dtype=float)
+        counted = ~np.isnan(count)
+        __, size, __ = simtools.bernoulli_curve(
+            expected_starting_population(params, obs),
+            obs['time'],
+            birthrates,
+            params['simulation_params']['deathrate_interaction'])
+        samplings, dilutions = simtools.get_samplings_dilutions(obs)
+        mean, var = observation_moments(size, samplings, dilutions, params['filters'])
+        terms = (count - mean)**2/var + np.log(2.0*np.pi*var)
+        total += -0.5*np.sum(terms[:, counted], axis=1)
+    total[np.isnan(total)] = -np.inf
+    return total
+
+
+def log_mean_exp(x):
+    import numpy as np
+    peak = np.max(x)
+    if not np.isfinite(peak):
+        return peak
+    return peak + np.log(np.mean(np.exp(x - peak)))
+
+
+def effective_sample_size(log_weights):
+    import numpy as np
+    w = np.exp(log_weights - np.max(log_weights))
+    return np.sum(w)**2/np.sum(w**2)
+
+
+def next_temperature(loglik, beta):
+    """
+    largest inverse temperature (at most 1) that keeps ESS_FRACTION effective particles
+    """
+    import numpy as np
+    target = ESS_FRACTION*len(loglik)
+    loglik = np.where(np.isfinite(loglik), loglik, -1e300)
+    if effective_sample_size((1.0 - beta)*loglik) >= target:
+        return 1.0
+    low, high = beta, 1.0
+    for __ in range(50):
+        middle = (low + high)/2.0
+        if effective_sample_size((middle - beta)*loglik) >= target:
+            low = middle
+        else:
+            high = middle
+    return max(low, beta + 1e-12)
+
+
+class TemperedModel:
+    """
+    particles of one resolution (number of control points) in tempered SMC
+    loglik - log likelihood of each row of birth rate control points (see log_likelihood)
+    """
+
+    def __init__(self, points, size, rate_limits, rng, loglik):
+        self.points = points
+        self.rate_limits = rate_limits
+        self.rng = rng
+        self.log_likelihood = loglik
+        self.x = rng.uniform(rate_limits[0], rate_limits[1], (size, points))
+        self.loglik = loglik(self.x)
+        self.log_evidence = 0.0
+        self.evaluations = size
+
+    def reweight(self, beta, beta_next):
+        """
+        move to the next temperature: update the evidence and resample
+        """
+        import numpy as np
+        increment = (beta_next - beta)*self.loglik
+        self.log_evidence += log_mean_exp(increment)
+        w = np.exp(increment - np.max(increment))
+        w /= np.sum(w)
+        # systematic resampling
+        positions = (self.rng.uniform() + np.arange(len(w)))/len(w)
+        index = np.minimum(np.searchsorted(np.cumsum(w), positions), len(w) - 1)
+        self.x = self.x[index]
+        self.loglik = self.loglik[index]
+
+    def move(self, beta):
+        """
+        random walk metropolis steps targeting prior * likelihood^beta
+        """
+        import numpy as np
+        size, points = self.x.shape
+        cov = np.atleast_2d(np.cov(self.x, rowvar=False))*2.38**2/points + \
+            np.eye(points)*1e-8
+        for __ in range(MOVES):
+            proposal = self.x + self.rng.multivariate_normal(np.zeros(points), cov, size)
+            inside = np.all((proposal >= self.rate_limits[0]) &
+                            (proposal <= self.rate_limits[1]), axis=1)
+            loglik = np.full(size, -np.inf)
+            loglik[inside] = self.log_likelihood(proposal[inside])
+            self.evaluations += int(np.sum(inside))
+            with np.errstate(invalid='ignore'):
+                accept = np.log(self.rng.uniform(size=size)) < beta*(loglik - self.loglik)
+            accept &= inside
+            self.x[accept] = proposal[accept]
+            self.loglik[accept] = loglik[accept]
+
+
+def tempered_smc(params, observed, size, rng):
+    """
+    run tempered SMC for all resolutions at a shared temperature schedule
+    yields (inverse temperature, models, likelihood evaluations) after every stage
+    """
+    rate_limits = sorted(params['abc_params']['rate_limits'])
+    resolution_limits = params['abc_params']['resolution_limits']
+    loglik = functools.partial(log_likelihood, params, observed)
+    models = [TemperedModel(points, size, rate_limits, rng, loglik)
+              for points in range(resolution_limits[0], resolution_limits[1] + 1)]
+    beta = 0.0
+    while beta < 1.0:
+        evaluations = sum(x.evaluations for x in models)
+        beta_next = min(next_temperature(x.loglik, beta) for x in models)
+        for model in models:
+            model.reweight(beta, beta_next)
+            model.move(beta_next)
+        beta = beta_next
+        yield beta, models, sum(x.evaluations for x in models) - evaluations
+
+
+def model_probabilities(models):
+    """
+    posterior model probabilities from the evidence (with a uniform prior over resolutions)
+    """
+    import numpy as np
+    log_evidence = np.array([x.log_evidence for x in models])
+    p = np.exp(log_evidence - np.max(log_evidence))
+    return p/np.sum(p)
+
+
+def reconstruct(params, observed, flat_observed, dbfile):
+    """
+    likelihood based reconstruction, stored as a pyabc History with one population per
+    tempering stage (the epsilon of a stage is 1 - inverse temperature)
+    params, observed - as from simtools.parse_params and parse_observations
+    flat_observed - the observations as stored in the History (see abc.flatten_observed)
+    """
+    import numpy as np
+    import dbtools
+
+    if params['abc_params']['simulator'] != 'bernoulli':
+        sys.exit("The likelihood engine requires simulator = 'bernoulli'")
+
+    rng = np.random.RandomState(params['abc_params']['seed'])
+    size = int(params['abc_params']['starting_population_size'])
+    resolution_limits = params['abc_params']['resolution_limits']
+    model_names = ['likelihood_' + str(x)
+                   for x in range(resolution_limits[0], resolution_limits[1] + 1)]
+    history = dbtools.new_history(dbfile, flat_observed, model_names,
+                                  {'engine': 'mcmc', 'population_size': size})
+
+    for t, (beta, models, evaluations) in enumerate(tempered_smc(params, observed, size, rng)):
+        p_models = model_probabilities(models)
+        particles = []
+        for m, (model, p_model) in enumerate(zip(models, p_models)):
+            if p_model == 0.0:
+                continue
+            for x, loglik in zip(model.x, model.loglik):
+                parameter = {'birthrate.r' + str(i): float(v) for i, v in enumerate(x)}
+                particles.append((m, parameter, p_model/size, float(-loglik)))
+        dbtools.append_population(history, t, 1.0 - beta, particles, evaluations, model_names)
+        print('t: {}, inverse temperature: {:.4g}, model probabilities: {}'.format(
+            t, beta, ', '.join('{:.3g}'.format(x) for x in p_models)), file=sys.stderr)
+
+    history.done()
@@ -14,7 +14,7 @@
 using namespace std;
 
 
-const string VERSION = "0.1.1";
+const string VERSION = "0.1.2";
 
 
 struct Arguments {
@@ -22,6 +22,7 @@ struct Arguments {
   vector<double> birth_rate;
   double interaction_death_rate;
   vector<double> times;
+  unsigned long seed;
 };
 
 
@@ -58,10 +59,14 @@ public:
 template <typename TCell, typename TRng=std::mt19937>
 class LB {
 public:
-  LB(TCell wt) {
+  // a seed of 0 means seeding from std::random_device
+  LB(TCell wt, unsigned long seed=0) {
     urd = std::uniform_real_distribution<double>(std::nextafter(0.0, 1.0), 1.0);
-    std::random_device rd;
-    rng.seed(rd());
+    if (seed == 0) {
+      std::random_device rd;
+      seed = rd();
+    }
+    rng.seed(seed);
     type_count = 1;
     X.resize(type_count);
     a.resize(type_count * 2);
@@ -189,10 +194,12 @@ int main(int argc, char **argv) {
     TCLAP::ValueArg<string> a_birth_rate("b", "birth-rate", "Birth rate", true, "", "[0, 1, 2, ...]", cmd);
     TCLAP::ValueArg<double> a_interaction_death_rate("q", "interaction-death_rate", "Interaction Death rate", true, 100, "double", cmd);
     TCLAP::ValueArg<string> a_times("t", "measure-times", "Times to measure population size", true, "", "[0, 1, 2, ...]", cmd);
+    TCLAP::ValueArg<unsigned long> a_seed("s", "seed", "Random seed (0 for a random seed)", false, 0, "integer", cmd);
 
     cmd.parse(argc, argv);
 
     a.n0 = a_n0.getValue();
+    a.seed = a_seed.getValue();
     string bstring = a_birth_rate.getValue();
     smatch m_b;
     regex re_fp("\\d+\\.\\d+");
@@ -202,6 +209,11 @@ int main(int argc, char **argv) {
       }
       bstring = m_b.suffix().str();
     }
+    if (a.birth_rate.size() == 1) {
+      // we always need at least 2 values to define the piecewise linear curve
+      // interpret a single value as a constant line
+      a.birth_rate.push_back(a.birth_rate[0]);
+    }
     a.interaction_death_rate = a_interaction_death_rate.getValue();
     string tstring = a_times.getValue();
     smatch m_t;
@@ -233,7 +245,7 @@ int main(int argc, char **argv) {
   // ### Simulation ### //
 
   Cell wt(a.birth_rate, a.interaction_death_rate, a.times.back());
-  LB<Cell> lb(wt);
+  LB<Cell> lb(wt, a.seed);
   lb.set_cell_count(a.n0);
   std::cout << "time\tsize\trate\n";
   double t_prev = 0.0;
@@ -4,27 +4,27 @@ Plotting functions for various causes
 
 
 import csv
+import glob
+import json
+import os
+import re
 import statistics
+import sys
 
 import click
 import numpy as np
-import matplotlib
-from matplotlib import pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib import cm as cm
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.ticker import MaxNLocator
-import matplotlib.patches as patches
-from pyabc import History
-from scipy.stats import linregress
-from scipy.stats import f_oneway
-# from scipy.optimize import minimize
-import pandas as pd
 
+import dbtools
 import simtools
 
+# matplotlib and pyabc are slow to import
+# so they are imported inside the commands that use them
 
-COLORS = ['k', 'r', 'b']
+
+COLORS = ['k', 'r', 'b', 'g', 'm', 'c', 'y', 'tab:orange', 'tab:brown']
+# resolution of the rasterized layers (particles, intervals) in saved plots
+# can be set with raster_dpi in plot_params
+RASTER_DPI = 200
 
 
 def hpdi(data, width=0.89):
@@ -75,23 +75,37 @@ def adjacent_values(vals, q1, q3):
     return lower_adjacent_value, upper_adjacent_value
 
 
+def headless():
+    """
+    use the non interactive Agg backend, the plots are only saved to file,
+    must be called before pyplot is imported
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+
 @main.command()
 @click.option('-p', '--paramfile', type=click.Path())
 @click.option('-o', '--obsfile', type=click.Path())
 @click.option('-d', '--dbfile', type=click.Path())
 @click.option('--run-id', type=int, default=1)
-@click.option('--save', type=click.Path(), default=None)
+@click.option('--save', type=click.Path(), required=True)
 def abc_info(paramfile, obsfile, dbfile, run_id, save):
     """
     Plots for examining ABC fitting process
     """
+    headless()
+    from matplotlib import pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.ticker import MaxNLocator
+    from pyabc import History
 
     db_path = 'sqlite:///' + dbfile
     abc_history = History(db_path)
     abc_history.id = run_id
 
     observed = simtools.parse_observations(obsfile)
-    simtools.parse_params(paramfile, observed)
+    params = simtools.parse_params(paramfile, observed)
 
     ### PLOTS SHOWING MODEL PROBABILITIES ###
     num_models = abc_history.nr_of_models_alive(0)
@@ -100,17 +114,21 @@ def abc_info(paramfile, obsfile, dbfile, run_id, save):
     axs = abc_history.get_model_probabilities().plot.bar()
     axs.set_ylabel("Probability")
     axs.set_xlabel("Generation")
-    resolutions = list(range(simtools.PARAMS['abc_params']['resolution_limits'][0],
-                             simtools.PARAMS['abc_params']['resolution_limits'][1] + 1))
+    resolutions = list(range(params['abc_params']['resolution_limits'][0],
+                             params['abc_params']['resolution_limits'][1] + 1))
     axs.legend(resolutions,
                title="Reconstruction resolution")
 
-    if save is not None:
-        # first time, construct the multipage pdf
-        pdf_out = PdfPages(save)
-        pdf_out.savefig()
-    else:
-        plt.show()
+    # mark models retired by pruning (see abc.ModelPruner)
+    for m, t, p_model in dbtools.read_pruned(dbfile, run_id):
+        print('Model', m, '(resolution', str(resolutions[m]) + ') pruned before generation', t,
+              'at probability', p_model)
+        axs.axvline(t - 0.5, color=COLORS[m], linestyle='--', linewidth=1.0)
+        axs.text(t - 0.5, 1.0, ' pruned ' + str(resolutions[m]), rotation=90,
+                 verticalalignment='top', fontsize='small')
+
+    pdf_out = PdfPages(save)
+    pdf_out.savefig()
 
     ### ABC SIMULATION DIAGNOSTICS ###
     fig, ax = plt.subplots(nrows=3, sharex=True)
@@ -133,11 +151,7 @@ def abc_info(paramfile, obsfile, dbfile, run_id, save):
 
     fig.set_size_inches(8, 5)
 
-    if save is not None:
-        pdf_out.savefig()
-    else:
-        plt.show()
-
+    pdf_out.savefig()
 
     ### PARAMETERS OVER TIME ###
     fig, axs = plt.subplots(nrows=max_points_in_models, sharex=True, sharey=True)
@@ -180,111 +194,87 @@ def abc_info(paramfile, obsfile, dbfile, run_id, save):
                 continue
             # print(t_axis, medians[param])
             axs[i].plot(t_axis, medians[param], color=COLORS[m])
-            axs[i].fill_between(t_axis, qs1[param], qs3[param], color=COLORS[m], alpha=0.2)
+            axs[i].fill_between(t_axis, qs1[param], qs3[param], color=COLORS[m], alpha=0.2,
+                                rasterized=True)
 
             axs[i].set_ylabel(param[10:])
 
         axs[-1].set_xlabel('Generation (t)')
 
-    if save is not None:
-        pdf_out.savefig()
-    else:
-        plt.show()
-
-    if save is not None:
-        pdf_out.close()
+    pdf_out.savefig(dpi=params['plot_params'].get('raster_dpi', RASTER_DPI))
+    pdf_out.close()
 
 
-@main.command()
-@click.option('-p', '--paramfile', type=click.Path())
-@click.option('-o', '--obsfile', type=click.Path())
-@click.option('-d', '--dbfile', type=click.Path())
-@click.option('--run-id', type=int, default=1)
-@click.option('--save', type=click.Path(), default=None)
-def result_single(paramfile, obsfile, dbfile, run_id, save):
+def violin_data(params, abc_history, j, max_gen, max_point_in_models, id_str):
     """
-    Plot the result of a single fitting
+    data for the violin plot of the birth rates of model j
     """
-
-    db_path = 'sqlite:///' + dbfile
-    abc_history = History(db_path)
-    abc_history.id = run_id
-
-    observed = simtools.parse_observations(obsfile)
-    # print(observed)
-    id_str = next(iter(observed))
-    simtools.parse_params(paramfile, observed)
-
-    # violin plot of results
-    max_gen = abc_history.max_t
-
-    # num_models_total = abc_history.nr_of_models_alive(0)
-    num_models_total = simtools.PARAMS['abc_params']['resolution_limits'][1] - simtools.PARAMS['abc_params']['resolution_limits'][0] + 1
-    num_models_final = abc_history.nr_of_models_alive(max_gen)
-    max_point_in_models = max([abc_history.get_distribution(m=x, t=max_gen)[0].shape[1]
-                               for x in range(num_models_final)])
-
-    # fig, axs = plt.subplots(ncols=num_models_final, sharey=True, sharex=True)
-    # fig.set_size_inches(num_models_final*3, 3)
-
-    if save is not None:
-        # first time, construct the multipage pdf
-        pdf_out = PdfPages(save)
-
-    for j in range(num_models_total):
-        if j not in abc_history.get_model_probabilities():
-            continue
-        model_prob = abc_history.get_model_probabilities()[j][max_gen]
-        # print(model_prob)
-        if model_prob == 0.0:
-            continue
-        fig, axs = plt.subplots()
-        fig.set_size_inches(4, 3)
-        end_time = simtools.PARAMS['end_time'][id_str]()
-        # print(end_time)
-
-        df, w = abc_history.get_distribution(m=j, t=max_gen)
-        # print(df)
-        # print(df.columns)
-        # abc_data = [sorted(df['birthrate.b' + str(x)]) for x in range(df.shape[1])]
-        time_axis = np.linspace(0, end_time, len(list(df.columns)))
-
-        # for x in list(df.columns):
-            # print(x)
-            # print(df[x])
-        abc_data = [sorted(df[x]) for x in list(df.columns)]
-        # print(abc_data)
-
-        violinparts = axs.violinplot(abc_data, positions=time_axis,
-                                        widths=end_time/(max_point_in_models + 1)*0.8,
-                                        showmeans=False, showmedians=False, showextrema=False)
-        for part in violinparts['bodies']:
-            part.set_facecolor('lightgrey')
-            part.set_alpha(1)
-            # from user Ruggero Turra https://stackoverflow.com/questions/29776114/half-violin-plot
-            m = np.mean(part.get_paths()[0].vertices[:, 0])
-            part.get_paths()[0].vertices[:, 0] = np.clip(
-                part.get_paths()[0].vertices[:, 0],
-                -np.inf,
-                m
-            )
-            part.set_facecolor('lightgrey')
-            part.set_color('lightgrey')
-
-        for t, d in zip(time_axis, abc_data):
-            axs.scatter(t + np.random.uniform(
-                0.1,
-                end_time/(max_point_in_models + 1)*0.4,
-                size=len(d)
-            ), d, color='grey', marker='.', s=1.0, alpha = 0.8)
-            # print('HPDI')
-            hpdi_interval = hpdi(d)
-            axs.plot([t + 0.1, t + end_time/(max_point_in_models + 1)*0.4],
-                     [hpdi_interval[0], hpdi_interval[0]],
-                      linestyle='--', color='k', linewidth=1.0)
-            axs.plot([t + 0.1, t + end_time/(max_point_in_models + 1)*0.4],
-                     [hpdi_interval[1], hpdi_interval[1]],
-                      linestyle='--', color='k', linewidth=1.0)
+    end_time = params['end_time'][id_str]()
+    # print(end_time)
+
+    df, w = abc_history.get_distribution(m=j, t=max_gen)
+    # print(df)
+    # print(df.columns)
+    # abc_data = [sorted(df['birthrate.b' + str(x)]) for x in range(df.shape[1])]
+    time_axis = np.linspace(0, end_time, len(list(df.columns)))
+
+    # for x in list(df.columns):
+        # print(x)
+        # print(df[x])
+    abc_data = [sorted(df[x]) for x in list(df.columns)]
+    # print(abc_data)
+    width = end_time/(max_point_in_models + 1)
+    jitter = [np.random.uniform(0.1, width*0.4, size=len(d)) for d in abc_data]
+
+    return {
+        'time_axis': time_axis,
+        'abc_data': abc_data,
+        'width': width,
+        'jitter': jitter,
+        'title': params['plot_params']['coupling_names'],
+    }
+
+
+def draw_violin(data):
+    """
+    violin plot of the birth rates of a model, with the particles (rasterized) beside each violin
+    """
+    from matplotlib import pyplot as plt
+    time_axis = data['time_axis']
+    abc_data = data['abc_data']
+    width = data['width']
+
+    fig, axs = plt.subplots()
+    fig.set_size_inches(4, 3)
+
+    violinparts = axs.violinplot(abc_data, positions=time_axis,
+                                    widths=width*0.8,
+                                    showmeans=False, showmedians=False, showextrema=False)
+    for part in violinparts['bodies']:
+        part.set_facecolor('lightgrey')
+        part.set_alpha(1)
+        # from user Ruggero Turra https://stackoverflow.com/questions/29776114/half-violin-plot
+        m = np.mean(part.get_paths()[0].vertices[:, 0])
+        part.get_paths()[0].vertices[:, 0] = np.clip(
+            part.get_paths()[0].vertices[:, 0],
+            -np.inf,
+            m
+        )
+        part.set_facecolor('lightgrey')
+        part.set_color('lightgrey')
+        part.set_rasterized(True)
+
+    for t, d, jitter in zip(time_axis, abc_data, data['jitter']):
+        axs.scatter(t + jitter, d, color='grey', marker='.', s=1.0, alpha = 0.8,
+                    rasterized=True)
+        # print('HPDI')
+        hpdi_interval = hpdi(d)
+        axs.plot([t + 0.1, t + width*0.4],
+                 [hpdi_interval[0], hpdi_interval[0]],
+                  linestyle='--', color='k', linewidth=1.0)
+        axs.plot([t + 0.1, t + width*0.4],
+                 [hpdi_interval[1], hpdi_interval[1]],
+                  linestyle='--', color='k', linewidth=1.0)
 
 
 # for b in v1['bodies']:
@@ -293,133 +283,242 @@ def result_single(paramfile, obsfile, dbfile, run_id, save):
 #     b.set_color('r')
 
 
-        quartile1, medians, quartile3 = np.percentile(abc_data, [25, 50, 75], axis=1)
-        whiskers = np.array([
-            adjacent_values(sorted_array, q1, q3)
-            for sorted_array, q1, q3 in zip(abc_data, quartile1, quartile3)])
-        whiskers_min, whiskers_max = whiskers[:, 0], whiskers[:, 1]
-        axs.scatter(time_axis, medians, marker='.', color='white', s=30, zorder=3)
-        axs.vlines(time_axis, whiskers_min, whiskers_max, color='k', linestyle='-', lw=1)
-        axs.vlines(time_axis, quartile1, quartile3, color='k', linestyle='-', lw=5)
+    quartile1, medians, quartile3 = np.percentile(abc_data, [25, 50, 75], axis=1)
+    whiskers = np.array([
+        adjacent_values(sorted_array, q1, q3)
+        for sorted_array, q1, q3 in zip(abc_data, quartile1, quartile3)])
+    whiskers_min, whiskers_max = whiskers[:, 0], whiskers[:, 1]
+    axs.scatter(time_axis, medians, marker='.', color='white', s=30, zorder=3)
+    axs.vlines(time_axis, whiskers_min, whiskers_max, color='k', linestyle='-', lw=1)
+    axs.vlines(time_axis, quartile1, quartile3, color='k', linestyle='-', lw=5)
 
-        birthrate = [statistics.median(x) for x in abc_data]
-        axs.plot(time_axis, birthrate, color='k')
-        axs.set_xlabel('Time [days]')
-        axs.set_ylabel(r'Growth rate [divisions day$^{-1}$ cell$^{-1}$]')
+    birthrate = [statistics.median(x) for x in abc_data]
+    axs.plot(time_axis, birthrate, color='k')
+    axs.set_xlabel('Time [days]')
+    axs.set_ylabel(r'Growth rate [divisions day$^{-1}$ cell$^{-1}$]')
 
-        title = simtools.PARAMS['plot_params']['coupling_names']
-        axs.set_title(title)
+    axs.set_title(data['title'])
 
 
-        # axs.set_ylim(0, simtools.PARAMS['abc_params']['rate_limits'][1])
+    # axs.set_ylim(0, simtools.PARAMS['abc_params']['rate_limits'][1])
 
-        plt.tight_layout()
+    plt.tight_layout()
+    return fig
 
-        if save is not None:
-            pdf_out.savefig()
-        else:
-            plt.show()
 
+def fit_data(params, abc_history, j, max_gen, observed, id_str):
+    """
+    data for the plot of the fit of model j against the observations
+    """
+    df, w = abc_history.get_distribution(m=j, t=max_gen)
 
-    # fit against timeline
-    for j in range(num_models_total):
-        if j not in abc_history.get_model_probabilities():
-            continue
-        model_prob = abc_history.get_model_probabilities()[j][max_gen]
-        if model_prob == 0.0:
-            continue
-        fig, axs = plt.subplots()
-        fig.set_size_inches(4, 3)
-        end_time = simtools.PARAMS['end_time'][id_str]()
+    # samplings = [simtools.get_samplings_dilutions(observed[id_str], x)[0]
+    #              for x, __ in enumerate(observed[id_str]['time'])]
+    # dilutions = [simtools.get_samplings_dilutions(observed[id_str], x)[1]
+    #              for x, __ in enumerate(observed[id_str]['time'])]
 
-        df, w = abc_history.get_distribution(m=j, t=max_gen)
-        time_axis = np.linspace(0, end_time, len(list(df.columns)))
+    # print(observed)
+    # print('main obs', simtools.OBSERVED)
+
+    # id_str = list(observed.keys())[j]
+
+    # samplings = list(zip(*samplings))
+    # dilutions = list(zip(*dilutions))
+
+    points = []
+    for k, v in observed.items():
+        # print(k, v)
+        samplings, dilutions = simtools.get_samplings_dilutions(observed[k])
+        measured = np.array(v['count'])
+        for s in samplings.transpose():
+            # print(measured, s)
+            measured /= s
+        for d in dilutions.transpose():
+            measured *= d
+        points.append((v['time'], measured))
+
+    # print(samplings, dilutions)
+
+    time_axis = np.linspace(0, max(observed[id_str]['time']), 100)
+
+    # solve the bernoulli model for all particles at once
+    starting_populations = [params['starting_population'][id_str]()
+                            for __ in range(len(df))]
+    time, size, rate = simtools.bernoulli_curve(
+        starting_populations,
+        time_axis,
+        df.values,
+        params['simulation_params']['deathrate_interaction'],
+    )
+    simulations = size.transpose()
+
+    qt1, qt2, qt3 = np.quantile(simulations, (0.05, 0.5, 0.95), axis=1)
+    # print(qt2)
+
+    measurename = 'Population measure'
+    if 'population_measure' in params['plot_params']:
+        measurename = params['plot_params']['population_measure']
+
+    return {
+        'points': points,
+        'time_axis': time_axis,
+        'quantiles': (qt1, qt2, qt3),
+        'measurename': measurename,
+        'title': params['plot_params']['coupling_names'],
+    }
+
+
+def draw_fit(data):
+    """
+    observations against the median and 90% interval of the simulated curves (rasterized)
+    """
+    from matplotlib import pyplot as plt
+    fig, axs = plt.subplots()
+    fig.set_size_inches(4, 3)
+
+    for time, measured in data['points']:
+        axs.scatter(time, measured, marker='.', color='k')
 
-        # samplings = [simtools.get_samplings_dilutions(observed[id_str], x)[0]
-        #              for x, __ in enumerate(observed[id_str]['time'])]
-        # dilutions = [simtools.get_samplings_dilutions(observed[id_str], x)[1]
-        #              for x, __ in enumerate(observed[id_str]['time'])]
+    qt1, qt2, qt3 = data['quantiles']
+    # axs.plot(time, qt1)
+    axs.plot(data['time_axis'], qt2, color='k')
+    # axs.plot(time, qt3)
+    axs.fill_between(data['time_axis'], qt1, qt3, zorder=-1, color='lightgray', rasterized=True)
 
-        # print(observed)
-        # print('main obs', simtools.OBSERVED)
+    axs.set_xlabel('Time [days]')
+    axs.set_ylabel(data['measurename'])
 
-        # id_str = list(observed.keys())[j]
+    # print(j, i, index)
+    # print(simtools.PARAMS['abc_params']['birthrate_coupling_sets'])
 
-        samplings, dilutions = simtools.get_samplings_dilutions(observed[id_str])
+    axs.set_title(data['title'])
 
-        # samplings = list(zip(*samplings))
-        # dilutions = list(zip(*dilutions))
+    plt.tight_layout()
+    return fig
 
-        abc_data = [sorted(df[x]) for x in list(df.columns)]
-        for k, v in observed.items():
-            # print(k, v)
-            samplings, dilutions = simtools.get_samplings_dilutions(observed[k])
-            measured = np.array(v['count'])
-            for s in samplings.transpose():
-                # print(measured, s)
-                measured /= s
-            for d in dilutions.transpose():
-                measured *= d
 
-            axs.scatter(v['time'], measured, marker='.', color='k')
+def result_pages(paramfile, obsfile, dbfile, run_id, best_only=False):
+    """
+    data for the violin and fit plots of every model with a nonzero final probability
+    (or only of the most probable one)
+    returns a list of ('violin' or 'fit', data) in page order, and the raster_dpi of the pages
+    """
+    from pyabc import History
+
+    db_path = 'sqlite:///' + dbfile
+    abc_history = History(db_path)
+    abc_history.id = run_id
 
-        # print(samplings, dilutions)
+    observed = simtools.parse_observations(obsfile)
+    # print(observed)
+    id_str = next(iter(observed))
+    params = simtools.parse_params(paramfile, observed)
 
-        simulations = None
+    # violin plot of results
+    max_gen = abc_history.max_t
 
-        time_axis = np.linspace(0, max(observed[id_str]['time']), 100)
+    # num_models_total = abc_history.nr_of_models_alive(0)
+    num_models_total = params['abc_params']['resolution_limits'][1] - params['abc_params']['resolution_limits'][0] + 1
+    num_models_final = abc_history.nr_of_models_alive(max_gen)
+    max_point_in_models = max([abc_history.get_distribution(m=x, t=max_gen)[0].shape[1]
+                               for x in range(num_models_final)])
 
-        i = 0
-        for index, row in df.iterrows():
-            # if i > 100:
-            #     break
-            # print(index, row)
-            time, size, rate = simtools.simulate_timeline(
-                simtools.PARAMS['starting_population'][id_str](),
-                time_axis,
-                list(row),
-                simtools.PARAMS['simulation_params']['deathrate_interaction'],
-                # simtools.PARAMS['abc_params']['simulator'],
-                'bernoulli',
-                verbosity=1
-            )
+    model_probabilities = abc_history.get_model_probabilities()
+    models = []
+    for j in range(num_models_total):
+        if j not in model_probabilities:
+            continue
+        model_prob = model_probabilities[j][max_gen]
+        # print(model_prob)
+        if model_prob == 0.0:
+            continue
+        models.append((model_prob, j))
+    if best_only:
+        models = [max(models)]
 
-            if simulations is None:
-                simulations = np.zeros((len(size), len(df)))
+    pages = [('violin', violin_data(params, abc_history, j, max_gen, max_point_in_models, id_str))
+             for __, j in models]
+    # fit against timeline
+    pages += [('fit', fit_data(params, abc_history, j, max_gen, observed, id_str))
+              for __, j in models]
+    return pages, params['plot_params'].get('raster_dpi', RASTER_DPI)
 
-            simulations[:, i] = size
-            i += 1
 
-        qt1, qt2, qt3 = np.quantile(simulations, (0.05, 0.5, 0.95), axis=1)
-        # print(qt2)
+def draw_pages(pages):
+    """
+    figures of the pages from result_pages
+    """
+    from matplotlib import pyplot as plt
+    draw = {'violin': draw_violin, 'fit': draw_fit}
+    figures = []
+    for kind, data in pages:
+        fig = draw[kind](data)
+        # drop it from pyplot, the figure itself is kept
+        plt.close(fig)
+        figures.append(fig)
+    return figures
+
+
+def save_figures(figures, save, dpi):
+    """
+    multipage pdf of the figures
+    dpi - resolution of the rasterized layers
+    """
+    from matplotlib.backends.backend_pdf import PdfPages
+    with PdfPages(save) as pdf_out:
+        for fig in figures:
+            pdf_out.savefig(fig, dpi=dpi)
 
-        # axs.plot(time, qt1)
-        axs.plot(time_axis, qt2, color='k')
-        # axs.plot(time, qt3)
-        axs.fill_between(time_axis, qt1, qt3, zorder=-1, color='lightgray')
 
-        axs.set_xlabel('Time [days]')
-        measurename = 'Population measure'
-        if 'population_measure' in simtools.PARAMS['plot_params']:
-            measurename = simtools.PARAMS['plot_params']['population_measure']
-        axs.set_ylabel(measurename)
+@main.command()
+@click.option('-p', '--paramfile', type=click.Path())
+@click.option('-o', '--obsfile', type=click.Path())
+@click.option('-d', '--dbfile', type=click.Path())
+@click.option('--run-id', type=int, default=1)
+@click.option('--save', type=click.Path(), required=True)
+def result_single(paramfile, obsfile, dbfile, run_id, save):
+    """
+    Plot the result of a single fitting
+    """
+    headless()
+    pages, dpi = result_pages(paramfile, obsfile, dbfile, run_id)
+    save_figures(draw_pages(pages), save, dpi)
 
-        # print(j, i, index)
-        # print(simtools.PARAMS['abc_params']['birthrate_coupling_sets'])
 
-        title = simtools.PARAMS['plot_params']['coupling_names']
-        axs.set_title(title)
+def report_group(group):
+    """
+    figures of the most probable model of a group and their dpi, for report
+    (runs in a worker process, the figures are pickled back to the parent)
+    """
+    paramfile, obsfile, dbfile = group
+    pages, dpi = result_pages(paramfile, obsfile, dbfile, 1, best_only=True)
+    return draw_pages(pages), dpi
 
-        plt.tight_layout()
 
-        if save is not None:
-            pdf_out.savefig()
-        else:
-            plt.show()
+@main.command()
+@click.option('-g', '--group', 'groups', type=(click.Path(), click.Path(), click.Path()),
+              multiple=True, help='parameter, observation and database file of a group')
+@click.option('-j', '--jobs', type=int, default=None,
+              help='number of groups plotted at the same time (default: all cores)')
+@click.option('--save', type=click.Path(), required=True)
+def report(groups, jobs, save):
+    """
+    Report of the most probable model of every group (violin plot and fit)
+    The figures of the groups are built concurrently, only writing the single pdf is serial.
+    """
+    import concurrent.futures
+    from matplotlib.backends.backend_pdf import PdfPages
+    # before the workers are forked, they inherit the backend
+    headless()
 
-    if save is not None:
-        pdf_out.close()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(report_group, groups))
 
+    with PdfPages(save) as pdf_out:
+        for figures, dpi in results:
+            for fig in figures:
+                # dpi only applies to the rasterized layers
+                pdf_out.savefig(fig, dpi=dpi)
 
 
 # @main.command()
@@ -431,19 +530,50 @@ def result_single(paramfile, obsfile, dbfile, run_id, save):
 #         wtr.writeheader()
 
 
+def adjusted_particles(params, observed, abc_history, t, m, method):
+    """
+    regression adjusted birth rates (one particle per row) and weights of model m in generation t
+    params, observed - as from simtools.parse_params and parse_observations
+    """
+    import adjustment
+    epsilon = abc_history.get_all_populations().set_index('t').loc[t]['epsilon']
+    rates = []
+    stats = []
+    distances = []
+    weights = []
+    for model, parameter, weight, distance, sum_stat in dbtools.read_population(abc_history, t):
+        if model != m:
+            continue
+        if 'simulation' not in sum_stat:
+            sys.exit('The database has no stored simulations, can not adjust')
+        columns = sorted(parameter, key=lambda x: int(x.split('.r')[-1]))
+        rates.append([parameter[x] for x in columns])
+        stats.append(adjustment.summary_statistics(params, observed, sum_stat))
+        distances.append(distance)
+        weights.append(weight)
+    return adjustment.adjust(params, observed, np.array(rates), np.array(stats),
+                             distances, weights, epsilon, method)
+
+
 @main.command()
 @click.option('-p', '--paramfile', type=click.Path())
 @click.option('-o', '--obsfile', type=click.Path())
 @click.option('-d', '--dbfile', type=click.Path())
 @click.option('-c', '--csvfile', type=click.Path())
 @click.option('--run-id', type=int, default=1)
+@click.option('--adjust', type=click.Choice(['linear', 'ridge']), default=None,
+              help='regression adjust the particles against their simulations')
+@click.option('--particles', 'particle_csvfile', type=click.Path(), default=None,
+              help='also save the (adjusted) particles and their weights')
 # @click.option('-n', '--name', type=str)
-def tabulate_single(paramfile, obsfile, dbfile, csvfile, run_id):
+def tabulate_single(paramfile, obsfile, dbfile, csvfile, run_id, adjust, particle_csvfile):
     """
     Table of results (appending to table)
     """
+    from pyabc import History
 
     fieldnames = ['name', 'model_index', 'model_probability', 'rate_position', 'rate_mean', 'rate_stdev']
+    particle_fieldnames = ['name', 'model_index', 'particle', 'rate_position', 'rate', 'weight']
 
     db_path = 'sqlite:///' + dbfile
     abc_history = History(db_path)
@@ -452,19 +582,20 @@ def tabulate_single(paramfile, obsfile, dbfile, csvfile, run_id):
     observed = simtools.parse_observations(obsfile)
     # print(observed)
     # id_str = next(iter(observed))
-    simtools.parse_params(paramfile, observed)
+    params = simtools.parse_params(paramfile, observed)
 
     # violin plot of results
     max_gen = abc_history.max_t
 
     # num_models_total = abc_history.nr_of_models_alive(0)
-    num_models_total = simtools.PARAMS['abc_params']['resolution_limits'][1] - simtools.PARAMS['abc_params']['resolution_limits'][0] + 1
+    num_models_total = params['abc_params']['resolution_limits'][1] - params['abc_params']['resolution_limits'][0] + 1
     num_models_final = abc_history.nr_of_models_alive(max_gen)
     max_point_in_models = max([abc_history.get_distribution(m=x, t=max_gen)[0].shape[1]
                                for x in range(num_models_final)])
 
     # print(max_gen, num_models_total, num_models_final)
 
+    particle_rows = []
     with open(csvfile, 'w') as csv_out:
         wtr = csv.DictWriter(csv_out, fieldnames=fieldnames)
         wtr.writeheader()
@@ -479,30 +610,33 @@ def tabulate_single(paramfile, obsfile, dbfile, csvfile, run_id):
 
             # print(j + 1, model_prob)
 
-            df, w = abc_history.get_distribution(m=j, t=max_gen)
-            # print(df)
-            # print(df.columns)
-            # abc_data = [sorted(df['birthrate.b' + str(x)]) for x in range(df.shape[1])]
-
-            # for x in list(df.columns):
-            #     print(x)
-            #     print(df[x])
-            abc_data = [sorted(df[x]) for x in list(df.columns)]
-            # print(abc_data)
-
-            for i, d in enumerate(abc_data):
-                print('HPDI')
-                hpdi_interval = hpdi(d)
-                print(hpdi_interval)
-                print('MEAN')
-                mean = np.mean(d)
-                print(mean)
-                print('SIGMA')
-                sigma = np.std(d)
-                print(sigma)
+            if adjust is not None:
+                rates, w = adjusted_particles(params, observed, abc_history, max_gen, j, adjust)
+            else:
+                df, w = abc_history.get_distribution(m=j, t=max_gen)
+                rates = df[sorted(df.columns, key=lambda x: int(x.split('.r')[-1]))].values
+            for k, (particle, weight) in enumerate(zip(rates, w)):
+                for i, rate in enumerate(particle):
+                    particle_rows.append({
+                        'name': params['plot_params']['coupling_names'],
+                        'model_index': j,
+                        'particle': k,
+                        'rate_position': i,
+                        'rate': rate,
+                        'weight': weight,
+                    })
+
+            for i in range(rates.shape[1]):
+                if adjust is not None:
+                    # the adjusted particles are only meaningful with their weights
+                    mean = np.average(rates[:, i], weights=w)
+                    sigma = np.sqrt(np.average((rates[:, i] - mean)**2, weights=w))
+                else:
+                    mean = np.mean(rates[:, i])
+                    sigma = np.std(rates[:, i])
 
                 row = {
-                    'name': simtools.PARAMS['plot_params']['coupling_names'],
+                    'name': params['plot_params']['coupling_names'],
                     'model_index': j,
                     'model_probability': model_prob,
                     'rate_position': i,
@@ -511,11 +645,132 @@ def tabulate_single(paramfile, obsfile, dbfile, csvfile, run_id):
                 }
                 wtr.writerow(row)
 
+    if particle_csvfile is not None:
+        with open(particle_csvfile, 'w') as csv_out:
+            wtr = csv.DictWriter(csv_out, fieldnames=particle_fieldnames)
+            wtr.writeheader()
+            for row in particle_rows:
+                wtr.writerow(row)
+
+
+def extract_db(dbfile, run_id):
+    """
+    model probabilities and weighted birth rate statistics of the final population of a database
+    (runs in a worker process of aggregate)
+    returns rows of the aggregate table, without the name
+    """
+    from pyabc import History
+
+    abc_history = History('sqlite:///' + dbfile)
+    abc_history.id = run_id
+    max_gen = abc_history.max_t
+    model_probabilities = abc_history.get_model_probabilities()
+
+    rows = []
+    for j in model_probabilities.columns:
+        model_prob = model_probabilities[j][max_gen]
+        if not model_prob > 0.0:
+            continue
+        df, w = abc_history.get_distribution(m=j, t=max_gen)
+        rates = df[sorted(df.columns, key=lambda x: int(x.split('.r')[-1]))].values
+        for i in range(rates.shape[1]):
+            mean = np.average(rates[:, i], weights=w)
+            sigma = np.sqrt(np.average((rates[:, i] - mean)**2, weights=w))
+            rows.append({
+                'model_index': int(j),
+                'model_probability': float(model_prob),
+                'rate_position': i,
+                'rate_mean': float(mean),
+                'rate_stdev': float(sigma),
+            })
+    return rows
+
+
+def cache_key(dbfile, run_id):
+    """
+    key of the aggregate cache entry of a database, changes whenever the database is written
+    """
+    stat = os.stat(dbfile)
+    return [stat.st_mtime_ns, stat.st_size, run_id]
+
+
+def db_group(dbfile):
+    """
+    group number of an intermediate/<name>.g<k>.db database (for sorting)
+    """
+    match = re.search(r'\.g(\d+)\.db$', dbfile)
+    return int(match.group(1)) if match else -1
 
 
+@main.command()
+@click.option('-n', '--name', type=str, default=None,
+              help='dataset, aggregates all intermediate/<name>.g<k>.db')
+@click.option('-i', '--intermediate', type=click.Path(), default='intermediate')
+@click.option('-c', '--csvfile', type=click.Path())
+@click.option('--cache', 'cachefile', type=click.Path(), default=None,
+              help='extracts of unchanged databases are reused from here '
+                   '(default: <csvfile>.cache.json)')
+@click.option('--run-id', type=int, default=1)
+@click.option('-j', '--jobs', type=int, default=None,
+              help='number of databases read at the same time (default: all cores)')
+@click.argument('dbfiles', nargs=-1, type=click.Path(exists=True))
+def aggregate(name, intermediate, csvfile, cachefile, run_id, jobs, dbfiles):
+    """
+    Table of results of many groups at once
+    Like tabulate-single on every database followed by csvtools.py merge, but with weighted
+    statistics, the databases read in parallel, and only changed databases read again.
+    The name of a group is read from the parameter file next to its database (<group>.toml).
+    """
+    import concurrent.futures
+    import toml
 
+    fieldnames = ['name', 'model_index', 'model_probability', 'rate_position', 'rate_mean', 'rate_stdev']
 
+    dbfiles = list(dbfiles)
+    if name is not None:
+        # shards (<name>.g<k>.r<R>.db) are not groups
+        dbfiles += [x for x in glob.glob(os.path.join(intermediate, glob.escape(name) + '.g*.db'))
+                    if db_group(x) >= 0 and x not in dbfiles]
+    if not dbfiles:
+        sys.exit('No databases to aggregate')
+    dbfiles = sorted(dbfiles, key=lambda x: (db_group(x), x))
+
+    if cachefile is None:
+        cachefile = csvfile + '.cache.json'
+    cache = {}
+    if os.path.exists(cachefile):
+        with open(cachefile) as cache_in:
+            cache = json.load(cache_in)
+
+    extracts = {}
+    changed = []
+    for dbfile in dbfiles:
+        entry = cache.get(os.path.abspath(dbfile))
+        if entry is not None and entry['key'] == cache_key(dbfile, run_id):
+            extracts[dbfile] = entry['rows']
+        else:
+            changed.append(dbfile)
+    print('Reading', len(changed), 'of', len(dbfiles), 'databases', file=sys.stderr)
+
+    if changed:
+        # imported once, before the workers are forked
+        import pyabc  # noqa: F401
+        with concurrent.futures.ProcessPoolExecutor(min(jobs or os.cpu_count(), len(changed))) as pool:
+            for dbfile, rows in zip(changed, pool.map(extract_db, changed,
+                                                      [run_id]*len(changed))):
+                extracts[dbfile] = rows
+                cache[os.path.abspath(dbfile)] = {'key': cache_key(dbfile, run_id), 'rows': rows}
+        with open(cachefile, 'w') as cache_out:
+            json.dump(cache, cache_out)
 
+    with open(csvfile, 'w') as csv_out:
+        wtr = csv.DictWriter(csv_out, fieldnames=fieldnames)
+        wtr.writeheader()
+        for dbfile in dbfiles:
+            paramfile = dbfile[:-len('.db')] + '.toml'
+            group_name = toml.load(paramfile)['plot_params']['coupling_names']
+            for row in extracts[dbfile]:
+                wtr.writerow(dict(row, name=group_name))
 
 
 if __name__ == '__main__':
@@ -6,6 +6,15 @@ rudimentary test of input files to verify that they conform to expected content/
 import toml
 import csv
 import click
+from os import path
+
+
+# constant birth rates (as fractions of the rate_limits range) used to time the simulator
+# slow and fast growth give the cheapest and most expensive rar-engine simulations
+ESTIMATE_RATES = [0.1, 0.5, 0.9]
+# range of mean acceptance rates over a reconstruction, used when projecting run time
+# (high early on when epsilon is large, low in the last generations)
+ESTIMATE_ACCEPTANCE = [0.3, 0.02]
 
 
 @click.group()
@@ -73,6 +82,48 @@ def test(paramfile, obsfile, minimal=True):
     assert isinstance(params['abc_params']['parallel_simulations'], int)
     assert params['abc_params']['parallel_simulations'] > 0
 
+    if 'seed' in params['abc_params']:
+        assert isinstance(params['abc_params']['seed'], int)
+    if 'common_random_numbers' in params['abc_params']:
+        assert isinstance(params['abc_params']['common_random_numbers'], bool)
+        if params['abc_params']['common_random_numbers']:
+            assert 'seed' in params['abc_params']
+    if 'prescreen_factor' in params['abc_params']:
+        assert isinstance(params['abc_params']['prescreen_factor'], (int, float))
+        assert params['abc_params']['prescreen_factor'] > 0
+        if params['abc_params']['simulator'] == 'bernoulli':
+            print('prescreen_factor has no effect with the bernoulli simulator')
+        elif params['abc_params']['prescreen_factor'] < 1:
+            print('prescreen_factor below 1 rejects particles that rar-engine might accept')
+    if 'prune_threshold' in params['abc_params']:
+        assert isinstance(params['abc_params']['prune_threshold'], (int, float))
+        assert 0 <= params['abc_params']['prune_threshold'] < 1
+    if 'prune_generations' in params['abc_params']:
+        assert isinstance(params['abc_params']['prune_generations'], int)
+        assert params['abc_params']['prune_generations'] > 0
+    if 'warm_start' in params['abc_params']:
+        assert isinstance(params['abc_params']['warm_start'], int)
+        assert params['abc_params']['warm_start'] >= params['abc_params']['resolution_limits'][0]
+        if params['abc_params']['warm_start'] >= params['abc_params']['resolution_limits'][1]:
+            print('warm_start covers all resolutions, the pilot only repeats the reconstruction')
+    for key in ['warm_start_width', 'warm_start_generations']:
+        if key in params['abc_params']:
+            assert isinstance(params['abc_params'][key], (int, float))
+            assert params['abc_params'][key] > 0
+    if 'surrogate' in params['abc_params']:
+        assert params['abc_params']['surrogate'] in ['gp', 'gbr']
+        for key in ['surrogate_z', 'surrogate_audit']:
+            if key in params['abc_params']:
+                assert isinstance(params['abc_params'][key], (int, float))
+                assert params['abc_params'][key] >= 0
+        if 'surrogate_after' in params['abc_params']:
+            assert isinstance(params['abc_params']['surrogate_after'], int)
+    if 'initial_sampling' in params['abc_params']:
+        assert params['abc_params']['initial_sampling'] in ['random', 'halton']
+    if 'simulation_threads' in params['abc_params']:
+        assert isinstance(params['abc_params']['simulation_threads'], int)
+        assert params['abc_params']['simulation_threads'] > 0
+
     if not minimal:
         if params['abc_params']['birthrate_coupling_sets'] not in ['all', 'none']:
             assert len(params['plot_params']['coupling_names']) == len(params['abc_params']['birthrate_coupling_sets'])
@@ -93,5 +144,122 @@ def test(paramfile, obsfile, minimal=True):
             print('for instance: dilution1, dilution2, etc...')
 
 
+
+def format_duration(seconds):
+    for unit, length in [('d', 86400), ('h', 3600), ('min', 60)]:
+        if seconds >= length:
+            return '{:.3g} {}'.format(seconds/length, unit)
+    return '{:.3g} s'.format(seconds)
+
+
+def read_groups(paramfile, obsfile, workdir):
+    """
+    split the observations into birthrate groups the same way as the snakemake pipeline
+    returns a dict of group -> observations (as from simtools.parse_observations)
+    """
+    import contextlib
+    import io
+    import csvtools
+    import simtools
+    groups = path.join(workdir, 'groups.csv')
+    zero = path.join(workdir, 'zero.csv')
+    with contextlib.redirect_stdout(io.StringIO()):
+        csvtools.define_groups.callback(obsfile, paramfile, groups)
+    csvtools.zero_time_longform.callback(groups, zero)
+    observed = simtools.parse_observations(zero)
+    result = {}
+    for id_string, obs in observed.items():
+        result.setdefault(obs['birthrate_group'][0], {})[id_string] = obs
+    return result
+
+
+def time_particle(params, observed, birthrates, simulator, repeats):
+    """
+    fastest wall time in seconds of simulating all observations of a group once
+    (the work done for every particle in abc.abc_model)
+    params - as from simtools.parse_params
+    """
+    import time
+    import simtools
+    times = []
+    for __ in range(repeats):
+        start = time.perf_counter()
+        for id_string, obs in observed.items():
+            simtools.simulate_timeline(
+                params['starting_population'][id_string](),
+                obs['time'],
+                birthrates,
+                params['simulation_params']['deathrate_interaction'],
+                simulator,
+                verbosity=0)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@main.command()
+@click.option('-p', 'paramfile', type=click.Path())
+@click.option('-o', 'obsfile', type=click.Path())
+@click.option('-s', '--simulator', 'simulators', type=click.Choice(['rar-engine', 'bernoulli']),
+              multiple=True, help='simulators to time (default: the configured one)')
+@click.option('-r', '--repeats', type=int, default=3)
+def estimate(paramfile, obsfile, simulators, repeats):
+    """
+    project the run time of a reconstruction of every group
+    by timing the simulator on the observations
+    """
+    import tempfile
+    import numpy as np
+    import simtools
+
+    with tempfile.TemporaryDirectory() as workdir:
+        groups = read_groups(paramfile, obsfile, workdir)
+
+    for group, observed in sorted(groups.items()):
+        params = simtools.parse_params(paramfile, observed)
+        abc_params = params['abc_params']
+        if not simulators:
+            simulators = [abc_params['simulator']]
+        resolutions = list(range(abc_params['resolution_limits'][0],
+                                 abc_params['resolution_limits'][1] + 1))
+        rate_limits = sorted(abc_params['rate_limits'])
+        particles = abc_params['starting_population_size']
+        generations = abc_params['max_populations']
+        # the observations of a particle are simulated in up to simulation_threads threads
+        # (as abc.simulation_threads) by every one of the parallel_simulations workers
+        threads = max(1, min(abc_params['simulation_threads'], len(observed)))
+        cores = abc_params['parallel_simulations']*threads
+        # a run stops when the acceptance rate drops below min_acceptance
+        acceptance = [ESTIMATE_ACCEPTANCE[0],
+                      max(ESTIMATE_ACCEPTANCE[1], abc_params['min_acceptance'])]
+        # one calibration sample from the prior, then a population per generation
+        simulations = [particles + particles*generations/x for x in acceptance]
+
+        print('group', group, '(' + ', '.join(sorted(observed)) + ')')
+        print('  {} observations, resolutions {}-{}, {} particles, up to {} generations'.format(
+            len(observed), resolutions[0], resolutions[-1], particles, generations))
+        print('  {:.0f}-{:.0f} simulated particles (acceptance {:g}-{:g})'.format(
+            simulations[0], simulations[1], acceptance[0], acceptance[1]))
+
+        for simulator in simulators:
+            # the resolutions share the particles, so the cost is averaged over them
+            per_particle = []
+            for quantile in ESTIMATE_RATES:
+                rate = rate_limits[0] + quantile*(rate_limits[1] - rate_limits[0])
+                per_particle.append(np.mean([
+                    time_particle(params, observed, [rate]*points, simulator, repeats)
+                    for points in resolutions]))
+            low = min(per_particle)*simulations[0]
+            high = max(per_particle)*simulations[1]
+            print('  {}: {:.3g}-{:.3g} s per particle'.format(
+                simulator, min(per_particle), max(per_particle)))
+            print('    core-hours {:.3g}-{:.3g}, wall-clock {} - {} on {} cores'
+                  ' ({} workers x {} threads)'.format(
+                      low/3600, high/3600, format_duration(low/cores), format_duration(high/cores),
+                      cores, abc_params['parallel_simulations'], threads))
+            if len(resolutions) > 1:
+                print('    sharded by resolution: core-hours {:.3g}-{:.3g} over {} jobs'.format(
+                    low*len(resolutions)/3600, high*len(resolutions)/3600, len(resolutions)))
+
+
 if __name__ == '__main__':
     main()
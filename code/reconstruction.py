@@ -0,0 +1,31 @@
+"""
+Importable interface to the reconstructions in abc.py, for batch drivers and notebooks
+
+    import reconstruction
+    first = reconstruction.Reconstruction('data/minimal.toml', 'intermediate/minimal.g0.data.csv',
+                                          'intermediate/minimal.g0.db')
+    first.run()
+    for m, (p_model, df, w) in first.posterior().items():
+        ...
+
+abc.py can not be imported as 'abc' since that collides with the standard library,
+so it is loaded here under the name ratrack_abc (like in service.py).
+"""
+
+import importlib.util
+import sys
+from os import path
+
+
+def _load_abc():
+    if 'ratrack_abc' in sys.modules:
+        return sys.modules['ratrack_abc']
+    spec = importlib.util.spec_from_file_location(
+        'ratrack_abc', path.join(path.dirname(path.abspath(__file__)), 'abc.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ratrack_abc'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+Reconstruction = _load_abc().Reconstruction
@@ -0,0 +1,309 @@
+"""
+Long-lived ratrack service
+Keeps python, pyabc and the plotting stack imported between snakemake jobs
+and runs the regular command line tools (abc.py, plots.py, csvtools.py, precheck.py)
+on request over a local unix socket.
+"""
+
+import codecs
+import importlib
+import importlib.util
+import json
+import os
+import random
+import select
+import socket
+import socketserver
+import sys
+import traceback
+from os import path
+
+import click
+
+
+# scripts that can be run by the service, with the module name they are loaded under
+# (abc.py can not be imported as 'abc' as that would collide with the standard library)
+SCRIPTS = {
+    'abc.py': 'ratrack_abc',
+    'plots.py': 'ratrack_plots',
+    'csvtools.py': 'ratrack_csvtools',
+    'precheck.py': 'ratrack_precheck',
+}
+
+# the scripts import their heavy dependencies lazily, so these are imported up front
+WARM_MODULES = [
+    'numpy',
+    'pandas',
+    'scipy.stats',
+    'matplotlib.pyplot',
+    'matplotlib.backends.backend_pdf',
+    'pyabc',
+    'toml',
+]
+
+CODE_DIR = path.dirname(path.abspath(__file__))
+
+DEFAULT_SOCKET = 'intermediate/ratrack.sock'
+
+
+@click.group()
+def main():
+    """
+    persistent service for running ratrack commands without python startup costs
+    """
+    pass
+
+
+def load_scripts():
+    """
+    import all the command line scripts once, so that forked jobs start warm
+    """
+    # plots are only ever saved to file by the service
+    import matplotlib
+    matplotlib.use('Agg')
+    for name in WARM_MODULES:
+        importlib.import_module(name)
+    if CODE_DIR not in sys.path:
+        sys.path.insert(0, CODE_DIR)
+    modules = {}
+    for script, name in SCRIPTS.items():
+        spec = importlib.util.spec_from_file_location(name, path.join(CODE_DIR, script))
+        module = importlib.util.module_from_spec(spec)
+        # registered so that functions of the scripts can be sent to worker processes
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        modules[script] = module
+    return modules
+
+
+def job_cores(argv, cwd, budget):
+    """
+    number of cores a job is expected to occupy
+    reconstructions use parallel_simulations times simulation_threads cores,
+    everything else one
+    """
+    if len(argv) < 2 or argv[0] != 'abc.py' or argv[1] != 'reconstruct':
+        return 1
+    for flag in ['-p', '--paramfile']:
+        if flag in argv[:-1]:
+            import toml
+            params = toml.load(path.join(cwd, argv[argv.index(flag) + 1]))
+            cores = int(params['abc_params'].get('parallel_simulations', 1))
+            cores *= int(params['abc_params'].get('simulation_threads', 1))
+            return max(1, min(cores, budget))
+    return 1
+
+
+def send(stream, message):
+    """
+    write one json line of the response
+    """
+    stream.write((json.dumps(message) + '\n').encode())
+    stream.flush()
+
+
+def run_job(module, argv, cwd, output_fd, error_fd):
+    """
+    run a command line script in a forked child process
+    never returns, the child exits with the exit code of the command
+    """
+    code = 0
+    try:
+        os.chdir(cwd)
+        os.dup2(output_fd, 1)
+        os.dup2(error_fd, 2)
+        # forked children would otherwise share the random state of the service
+        random.seed()
+        import numpy as np
+        np.random.seed()
+        module.main(args=argv[1:], prog_name=argv[0], standalone_mode=False)
+    except click.ClickException as e:
+        e.show()
+        code = e.exit_code
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def relay_job(stream, module, argv, cwd):
+    """
+    run a command in a further child process and send its stdout and stderr to the client
+    as 'output' and 'error' messages, and finally its exit code
+    """
+    pipes = {}
+    for key in ['output', 'error']:
+        read_fd, write_fd = os.pipe()
+        pipes[key] = read_fd, write_fd
+    pid = os.fork()
+    if pid == 0:
+        for read_fd, __ in pipes.values():
+            os.close(read_fd)
+        run_job(module, argv, cwd, pipes['output'][1], pipes['error'][1])
+    # utf-8 characters can be split between reads
+    readers = {}
+    for key, (read_fd, write_fd) in pipes.items():
+        os.close(write_fd)
+        readers[read_fd] = key, codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while readers:
+        ready, __, __ = select.select(list(readers), [], [])
+        for read_fd in ready:
+            key, decoder = readers[read_fd]
+            chunk = os.read(read_fd, 4096)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                send(stream, {key: text})
+            if not chunk:
+                os.close(read_fd)
+                del readers[read_fd]
+    __, status = os.waitpid(pid, 0)
+    send(stream, {'exit': os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1})
+
+
+class Server(socketserver.UnixStreamServer):
+    """
+    single threaded server that forks a child process for each job
+    the request is a single json line {'argv': [...], 'cwd': ..., 'cores': ...}
+    the response is a stream of json lines with output and error text, and finally the exit code
+    jobs wait until their cores fit in the budget, the children are reaped between requests
+    """
+
+    def __init__(self, socket_path, modules, cores):
+        super().__init__(socket_path, None)
+        self.modules = modules
+        self.cores = cores
+        self.free = cores
+        # requests waiting for cores, as (connection, request, cores)
+        self.waiting = []
+        # pid -> cores of the running jobs
+        self.jobs = {}
+
+    def process_request(self, connection, client_address):
+        with connection.makefile('rb') as stream:
+            request = json.loads(stream.readline().decode())
+        argv = request['argv']
+        if not argv or argv[0] not in self.modules:
+            with connection.makefile('wb') as stream:
+                send(stream, {'error': 'unknown script: ' + ' '.join(argv[:1]) + '\n'})
+                send(stream, {'exit': 2})
+            self.shutdown_request(connection)
+            return
+
+        cores = request.get('cores')
+        if cores is None:
+            cores = job_cores(argv, request['cwd'], self.cores)
+        cores = max(1, min(int(cores), self.cores))
+        self.waiting.append((connection, request, cores))
+        self.start_jobs()
+
+    def start_jobs(self):
+        """
+        fork the waiting jobs that fit in the free cores, oldest first
+        """
+        for job in list(self.waiting):
+            connection, request, cores = job
+            if cores > self.free:
+                continue
+            self.waiting.remove(job)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self.socket.close()
+                for other, __, __ in self.waiting:
+                    other.close()
+                try:
+                    with connection.makefile('wb') as stream:
+                        relay_job(stream, self.modules[request['argv'][0]], request['argv'],
+                                  request['cwd'])
+                    self.shutdown_request(connection)
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(0)
+            self.close_request(connection)
+            self.jobs[pid] = cores
+            self.free -= cores
+
+    def service_actions(self):
+        """
+        release the cores of finished jobs, called by serve_forever
+        """
+        while self.jobs:
+            pid, __ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            self.free += self.jobs.pop(pid)
+        self.start_jobs()
+
+
+@main.command()
+@click.option('-s', '--socket', 'socket_path', type=click.Path(), default=DEFAULT_SOCKET)
+@click.option('-c', '--cores', type=int, default=None,
+              help='total number of cores shared by concurrent jobs (default: all)')
+def serve(socket_path, cores):
+    """
+    start the service and keep it running until interrupted
+    """
+    if cores is None:
+        cores = os.cpu_count()
+    if path.exists(socket_path):
+        os.remove(socket_path)
+
+    print('Loading ratrack modules', file=sys.stderr)
+    modules = load_scripts()
+
+    server = Server(socket_path, modules, cores)
+    print('Serving on', socket_path, 'with', cores, 'cores', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+@main.command(context_settings={'ignore_unknown_options': True,
+                               'allow_interspersed_args': False})
+@click.option('-s', '--socket', 'socket_path', type=click.Path(), default=DEFAULT_SOCKET)
+@click.option('-c', '--cores', type=int, default=None,
+              help='cores claimed by the job (default: guessed from the command)')
+@click.argument('command', nargs=-1, type=click.UNPROCESSED)
+def submit(socket_path, cores, command):
+    """
+    run a command (such as 'abc.py reconstruct ...') through the service
+    falls back to running it directly if no service is listening
+    """
+    command = list(command)
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        os.execvp(sys.executable,
+                  [sys.executable, path.join(CODE_DIR, command[0])] + command[1:])
+
+    with connection, connection.makefile('rwb') as stream:
+        request = {'argv': command, 'cwd': os.getcwd(), 'cores': cores}
+        stream.write((json.dumps(request) + '\n').encode())
+        stream.flush()
+        for line in stream:
+            message = json.loads(line.decode())
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+            if 'error' in message:
+                sys.stderr.write(message['error'])
+                sys.stderr.flush()
+            if 'exit' in message:
+                sys.exit(message['exit'])
+    print('Lost connection to service', file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
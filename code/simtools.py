@@ -4,9 +4,16 @@ Shared tools for abc simulation and analysis
 
 import copy
 import csv
+import functools
+import hashlib
+import json
+import os
 # import statistics
 import subprocess
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from io import StringIO
 
 import numpy as np
@@ -17,8 +24,120 @@ FORWARD_SAMPLING = 'RV'
 BACKWARD_SAMPLING = 'MLE'
 
 
-# change to 0 for less output, and 2 or 3 for more output
-VERBOSITY = 1
+# change to 1 to print every simulator call, and 2 or 3 for more output
+# (use 'abc.py monitor' to follow the progress of a reconstruction)
+VERBOSITY = 0
+
+
+# per stage [calls, seconds] in this process, see stage()
+TIMINGS = {}
+# the observations of a particle may be simulated in several threads (see abc.abc_model)
+TIMINGS_LOCK = threading.Lock()
+# workers flush their timings at most this often (seconds), so that 'abc.py monitor'
+# can follow a generation, and once more when they exit (see abc.timed_workers)
+FLUSH_INTERVAL = 5.0
+# time (perf_counter) of the last flush in this process
+LAST_FLUSH = None
+
+
+@contextmanager
+def stage(name):
+    """
+    time a block of code and add it to the counters for the named stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with TIMINGS_LOCK:
+            counter = TIMINGS.setdefault(name, [0, 0.0])
+            counter[0] += 1
+            counter[1] += elapsed
+
+
+def staged(name):
+    """
+    decorator that times every call of a function as the named stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """
+    count events (without timing them) in the counters for name
+    """
+    with TIMINGS_LOCK:
+        counter = TIMINGS.setdefault(name, [0, 0.0])
+        counter[0] += n
+
+
+def flush_timings(filename, generation, force=False):
+    """
+    append the timings collected so far to filename (if set) and reset them,
+    unless they were flushed less than FLUSH_INTERVAL seconds ago and force is not set
+    (each line is small enough to be written atomically by concurrent workers)
+    """
+    global TIMINGS, LAST_FLUSH
+    if filename is None or not TIMINGS:
+        return
+    now = time.perf_counter()
+    if not force and LAST_FLUSH is not None and now - LAST_FLUSH < FLUSH_INTERVAL:
+        return
+    LAST_FLUSH = now
+    with TIMINGS_LOCK:
+        timings, TIMINGS = TIMINGS, {}
+    line = json.dumps({'generation': generation, 'worker': os.getpid(), 'stages': timings})
+    with open(filename, 'a') as out_file:
+        out_file.write(line + '\n')
+
+
+def derive_seed(*keys):
+    """
+    deterministic 32 bit seed from a sequence of keys (numbers and strings)
+    """
+    digest = hashlib.sha256(json.dumps(keys).encode()).hexdigest()
+    return int(digest[:8], 16)
+
+
+def random_state(*keys):
+    """
+    numpy RandomState seeded from keys, or None (use the global state) if the first key is None
+    """
+    if keys[0] is None:
+        return None
+    return np.random.RandomState(derive_seed(*keys))
+
+
+def particle_seed(abc_params, generation):
+    """
+    seed for evaluating one particle, None if no seed is set in abc_params
+    in common random numbers mode every particle in a generation gets the same seed,
+    otherwise it is drawn from the (seeded, see abc.SamplerHooks) global random state
+    """
+    seed = abc_params['seed']
+    if seed is None:
+        return None
+    if abc_params['common_random_numbers']:
+        return derive_seed(seed, generation, 'common')
+    return int(np.random.randint(2**31))
+
+
+def log_particle(filename, generation, birthrate, distance):
+    """
+    append an evaluated particle to filename (if set)
+    """
+    if filename is None:
+        return
+    line = json.dumps({'generation': generation, 'birthrate': list(birthrate), 'distance': distance})
+    with open(filename, 'a') as out_file:
+        out_file.write(line + '\n')
 
 
 # simulate a lb-process using the given parameters with external software
@@ -39,9 +158,11 @@ def simulate_timeline(starting_population,
                       birthrates,
                       deathrate_interaction,
                       simulator,
-                      verbosity=VERBOSITY):
+                      verbosity=VERBOSITY,
+                      seed=None):
     """
     Simulate a lb-process using external software
+    seed is passed to stochastic simulators (the bernoulli simulator is deterministic)
     """
     # sanity checking
     assert starting_population > 0
@@ -63,9 +184,12 @@ def simulate_timeline(starting_population,
           ' -q ' + str(deathrate_interaction)
           # ' -t \'' + str(times) + '\'' \
           # ' -b \'' + str(birthrates) + '\'' \
+    if seed is not None and simulator != 'bernoulli':
+        cmd += ' -s ' + str(seed)
     if verbosity > 0:
         print(cmd)
-    output = subprocess.getoutput(cmd)
+    with stage('spawn'):
+        output = subprocess.getoutput(cmd)
     if verbosity > 1:
         print(output)
     # output from rar-engine is actually a .tsv file (printed in stdout)
@@ -75,19 +199,20 @@ def simulate_timeline(starting_population,
     size = []
     rate = []
 
-    rdr = csv.DictReader(buff, dialect='excel-tab')
-    try:
-        for line in rdr:
-            time.append(float(line['time']))
-            size.append(int(float(line['size'])))
-            # Casting like this can maybe lose precision.
-            # But python3 doesn't want to construct integers from scientific notation,
-            # whereas the float-constructor handles anything TODO fix?
-            rate.append(float(line['rate']))
-    except ValueError:
-        print('Timeline simulation does not conform to standard', file=sys.stderr)
-        print(output, file=sys.stderr)
-        exit(1)
+    with stage('parse'):
+        rdr = csv.DictReader(buff, dialect='excel-tab')
+        try:
+            for line in rdr:
+                time.append(float(line['time']))
+                size.append(int(float(line['size'])))
+                # Casting like this can maybe lose precision.
+                # But python3 doesn't want to construct integers from scientific notation,
+                # whereas the float-constructor handles anything TODO fix?
+                rate.append(float(line['rate']))
+        except ValueError:
+            print('Timeline simulation does not conform to standard', file=sys.stderr)
+            print(output, file=sys.stderr)
+            exit(1)
 
     if verbosity > 2:
         print([x for x in zip(time, size, rate)])
@@ -95,7 +220,38 @@ def simulate_timeline(starting_population,
     return np.array(time), np.array(size), np.array(rate)
 
 
-def apply_noise(size, filters):
+def bernoulli_curve(starting_population, times, birthrates, deathrate_interaction):
+    """
+    Closed form solution of the logistic growth model solved by the bernoulli simulator
+    N(t) = 1/(e^-A(t)/n0 + q(1 - e^-A(t))), where A(t) is the integral of the
+    piecewise linear birth rate (see bernoulli.cpp), for one or many curves at once.
+    starting_population - number, or one per curve
+    birthrates - control points of one curve, or 2d with one curve per row
+    Returns time, size, rate like simulate_timeline (size and rate are 2d for several curves)
+    """
+    times = np.array(sorted(times), dtype=float)
+    rates = np.atleast_2d(np.array(birthrates, dtype=float))
+    if rates.shape[1] == 1:
+        # a single value is a constant line
+        rates = np.repeat(rates, 2, axis=1)
+    segments = rates.shape[1] - 1
+    dt = times[-1] / segments if times[-1] > 0 else 1.0
+    # index of segment containing each time (t_end belongs to the final segment)
+    i = np.minimum((times / dt).astype(int), segments - 1)
+    u = times - i*dt
+    cumulative = np.zeros(rates.shape)
+    cumulative[:, 1:] = np.cumsum((rates[:, :-1] + rates[:, 1:])*dt/2.0, axis=1)
+    rate = rates[:, i] + (rates[:, i + 1] - rates[:, i])*u/dt
+    integral = cumulative[:, i] + (rates[:, i] + rate)*u/2.0
+    n0 = np.reshape(np.array(starting_population, dtype=float), (-1, 1))
+    size = 1.0/(np.exp(-integral)/n0 - deathrate_interaction*np.expm1(-integral))
+    if np.ndim(birthrates) < 2:
+        return times, size[0], rate[0]
+    return times, size, rate
+
+
+@staged('noise')
+def apply_noise(size, filters, rng=None):
     """
     Apply list of noise filters in order.
     Implemented types:
@@ -104,7 +260,10 @@ def apply_noise(size, filters):
       poisson: simulates random sampling (in any number of steps)
       gauss-multiplicative: gaussian noise with constant COV
       gauss-additive: gaussian noise with constant stdev
+    rng is a numpy RandomState (default is the global random state)
     """
+    if rng is None:
+        rng = np.random
     for filt in filters:
         if filt['name'] == ['copy']:
             continue
@@ -112,23 +271,19 @@ def apply_noise(size, filters):
             size *= filt['sample']
             # size = [x * y for x, y in zip(size, filt['sample'])]
         elif filt['name'] == 'poisson':
-            size = np.random.poisson(size * filt['sample'])
+            size = rng.poisson(size * filt['sample'])
             # size = [np.random.poisson(x * y) for x, y in zip(size, filt['sample'])]
         elif filt['name'] == 'gauss-multiplicative':
-            size = np.round(size*np.random.normal(filt['mean'], filt['sigma'], size.size), 0).astype(int)
+            size = np.round(size*rng.normal(filt['mean'], filt['sigma'], size.size), 0).astype(int)
             # size = [np.random.normal(filt['mean'], filt['sigma']) * x for x in size]
         elif filt['name'] == 'gauss-additive':
-            size += np.random.normal(filt['mean'], filt['sigma'], size.size)
+            size += rng.normal(filt['mean'], filt['sigma'], size.size)
             # size = [np.random.normal(filt['mean'], filt['sigma']) + x for x in size]
 
     return np.round(size)
 
 
-PARAMS = {}
-
-OBSERVED = {}
-
-
+@staged('samplings_dilutions')
 def get_samplings_dilutions(observed):
     """
     Get the list of all samplings and dilutions done to particular observation
@@ -159,10 +314,14 @@ def get_samplings_dilutions(observed):
     # return np.array(zip(*samplings)), np.array(zip(*dilutions))
 
 
-def apply_sampling(size, samplings, dilutions):
+@staged('sampling')
+def apply_sampling(size, samplings, dilutions, rng=None):
     """
     apply sampling methods to simulated data to make it comparable to observations
+    rng is a numpy RandomState (default is the global random state)
     """
+    if rng is None:
+        rng = np.random
 
     if BACKWARD_SAMPLING == 'MLE':
         for dilution in dilutions.transpose():
@@ -180,7 +339,7 @@ def apply_sampling(size, samplings, dilutions):
     elif FORWARD_SAMPLING == 'RV':
         for sample in samplings.transpose():
             # sample = np.array(sample)
-            size = np.random.poisson(size*sample)
+            size = rng.poisson(size*sample)
             # size = [np.random.poisson(x * y) for x, y in zip(size, sample)]
     else:
         sys.exit("Unsupported forward sampling method")
@@ -226,81 +385,110 @@ def parse_observations(infile):
 
     # print(observed)
 
-    global OBSERVED
-    OBSERVED = copy.deepcopy(observed)
     return observed
 
 
 def parse_params(paramfile, observed=None):
     """
     parse toml parameter file and observed data for lb-process parameters that are not the birthrate
+    returns a dict of the parameters
     """
     # set model parameters
-    global PARAMS
-    PARAMS = toml.load(paramfile)
+    params = toml.load(paramfile)
 
     # set defaults for variables where parameters are not mandatory
-    if 'starting_cell_count' not in PARAMS['simulation_params']:
-        PARAMS['simulation_params']['starting_cell_count'] = 'calculate'
-    if 'end_time' not in PARAMS['simulation_params']:
-        PARAMS['simulation_params']['end_time'] = 'max_observed'
-
-    if 'min_starting_cell_count' not in PARAMS['simulation_params']:
-        PARAMS['simulation_params']['min_starting_cell_count'] = 0
-    if 'starting_population_size' not in PARAMS['abc_params']:
-        PARAMS['abc_params']['starting_population_size'] = 100
-    if 'min_epsilon' not in PARAMS['abc_params']:
-        PARAMS['abc_params']['min_epsilon'] = 0.1
-    if 'max_populations' not in PARAMS['abc_params']:
-        PARAMS['abc_params']['max_populations'] = 10
-    if 'min_acceptance' not in PARAMS['abc_params']:
-        PARAMS['abc_params']['min_acceptance'] = 0.0
-    if 'plot_params' not in PARAMS:
-        PARAMS['plot_params'] = {}
-        PARAMS['plot_params'][['population_measure']] = 'Cells'
-
-    if 'distance_function' not in PARAMS['abc_params']:
-        PARAMS['abc_params']['distance_function'] = 'linear'
+    if 'starting_cell_count' not in params['simulation_params']:
+        params['simulation_params']['starting_cell_count'] = 'calculate'
+    if 'end_time' not in params['simulation_params']:
+        params['simulation_params']['end_time'] = 'max_observed'
+
+    if 'min_starting_cell_count' not in params['simulation_params']:
+        params['simulation_params']['min_starting_cell_count'] = 0
+    if 'starting_population_size' not in params['abc_params']:
+        params['abc_params']['starting_population_size'] = 100
+    if 'min_epsilon' not in params['abc_params']:
+        params['abc_params']['min_epsilon'] = 0.1
+    if 'max_populations' not in params['abc_params']:
+        params['abc_params']['max_populations'] = 10
+    if 'min_acceptance' not in params['abc_params']:
+        params['abc_params']['min_acceptance'] = 0.0
+    if 'plot_params' not in params:
+        params['plot_params'] = {}
+        params['plot_params']['population_measure'] = 'Cells'
+
+    if 'distance_function' not in params['abc_params']:
+        params['abc_params']['distance_function'] = 'linear'
+    if 'seed' not in params['abc_params']:
+        params['abc_params']['seed'] = None
+    if 'common_random_numbers' not in params['abc_params']:
+        params['abc_params']['common_random_numbers'] = False
+    if 'prescreen_factor' not in params['abc_params']:
+        params['abc_params']['prescreen_factor'] = None
+    if 'prune_threshold' not in params['abc_params']:
+        params['abc_params']['prune_threshold'] = None
+    if 'prune_generations' not in params['abc_params']:
+        params['abc_params']['prune_generations'] = 2
+    if 'warm_start' not in params['abc_params']:
+        params['abc_params']['warm_start'] = None
+    if 'warm_start_width' not in params['abc_params']:
+        params['abc_params']['warm_start_width'] = 4.0
+    if 'warm_start_generations' not in params['abc_params']:
+        params['abc_params']['warm_start_generations'] = params['abc_params']['max_populations']
+    if 'surrogate' not in params['abc_params']:
+        params['abc_params']['surrogate'] = None
+    if 'surrogate_after' not in params['abc_params']:
+        params['abc_params']['surrogate_after'] = 2
+    if 'surrogate_z' not in params['abc_params']:
+        params['abc_params']['surrogate_z'] = 2.0
+    if 'surrogate_audit' not in params['abc_params']:
+        params['abc_params']['surrogate_audit'] = 0.05
+    if 'simulation_threads' not in params['abc_params']:
+        params['abc_params']['simulation_threads'] = 1
+    if 'initial_sampling' not in params['abc_params']:
+        params['abc_params']['initial_sampling'] = 'random'
 
     # if we specified carrying capacity
-    if 'deathrate_interaction' not in PARAMS['simulation_params']:
-        PARAMS['simulation_params']['deathrate_interaction'] = 1.0/PARAMS['simulation_params']['carrying_capacity']
+    if 'deathrate_interaction' not in params['simulation_params']:
+        params['simulation_params']['deathrate_interaction'] = 1.0/params['simulation_params']['carrying_capacity']
 
     # finalize parsing
-    if PARAMS['simulation_params']['starting_cell_count'] == 'calculate':
+    if params['simulation_params']['starting_cell_count'] == 'calculate':
         if observed is None:
             sys.exit("Cannot compute starting cell count without observations")
-        PARAMS['starting_population'] = {}
+        params['starting_population'] = {}
         for id_string, obs in observed.items():
             samplings, dilutions = get_samplings_dilutions(obs)
             samplings = samplings[0]
             dilutions = dilutions[0]
-            pop = max(obs['count'][0], PARAMS['simulation_params']['min_starting_cell_count'])
+            pop = max(obs['count'][0], params['simulation_params']['min_starting_cell_count'])
             if FORWARD_SAMPLING == 'MLE' and BACKWARD_SAMPLING == 'MLE':
                 for sample in samplings:
                     pop /= sample
                 for dilution in dilutions:
                     pop *= dilution
-                PARAMS['starting_population'][id_string] = lambda x=int(pop): x
+                params['starting_population'][id_string] = lambda x=int(pop), rng=None: x
             if FORWARD_SAMPLING == 'RV' and BACKWARD_SAMPLING == 'MLE':
-                def f(x=pop, y=copy.deepcopy(samplings), z=copy.deepcopy(dilutions)):
+                def f(x=pop, y=copy.deepcopy(samplings), z=copy.deepcopy(dilutions), rng=None):
                     # print(x, list(y), list(z))
+                    if rng is None:
+                        rng = np.random
                     for sample in y:
                         x /= sample
                     for dilution in z:
-                        x = np.random.poisson(x * dilution)
+                        x = rng.poisson(x * dilution)
                     return int(x)
-                PARAMS['starting_population'][id_string] = f
+                params['starting_population'][id_string] = f
 
     else:
-        PARAMS['starting_population'] = lambda x=int(PARAMS['simulation_params']['starting_cell_count']): x
+        params['starting_population'] = lambda x=int(params['simulation_params']['starting_cell_count']), rng=None: x
     # no need to simulate longer than observed segment
-    PARAMS['end_time'] = {}
-    if PARAMS['simulation_params']['end_time'] == 'max_observed':
+    params['end_time'] = {}
+    if params['simulation_params']['end_time'] == 'max_observed':
         for id_string, obs in observed.items():
             if observed is None:
                 sys.exit("Cannot compute end_time: 'max_observed' without observations")
-            PARAMS['end_time'][id_string] = lambda x=max(obs['time']): x
+            params['end_time'][id_string] = lambda x=max(obs['time']): x
     else:
-        PARAMS['end_time'][id_string] = lambda x=float(PARAMS['end_time']): x
+        params['end_time'][id_string] = lambda x=float(params['end_time']): x
+    return params
 
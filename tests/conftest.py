@@ -0,0 +1,22 @@
+"""
+the scripts in code/ import each other as top level modules
+"""
+
+import sys
+from os import path
+
+import pytest
+
+
+CODE = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'code')
+if CODE not in sys.path:
+    sys.path.insert(0, CODE)
+
+
+@pytest.fixture
+def ratrack_abc():
+    """
+    abc.py, loaded under the name ratrack_abc like in reconstruction.py
+    """
+    import reconstruction
+    return reconstruction._load_abc()
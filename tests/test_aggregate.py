@@ -0,0 +1,73 @@
+"""
+cache of plots.py aggregate
+"""
+
+import csv
+import os
+
+import pytest
+
+import plots
+
+
+PARAMS = """[plot_params]
+coupling_names = '{}'
+"""
+
+
+def write_group(tmpdir, group, rates):
+    """
+    intermediate/demo.g<group>.db with a one control point population, and its parameter file
+    """
+    import dbtools
+    dbfile = str(tmpdir.join('demo.g{}.db'.format(group)))
+    tmpdir.join('demo.g{}.toml'.format(group)).write(PARAMS.format('group' + str(group)))
+    history = dbtools.new_history(dbfile, {}, ['abc_model'], {})
+    particles = [(0, {'birthrate.r0': x}, 1.0/len(rates), 1.0) for x in rates]
+    dbtools.append_population(history, 0, 2.0, particles, len(rates), ['abc_model'])
+    history.done()
+    return dbfile
+
+
+def test_cache_key(tmpdir):
+    dbfile = tmpdir.join('demo.g0.db')
+    dbfile.write('data')
+    key = plots.cache_key(str(dbfile), 1)
+    assert key == plots.cache_key(str(dbfile), 1)
+    assert key != plots.cache_key(str(dbfile), 2)
+    stat = os.stat(str(dbfile))
+    os.utime(str(dbfile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert key[1:] == plots.cache_key(str(dbfile), 1)[1:]
+    assert key != plots.cache_key(str(dbfile), 1)
+    dbfile.write('more data')
+    assert key[1] != plots.cache_key(str(dbfile), 1)[1]
+
+
+def aggregate(tmpdir, capsys):
+    """
+    aggregate demo, returns the status message and the table
+    """
+    csvfile = str(tmpdir.join('demo.csv'))
+    plots.aggregate.callback('demo', str(tmpdir), csvfile, None, 1, 1, ())
+    with open(csvfile) as csv_in:
+        rows = list(csv.DictReader(csv_in))
+    return capsys.readouterr().err, rows
+
+
+def test_aggregate_reads_changed_databases(tmpdir, capsys):
+    pytest.importorskip('pyabc')
+    write_group(tmpdir, 0, [0.5, 1.5])
+    write_group(tmpdir, 1, [1.0])
+    message, rows = aggregate(tmpdir, capsys)
+    assert 'Reading 2 of 2 databases' in message
+    assert [(x['name'], float(x['rate_mean'])) for x in rows] == [('group0', 1.0), ('group1', 1.0)]
+
+    message, cached = aggregate(tmpdir, capsys)
+    assert 'Reading 0 of 2 databases' in message
+    assert cached == rows
+
+    os.remove(str(tmpdir.join('demo.g1.db')))
+    write_group(tmpdir, 1, [2.0])
+    message, rows = aggregate(tmpdir, capsys)
+    assert 'Reading 1 of 2 databases' in message
+    assert [(x['name'], float(x['rate_mean'])) for x in rows] == [('group0', 1.0), ('group1', 2.0)]
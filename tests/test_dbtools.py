@@ -0,0 +1,33 @@
+"""
+pyabc History databases written by dbtools
+"""
+
+import pytest
+
+
+def test_population_round_trip(tmpdir):
+    pytest.importorskip('pyabc')
+    import dbtools
+    dbfile = str(tmpdir.join('written.db'))
+    model_names = ['abc_model', 'abc_model']
+    history = dbtools.new_history(dbfile, {'minimal.count': [1.0, 2.0]}, model_names,
+                                  {'engine': 'test'})
+    particles = [
+        (0, {'birthrate.r0': 0.5}, 1.0, 3.0),
+        (1, {'birthrate.r0': 0.5, 'birthrate.r1': 1.0}, 2.0, 1.0),
+        (1, {'birthrate.r0': 1.5, 'birthrate.r1': 1.0}, 1.0, 2.0),
+    ]
+    dbtools.append_population(history, 0, 3.0, particles, 10, model_names)
+    history.done()
+
+    from pyabc import History
+    history = History('sqlite:///' + dbfile)
+    assert history.max_t == 0
+    probabilities = history.get_model_probabilities(0)['p']
+    assert [probabilities[0], probabilities[1]] == pytest.approx([0.25, 0.75])
+    read = sorted(dbtools.read_population(history, 0), key=lambda x: (x[0], x[3]))
+    written = sorted(particles, key=lambda x: (x[0], x[3]))
+    assert [(m, parameter, d) for m, parameter, __, d, __ in read] == \
+        [(m, parameter, d) for m, parameter, __, d in written]
+    assert sum(x[2] for x in read) == pytest.approx(1.0)
+    assert [x[2] for x in read] == pytest.approx([0.25, 0.5, 0.25])
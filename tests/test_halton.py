@@ -0,0 +1,57 @@
+"""
+scrambled halton sequence for the initial samples (initial_sampling = 'halton')
+"""
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+
+def test_points_in_unit_cube(ratrack_abc):
+    sequence = ratrack_abc.HaltonSequence(4, seed=1)
+    points = np.array([sequence.point(i) for i in range(500)])
+    assert points.shape == (500, 4)
+    assert np.all(points >= 0.0) and np.all(points < 1.0)
+    assert len(np.unique(points, axis=0)) == 500
+
+
+def test_reproducible(ratrack_abc):
+    first = [ratrack_abc.HaltonSequence(3, seed=1).point(i) for i in range(20)]
+    again = [ratrack_abc.HaltonSequence(3, seed=1).point(i) for i in range(20)]
+    other = [ratrack_abc.HaltonSequence(3, seed=2).point(i) for i in range(20)]
+    assert np.array_equal(first, again)
+    assert not np.array_equal(first, other)
+
+
+@pytest.mark.parametrize('digits', [1, 2])
+def test_stratified(ratrack_abc, digits):
+    # the first base^k points of each dimension fall in different intervals of width base^-k
+    sequence = ratrack_abc.HaltonSequence(3, seed=1)
+    for dimension, base in enumerate(sequence.bases):
+        n = base**digits
+        strata = [int(sequence.point(i)[dimension]*n) for i in range(n)]
+        assert sorted(strata) == list(range(n))
+
+
+def test_next_shared_between_workers(ratrack_abc):
+    sequence = ratrack_abc.HaltonSequence(2, seed=1)
+    assert np.array_equal(sequence.next(), sequence.point(0))
+    worker = multiprocessing.get_context('fork').Process(target=sequence.next)
+    worker.start()
+    worker.join()
+    assert np.array_equal(sequence.next(), sequence.point(2))
+
+
+def test_quasi_random_prior(ratrack_abc):
+    pyabc = pytest.importorskip('pyabc')
+    lows, highs = [0.5, 1.0], [1.5, 3.0]
+    prior = pyabc.Distribution(birthrate={
+        'r0': pyabc.RV('uniform', 0.5, 1.0), 'r1': pyabc.RV('uniform', 1.0, 2.0)})
+    prior = ratrack_abc.quasi_random(prior, lows, highs, seed=1)
+    sequence = ratrack_abc.HaltonSequence(2, seed=1)
+    for i in range(10):
+        parameter = prior.rvs()
+        assert sorted(parameter) == ['birthrate.r0', 'birthrate.r1']
+        expected = np.array(lows) + sequence.point(i)*(np.array(highs) - np.array(lows))
+        assert [parameter['birthrate.r0'], parameter['birthrate.r1']] == pytest.approx(expected)
@@ -0,0 +1,141 @@
+"""
+prior density and truncation of abc.py reweight
+"""
+
+import pytest
+
+
+OBSERVATIONS = """name,time,count,sample1,birthrate_group
+minimal,0.0,19,0.01,0
+minimal,2.0,105,0.01,0
+minimal,4.0,403,0.01,0
+"""
+
+PARAMS = """[simulation_params]
+carrying_capacity = 3e6
+
+[abc_params]
+rate_limits = {}
+resolution_limits = {}
+simulator = 'bernoulli'
+distance_function = '{}'
+
+[[filters]]
+name = 'gauss-multiplicative'
+mean = 1.0
+sigma = 0.05
+"""
+
+
+def test_prior_density(ratrack_abc):
+    assert ratrack_abc.prior_density([0.5, 2.0], 1) == pytest.approx(1/1.5)
+    assert ratrack_abc.prior_density([2.0, 0.5], 3) == pytest.approx(1.5**-3)
+
+
+def test_prior_widened(ratrack_abc):
+    previous = {'rate_limits': [0.0, 2.0], 'resolution_limits': [1, 3]}
+    assert ratrack_abc.prior_widened(previous, previous) is None
+    assert ratrack_abc.prior_widened(
+        previous, {'rate_limits': [2.0, 0.5], 'resolution_limits': [2, 3]}) is None
+    assert ratrack_abc.prior_widened(
+        previous, {'rate_limits': [0.0, 2.5], 'resolution_limits': [1, 3]}) is not None
+    assert ratrack_abc.prior_widened(
+        previous, {'rate_limits': [-0.5, 2.0], 'resolution_limits': [1, 3]}) is not None
+    assert ratrack_abc.prior_widened(
+        previous, {'rate_limits': [0.0, 2.0], 'resolution_limits': [1, 4]}) is not None
+
+
+@pytest.fixture
+def previous(tmpdir):
+    """
+    observations, parameters and database of a reconstruction with rate_limits [0, 3]
+    and resolution_limits [1, 2]. The database is only created by previous_population.
+    """
+    obsfile = tmpdir.join('minimal.csv')
+    obsfile.write(OBSERVATIONS)
+    paramfile = tmpdir.join('previous.toml')
+    paramfile.write(PARAMS.format([0.0, 3.0], [1, 2], 'linear'))
+    return str(obsfile), str(paramfile), str(tmpdir.join('previous.db'))
+
+
+@pytest.fixture
+def previous_population(previous):
+    """
+    previous, with a population of one and two control point particles in the database
+    """
+    pytest.importorskip('pyabc')
+    import dbtools
+    dbfile = previous[2]
+    model_names = ['abc_model', 'abc_model']
+    history = dbtools.new_history(dbfile, {}, model_names, {})
+    particles = [
+        (0, {'birthrate.r0': 0.5}, 0.25, 1.0),
+        (0, {'birthrate.r0': 2.5}, 0.25, 1.0),
+        (1, {'birthrate.r0': 0.5, 'birthrate.r1': 1.0}, 0.25, 1.0),
+        (1, {'birthrate.r0': 1.5, 'birthrate.r1': 1.0}, 0.25, 1.0),
+    ]
+    dbtools.append_population(history, 0, 2.0, particles, 4, model_names)
+    history.done()
+    return previous
+
+
+def reweight(ratrack_abc, tmpdir, previous, rate_limits, resolution_limits,
+             distance_function='linear'):
+    """
+    reweight previous to the given priors, returns the Reconstruction
+    """
+    obsfile, previous_paramfile, previous_dbfile = previous
+    paramfile = tmpdir.join('current.toml')
+    paramfile.write(PARAMS.format(rate_limits, resolution_limits, distance_function))
+    reconstruction = ratrack_abc.Reconstruction(str(paramfile), obsfile,
+                                                str(tmpdir.join('current.db')))
+    reconstruction.reweight(previous_dbfile, previous_paramfile, 0.0)
+    return reconstruction
+
+
+@pytest.fixture
+def reruns(monkeypatch, ratrack_abc):
+    """
+    list of the databases that reweight falls back to reconstructing
+    """
+    dbfiles = []
+
+    def run(self):
+        dbfiles.append(self.dbfile)
+
+    monkeypatch.setattr(ratrack_abc.Reconstruction, 'run', run)
+    return dbfiles
+
+
+def test_reweight_truncates(ratrack_abc, tmpdir, previous_population, reruns):
+    from pyabc import History
+    reconstruction = reweight(ratrack_abc, tmpdir, previous_population, [0.0, 2.0], [1, 2])
+    assert not reruns
+    # reading the previous parameters leaves those of the reconstruction alone
+    assert reconstruction.params['abc_params']['rate_limits'] == [0.0, 2.0]
+    history = History('sqlite:///' + reconstruction.dbfile)
+    df, w = history.get_distribution(m=0, t=0)
+    assert list(df['birthrate.r0']) == [0.5]
+    df, w = history.get_distribution(m=1, t=0)
+    assert sorted(df['birthrate.r0']) == [0.5, 1.5]
+    # two control points lose more prior volume than one when going from 3 to 2 wide
+    probabilities = history.get_model_probabilities(0)['p']
+    assert probabilities[0] == pytest.approx((1/2)/(1/2 + 2*(3/2)/2))
+
+
+@pytest.mark.parametrize('rate_limits, resolution_limits', [
+    ([0.0, 4.0], [1, 2]),
+    ([0.0, 3.0], [1, 3]),
+])
+def test_reweight_wider_prior_reruns(ratrack_abc, tmpdir, previous, reruns,
+                                     rate_limits, resolution_limits):
+    pytest.importorskip('pyabc')
+    reconstruction = reweight(ratrack_abc, tmpdir, previous, rate_limits, resolution_limits)
+    assert reruns == [reconstruction.dbfile]
+
+
+def test_reweight_other_distance_function_reruns(ratrack_abc, tmpdir, previous_population,
+                                                 reruns):
+    reconstruction = reweight(ratrack_abc, tmpdir, previous_population, [0.0, 3.0], [1, 2],
+                              'rmsd')
+    assert reruns == [reconstruction.dbfile]
@@ -0,0 +1,62 @@
+"""
+relaying the output of jobs run by the ratrack service
+"""
+
+import io
+import json
+import os
+import sys
+import time
+
+import click
+import pytest
+
+import service
+
+
+@click.group()
+def job():
+    pass
+
+
+@job.command()
+def split():
+    # one character split over two writes
+    encoded = 'rate µ=1.0\n'.encode()
+    middle = encoded.index('µ'.encode()) + 1
+    os.write(1, encoded[:middle])
+    # so that the relay reads the halves separately
+    time.sleep(0.2)
+    os.write(1, encoded[middle:])
+    os.write(2, 'warning ±0.5\n'.encode())
+    sys.exit(3)
+
+
+class Module:
+    main = job
+
+
+class Stream(io.BytesIO):
+    def close(self):
+        pass
+
+
+def relay(argv, tmpdir):
+    """
+    messages sent by relay_job for argv
+    """
+    stream = Stream()
+    service.relay_job(stream, Module, argv, str(tmpdir))
+    return [json.loads(x) for x in stream.getvalue().decode().splitlines()]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='the service forks its jobs')
+def test_relay_job(tmpdir):
+    messages = relay(['job.py', 'split'], tmpdir)
+    assert messages[-1] == {'exit': 3}
+    output = ''.join(x.get('output', '') for x in messages)
+    error = ''.join(x.get('error', '') for x in messages)
+    assert output == 'rate µ=1.0\n'
+    assert error == 'warning ±0.5\n'
+    assert '�' not in output
+
@@ -0,0 +1,104 @@
+"""
+closed form bernoulli curves and reproducible seeding of simtools
+"""
+
+import numpy as np
+import pytest
+
+import simtools
+
+
+def piecewise_rate(t, end_time, birthrates):
+    """
+    birth rate at time t, linear between control points spread evenly over [0, end_time]
+    """
+    if len(birthrates) == 1:
+        return birthrates[0]
+    return np.interp(t, np.linspace(0.0, end_time, len(birthrates)), birthrates)
+
+
+def integrate_logistic(starting_population, times, birthrates, deathrate_interaction,
+                       steps=400):
+    """
+    dN/dt = b(t) N (1 - q N) by fourth order runge kutta
+    """
+    def derivative(t, n):
+        return piecewise_rate(t, times[-1], birthrates)*n*(1.0 - deathrate_interaction*n)
+
+    sizes = [float(starting_population)]
+    n = float(starting_population)
+    for start, end in zip(times[:-1], times[1:]):
+        h = (end - start)/steps
+        t = start
+        for __ in range(steps):
+            k1 = derivative(t, n)
+            k2 = derivative(t + h/2, n + h/2*k1)
+            k3 = derivative(t + h/2, n + h/2*k2)
+            k4 = derivative(t + h, n + h*k3)
+            n += h/6*(k1 + 2*k2 + 2*k3 + k4)
+            t += h
+        sizes.append(n)
+    return np.array(sizes)
+
+
+@pytest.mark.parametrize('birthrates', [[0.8], [0.2, 1.5], [1.2, 0.1, 0.9, -0.3]])
+@pytest.mark.parametrize('deathrate_interaction', [0.0, 1e-3])
+def test_bernoulli_curve_integrates_logistic_growth(birthrates, deathrate_interaction):
+    times = [0.0, 1.5, 3.0, 4.0, 7.0, 9.0]
+    time, size, rate = simtools.bernoulli_curve(50, times, birthrates, deathrate_interaction)
+    assert list(time) == times
+    assert rate == pytest.approx([piecewise_rate(t, times[-1], birthrates) for t in times])
+    assert size == pytest.approx(
+        integrate_logistic(50, times, birthrates, deathrate_interaction), rel=1e-6)
+
+
+def test_bernoulli_curve_rows():
+    times = [0.0, 2.0, 5.0, 6.0]
+    birthrates = [[0.3, 1.1, 0.4], [1.0, 0.0, 2.0]]
+    __, size, rate = simtools.bernoulli_curve([10, 20], times, birthrates, 1e-2)
+    assert size.shape == rate.shape == (2, len(times))
+    for row, (n0, curve) in enumerate(zip([10, 20], birthrates)):
+        __, row_size, row_rate = simtools.bernoulli_curve(n0, times, curve, 1e-2)
+        assert size[row] == pytest.approx(row_size)
+        assert rate[row] == pytest.approx(row_rate)
+
+
+def test_derive_seed():
+    seed = simtools.derive_seed(1, 'minimal', 'noise')
+    assert seed == simtools.derive_seed(1, 'minimal', 'noise')
+    assert 0 <= seed < 2**32
+    assert seed != simtools.derive_seed(2, 'minimal', 'noise')
+    assert seed != simtools.derive_seed(1, 'minimal', 'start')
+    assert seed != simtools.derive_seed('minimal', 1, 'noise')
+
+
+def test_random_state():
+    assert simtools.random_state(None, 'minimal', 'noise') is None
+    first = simtools.random_state(1, 'minimal', 'noise').uniform(size=5)
+    assert list(first) == list(simtools.random_state(1, 'minimal', 'noise').uniform(size=5))
+    assert list(first) != list(simtools.random_state(1, 'other', 'noise').uniform(size=5))
+
+
+def test_seeded_noise():
+    size = np.linspace(1e3, 1e5, 5)
+    filters = [{'name': 'poisson', 'sample': 0.1},
+               {'name': 'gauss-multiplicative', 'mean': 1.0, 'sigma': 0.05}]
+
+    def noisy(seed):
+        return simtools.apply_noise(size.copy(), filters, simtools.random_state(seed, 'noise'))
+
+    assert list(noisy(7)) == list(noisy(7))
+    assert list(noisy(7)) != list(noisy(8))
+
+
+def test_particle_seed():
+    abc_params = {'seed': 3, 'common_random_numbers': True}
+    assert simtools.particle_seed(abc_params, 2) == simtools.particle_seed(abc_params, 2)
+    assert simtools.particle_seed(abc_params, 2) != simtools.particle_seed(abc_params, 3)
+    assert simtools.particle_seed({'seed': None, 'common_random_numbers': True}, 2) is None
+    abc_params['common_random_numbers'] = False
+    np.random.seed(5)
+    first = [simtools.particle_seed(abc_params, 2) for __ in range(3)]
+    np.random.seed(5)
+    assert first == [simtools.particle_seed(abc_params, 2) for __ in range(3)]
+    assert len(set(first)) == 3
@@ -0,0 +1,62 @@
+"""
+import time of the command line entry points
+"""
+
+import re
+import subprocess
+import sys
+from os import path
+
+import pytest
+
+
+CODE = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'code')
+
+# import time budget (seconds) for running each entry point with --help
+STARTUP_BUDGET = {
+    'abc.py': 0.25,
+    'plots.py': 0.25,
+    'csvtools.py': 0.25,
+    'precheck.py': 0.25,
+    'service.py': 0.25,
+    'bench.py': 0.25,
+}
+# modules that are slow to import and only needed by some commands
+STARTUP_FORBIDDEN = ['pyabc', 'matplotlib', 'pandas', 'scipy', 'sklearn']
+
+
+def import_times(script):
+    """
+    run script --help with python -X importtime
+    returns a dict of top level module -> cumulative import time in seconds
+    and the set of all imported modules
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    re_line = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+    top_level = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = re_line.match(line)
+        if match is None:
+            continue
+        modules.add(match.group(4))
+        if not match.group(3):
+            top_level[match.group(4)] = int(match.group(2))*1e-6
+    return top_level, modules
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime needs python 3.7')
+@pytest.mark.parametrize('script', sorted(STARTUP_BUDGET))
+def test_startup(script):
+    # use the fastest of a few runs to reduce noise from a busy machine
+    runs = [import_times(path.join(CODE, script)) for __ in range(3)]
+    top_level, modules = min(runs, key=lambda x: sum(x[0].values()))
+    forbidden = sorted({x for x in modules if x.split('.')[0] in STARTUP_FORBIDDEN})
+    assert not forbidden, 'imports heavy modules: ' + ', '.join(forbidden)
+    total = sum(top_level.values())
+    slowest = sorted(top_level.items(), key=lambda x: -x[1])[:5]
+    assert total <= STARTUP_BUDGET[script], 'slowest imports: ' + ', '.join(
+        '{} {:.3f}s'.format(k, v) for k, v in slowest)